@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import argparse
+import concurrent.futures
+import functools
+import gzip
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+
+import log_analyzer
+
+url_templates = [
+    '/api/v2/group/{0}/banners',
+    '/api/v2/banner/{0}',
+    '/api/v2/group/{0}/statistic/sites/?date_type=day&date_from=2017-06-28&date_to=2017-06-28',
+    '/api/1/photogenic_banners/list/?server_name=WIN7RB{0}',
+    '/export/appinstall_raw/2017-06-{0}/',
+]
+user_agents = ['python-requests/2.13.0', 'Configovod', 'Lynx/2.8.8dev.9 libwww-FM/2.14 SSL-MM/1.4.1 GNUTLS/2.10.5',
+               'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/59.0.3071.115']
+# budget of the import of log_analyzer as a library, ms above the interpreter startup
+STARTUP_BUDGET_MS = 50
+# modules the library import must not load, they are imported by the functions using them
+LAZY_MODULES = ('numpy', 'argparse', 'concurrent.futures', 'cProfile', 'pickle', 'shutil', 'subprocess', 'calendar')
+
+malformed_line = '1.169.137.128 -  - [29/Jun/2017:03:50:22 +0300] "-" 400 0 "-" "-" "-" "-" "-" 0.000\n'
+
+
+def synthetic_lines(count_lines: int, count_urls: int = 10000, skew: float = 1.1, malformed: float = 0.01,
+                    seed: int = 1):
+    """
+    Function-generator of reproducible 'ui_short' log lines of one day
+    :param count_lines: number of lines
+    :param count_urls: number of distinct URLs
+    :param skew: Zipf exponent of the URL popularity, 0 - uniform
+    :param malformed: share of lines not matching the log format
+    :param seed: random seed
+    :return: log lines with the line feed
+    """
+    rnd = random.Random(seed)
+    urls = [url_templates[index % len(url_templates)].format(index) for index in range(count_urls)]
+    cum_weights = list(itertools.accumulate(1 / (rank + 1) ** skew for rank in range(count_urls)))
+    batch_size = 10000
+    for batch_start in range(0, count_lines, batch_size):
+        size = min(batch_size, count_lines - batch_start)
+        for index, url in enumerate(rnd.choices(urls, cum_weights=cum_weights, k=size), batch_start):
+            if rnd.random() < malformed:
+                yield malformed_line
+                continue
+            seconds = index * 86400 // count_lines
+            yield '1.%d.%d.%d -  - [29/Jun/2017:%02d:%02d:%02d +0300] "%s %s HTTP/1.1" %d %d "-" "%s" "-" ' \
+                  '"1498697422-%d-4708-9752772" "%x" %.3f\n' % (
+                      rnd.randrange(256), rnd.randrange(256), rnd.randrange(256),
+                      seconds // 3600, seconds // 60 % 60, seconds % 60,
+                      'GET' if rnd.random() < 0.9 else 'POST', url, rnd.choice((200, 200, 200, 304, 404, 500)),
+                      rnd.randrange(100000), rnd.choice(user_agents), rnd.randrange(1 << 32), rnd.randrange(1 << 48),
+                      rnd.lognormvariate(-2, 1.2))
+
+
+def generate_log(log_path: str, count_lines: int, count_urls: int = 10000, skew: float = 1.1,
+                 malformed: float = 0.01, seed: int = 1) -> int:
+    """
+    Writes a synthetic log, gzip-compressed if the name ends with .gz
+    :return: size of the uncompressed log in bytes
+    """
+    open_log = gzip.open if log_path.endswith('.gz') else open
+    size_bytes = 0
+    with open_log(log_path, 'wt', encoding='utf-8') as log_file:
+        for line in synthetic_lines(count_lines, count_urls, skew, malformed, seed):
+            size_bytes += len(line)
+            log_file.write(line)
+    return size_bytes
+
+
+def bench_parser(name: str, parse_line, lines: list, repeat: int) -> float:
+    """
+    Measures the throughput of a line parser
+    :param name: name of the parser in the output
+    :param parse_line: function parsing one log line
+    :param lines: list of log lines
+    :param repeat: number of measurements, the best one is taken
+    :return: lines per second
+    """
+    best = min(timeit.repeat(lambda: [parse_line(line) for line in lines], number=1, repeat=repeat))
+    lines_sec = len(lines) / best
+    print('%-10s %12.0f lines/sec' % (name, lines_sec))
+    return lines_sec
+
+
+def bench_ingestion(name: str, config: dict, log_name: str, size_bytes: int, repeat: int) -> float:
+    """
+    Measures the throughput of reading and parsing a log file by 'parsing_string_log'
+    :param name: name of the case in the output
+    :param config: analyzer config
+    :param log_name: name of the log file in 'LOG_DIR'
+    :param size_bytes: size of the uncompressed log
+    :param repeat: number of measurements, the best one is taken
+    :return: MB per second of uncompressed log
+    """
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in log_analyzer.parsing_string_log(config, log_name):
+            pass
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    mb_sec = size_bytes / best / 2 ** 20
+    print('%-22s %10.1f MB/s' % (name, mb_sec))
+    return mb_sec
+
+
+def run_ingestion(lines: list, repeat: int):
+    """
+    Compares plain and gzip logs read in the parsing thread and by the decompression pipeline
+    """
+    with tempfile.TemporaryDirectory() as log_dir:
+        log_data = ''.join(lines).encode('utf-8')
+        plain_name = 'nginx-access-ui.log-20170630.log'
+        gz_name = 'nginx-access-ui.log-20170630.gz'
+        with open(os.path.join(log_dir, plain_name), 'wb') as log_file:
+            log_file.write(log_data)
+        with open(os.path.join(log_dir, gz_name), 'wb') as log_file:
+            log_file.write(gzip.compress(log_data, compresslevel=6))
+        config = dict(log_analyzer.default_config, LOG_DIR=log_dir)
+        bench_ingestion('plain', config, plain_name, len(log_data), repeat)
+        for gzip_reader in ("text", "thread", "auto"):
+            config["GZIP_READER"] = gzip_reader
+            bench_ingestion('gzip (%s)' % gzip_reader, config, gz_name, len(log_data), repeat)
+
+
+def read_log_case(config: dict, log_name: str) -> tuple:
+    """
+    Subprocess job: reads and parses the whole log with 'parsing_string_log'
+    :return: (elapsed seconds, number of lines, peak RSS in KB)
+    """
+    counter = 0
+    start = time.perf_counter()
+    for _ in log_analyzer.parsing_string_log(config, log_name):
+        counter += 1
+    elapsed = time.perf_counter() - start
+    return elapsed, counter, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def run_plain_reader(lines: list, repeat: int):
+    """
+    Compares lines/sec and peak RSS of the text-mode and memory-mapped reading of a .log file,
+    every measurement runs in a fresh interpreter so the peak RSS belongs to one case
+    """
+    with tempfile.TemporaryDirectory() as log_dir:
+        log_name = 'nginx-access-ui.log-20170630.log'
+        with open(os.path.join(log_dir, log_name), 'w', encoding='utf-8') as log_file:
+            log_file.writelines(lines)
+        config = dict(log_analyzer.default_config, LOG_DIR=log_dir)
+        context = multiprocessing.get_context('spawn')
+        for plain_reader in ("text", "mmap"):
+            config["PLAIN_READER"] = plain_reader
+            results = []
+            for _ in range(repeat):
+                with concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                    results.append(executor.submit(read_log_case, config, log_name).result())
+            elapsed, _, max_rss = min(results)
+            print('%-6s %12.0f lines/sec %10d KB peak RSS' % (plain_reader, len(lines) / elapsed, max_rss))
+
+
+def run_parser(lines: list, repeat: int):
+    """
+    Compares the template and the compiled line parsers
+    """
+    template = [log_analyzer.MASK_URL, log_analyzer.MASK_REQUEST_TIME]
+    template_rate = bench_parser('template', lambda line: log_analyzer.parsing_string(line, template),
+                                 lines, repeat)
+    compiled_rate = bench_parser('compiled', log_analyzer.parsing_line, lines, repeat)
+    print('speedup    %12.2fx' % (compiled_rate / template_rate))
+
+
+def peak_rss() -> int:
+    """
+    :return: peak RSS of the process in KB, it only grows during the process
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def timed_stage(results: dict, name: str, function, *args, lines: int = None, size_bytes: int = None):
+    """
+    Runs one pipeline stage and records its wall and CPU time and throughput
+    :return: result of the stage
+    """
+    start_cpu = time.process_time()
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    stage = {"seconds": elapsed, "cpu_seconds": time.process_time() - start_cpu}
+    if lines is not None:
+        stage["lines_sec"] = lines / elapsed
+    if size_bytes is not None:
+        stage["mb_sec"] = size_bytes / elapsed / 2 ** 20
+    results[name] = stage
+    print('%-18s %8.3f s %12s %10s' % (
+        name, elapsed, '%.0f l/s' % stage["lines_sec"] if "lines_sec" in stage else '',
+        '%.1f MB/s' % stage["mb_sec"] if "mb_sec" in stage else ''))
+    return result
+
+
+def run_pipeline(args) -> dict:
+    """
+    Generates a synthetic log and times each stage of the analyzer pipeline,
+    the peak RSS is measured once for the whole run
+    :return: dictionary of the parameters, the stage measurements and the peak RSS of the run
+    """
+    log_analyzer.template_report = os.path.join(os.path.dirname(os.path.abspath(log_analyzer.__file__)),
+                                                'report.html')
+    with tempfile.TemporaryDirectory() as log_dir:
+        log_name = 'nginx-access-ui.log-20170629.%s' % ('gz' if args.gzip else 'log')
+        size_bytes = generate_log(os.path.join(log_dir, log_name), args.lines, args.urls, args.skew,
+                                  args.malformed, args.seed)
+        config = dict(log_analyzer.default_config, LOG_DIR=log_dir, REPORT_DIR=log_dir)
+        results = {}
+        parsed = timed_stage(results, 'parsing_string_log', lambda: list(log_analyzer.parsing_string_log(
+            config, log_name)), lines=args.lines, size_bytes=size_bytes)
+        timed_stage(results, 'sort_list_url', log_analyzer.sort_list_url, parsed, lines=len(parsed))
+        aggregates = timed_stage(results, 'aggregate_url', functools.partial(
+            log_analyzer.aggregate_url, limits=log_analyzer.quantile_limits(config)), parsed, lines=len(parsed))
+        del parsed
+        result_mas = timed_stage(results, 'create_result_mas', log_analyzer.create_result_mas, aggregates,
+                                 config["REPORT_SIZE"])
+        timed_stage(results, 'create_report', log_analyzer.create_report, config, log_name, result_mas)
+    run_peak_rss = peak_rss()
+    print('%-18s %10d KB' % ('run peak RSS', run_peak_rss))
+    return {"parameters": {"lines": args.lines, "urls": args.urls, "skew": args.skew, "malformed": args.malformed,
+                           "gzip": args.gzip, "seed": args.seed, "size_bytes": size_bytes,
+                           "distinct_urls": len(aggregates)},
+            "stages": results,
+            "run_peak_rss_kb": run_peak_rss}
+
+
+def python_wall_time(code: str) -> float:
+    """
+    :param code: Python code run by a new interpreter in the directory of log_analyzer
+    :return: wall time of the interpreter in seconds
+    """
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], check=True,
+                   cwd=os.path.dirname(os.path.abspath(log_analyzer.__file__)))
+    return time.perf_counter() - start
+
+
+def run_startup(args):
+    """
+    Measures the import of log_analyzer in new interpreters against 'STARTUP_BUDGET_MS' (with the bytecode
+    cache written by the first import) and the calls/sec of 'analyze' on a small log in the same process
+    """
+    count = max(args.repeat, 10)
+    python_wall_time('import log_analyzer')
+    base = statistics.median(python_wall_time('pass') for _ in range(count))
+    imported = statistics.median(python_wall_time('import log_analyzer') for _ in range(count))
+    import_ms = (imported - base) * 1000
+    print('%-18s %8.1f ms (budget %d ms) %s' % ('import', import_ms, STARTUP_BUDGET_MS,
+                                                 'OK' if import_ms <= STARTUP_BUDGET_MS else 'OVER BUDGET'))
+    loaded = subprocess.run([sys.executable, '-c', 'import sys, log_analyzer; print(*[module for module in %r '
+                                                   'if module in sys.modules])' % (LAZY_MODULES,)],
+                            check=True, stdout=subprocess.PIPE, universal_newlines=True,
+                            cwd=os.path.dirname(os.path.abspath(log_analyzer.__file__))).stdout.split()
+    print('%-18s %s' % ('lazy modules', 'imported: ' + ', '.join(loaded) if loaded else 'not imported'))
+    with tempfile.TemporaryDirectory() as log_dir:
+        log_path = os.path.join(log_dir, 'nginx-access-ui.log-20170629.log')
+        generate_log(log_path, args.lines, args.urls, args.skew, args.malformed, args.seed)
+        calls = timeit.repeat(lambda: log_analyzer.analyze(log_path), number=10, repeat=args.repeat)
+        print('%-18s %8.1f calls/s of %d lines' % ('analyze', 10 / min(calls), args.lines))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Log analizer benchmark')
+    parser.add_argument('--lines', type=int, default=100000, help='number of log lines')
+    parser.add_argument('--repeat', type=int, default=3, help='number of measurements')
+    parser.add_argument('--suite', choices=('parser', 'ingestion', 'plain', 'pipeline', 'startup'), default='parser',
+                        help='benchmark to run')
+    parser.add_argument('--urls', type=int, default=10000, help='number of distinct URLs')
+    parser.add_argument('--skew', type=float, default=1.1, help='Zipf exponent of the URL popularity')
+    parser.add_argument('--malformed', type=float, default=0.01, help='share of malformed lines')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--gzip', action='store_true', help='gzip-compressed log for the pipeline suite')
+    parser.add_argument('--json', type=str, help='write the pipeline measurements to this JSON file')
+    parser.add_argument('--generate', type=str, help='only write a synthetic log to this path')
+    args = parser.parse_args()
+    if args.generate:
+        generate_log(args.generate, args.lines, args.urls, args.skew, args.malformed, args.seed)
+        return
+    if args.suite == 'startup':
+        run_startup(args)
+        return
+    if args.suite == 'pipeline':
+        results = run_pipeline(args)
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as file_json:
+                json.dump(results, file_json, indent=2)
+        return
+    lines = list(synthetic_lines(args.lines, args.urls, args.skew, args.malformed, args.seed))
+    if args.suite == 'ingestion':
+        run_ingestion(lines, args.repeat)
+    elif args.suite == 'plain':
+        run_plain_reader(lines, args.repeat)
+    else:
+        run_parser(lines, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,15 +4,31 @@ import sys
 import os
 import re
 import gzip
+import array
 import collections
-import operator
-import string
+import itertools
+import heapq
+import math
+import hashlib
+import queue
+import threading
+import zlib
+import mmap
+import time
 import logging
-import argparse
 import json
 import datetime
-import pathlib
-import shutil
+import contextlib
+import functools
+
+# argparse, calendar, concurrent.futures, cProfile, shutil and subprocess are imported by the functions
+# using them and numpy by 'load_numpy', so the module imported as a library loads only what parsing needs
+numpy = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # url regular expression pattern
 MASK_URL = r'(?<=GET\s)(/\S+)'
@@ -21,6 +37,93 @@ MASK_REQUEST_TIME = r'(?<=\ )\d+\.\d+?$'
 
 MASK_LOG = r'nginx-access-ui.log-(\d+)((\.gz\b)|(\.log\b))'
 
+# full 'ui_short' log line regular expression pattern
+MASK_LINE = (r'\S+ \S+ +\S+ \[(?P<time_local>[^\]]*)\] '
+             r'"(?P<method>[A-Z]+) (?P<url>\S+)[^"]*" '
+             r'(?P<status>\d{3}) (?P<bytes_sent>\d+|-) '
+             r'.* (?P<request_time>\d+\.\d+)\s*$')
+
+# URL path segments collapsed by the normalization
+MASK_URL_ID = r'(?<=/)\d+(?=/|$)'
+MASK_URL_HEX = r'(?<=/)[0-9a-fA-F]{8,}(?:-[0-9a-fA-F]{4,})*(?=/|$)'
+# aggregation key of the URLs spilled by the 'URL_MAX_DISTINCT' limit
+OTHER_URL = "other"
+
+# report of a day, the date is in the first group
+MASK_REPORT = r'report-(\d{4}\.\d{2}\.\d{2})\.html(?:\.gz)?$'
+
+LOG_NAME_PATTERN = re.compile(MASK_LOG)
+REPORT_NAME_PATTERN = re.compile(MASK_REPORT)
+LINE_PATTERN = re.compile(MASK_LINE)
+LINE_PATTERN_BYTES = re.compile(MASK_LINE.encode())
+# request methods of the aggregated lines, the other lines of the log format are skipped
+REQUEST_METHODS = ("GET",)
+# 'MASK_LINE' restricted to the request methods, compiled once per methods and type of the lines
+METHOD_LINE_PATTERNS = {}
+URL_ID_PATTERN = re.compile(MASK_URL_ID)
+URL_HEX_PATTERN = re.compile(MASK_URL_HEX)
+
+# size of the blocks read from a compressed log file
+GZIP_BLOCK_SIZE = 1 << 20
+# external decompressors used in the order of preference
+GZIP_COMMANDS = ("pigz", "gzip")
+# per-day aggregate snapshot saved next to the report
+MASK_SNAPSHOT = r'report-(\d{4}\.\d{2}\.\d{2})\.snapshot$'
+SNAPSHOT_VERSION = 5
+
+# name of the report rendered by the follow mode
+FOLLOW_REPORT_STEM = "report-live"
+# maximum number of bytes of the followed log parsed in one step, a longer line is skipped
+FOLLOW_READ_SIZE = 64 << 20
+
+# parsed pages of a memory-mapped log are released from the process after each window
+MMAP_RELEASE_SIZE = 8 << 20
+# an uncompressed log parsed by 'WORKERS' processes is split into this many chunks per process,
+# so the chunks not started yet can be cancelled when a chunk is rejected by the error parsing
+PARALLEL_CHUNKS_PER_WORKER = 4
+
+# format of the directory index cache 'INDEX_CACHE_PATH'
+INDEX_CACHE_VERSION = 1
+# cached directory listing is trusted only if the directory was modified this long before the scan (ns),
+# a change within the same mtime tick as the scan would be missed otherwise
+INDEX_MTIME_GRANULARITY = 2 * 10 ** 9
+
+# settings changing the aggregates of a log, part of the parse cache key
+PARSE_CACHE_CONFIG = ("PARSER", "REQUEST_METHODS", "CAPTURE_STATUS", "TIMELINE_BUCKET_SECONDS", "URL_NORMALIZE",
+                      "URL_REWRITE_RULES", "URL_MAX_DISTINCT", "STATS_BACKEND", "QUANTILE_BACKEND",
+                      "QUANTILE_EXACT_LIMIT", "QUANTILE_RELATIVE_ERROR")
+
+# (exact limit, relative error) of the quantile backend of a UrlAggregate, the "auto" defaults of 'quantile_limits'
+QUANTILE_LIMITS = (10000, 0.01)
+
+# number of parsed lines timed together by the 'parse' stage of the run metrics
+METRICS_BATCH_SIZE = 4096
+
+# groups of 'MASK_LINE' yielded by the parsers, added by 'CAPTURE_STATUS' and by 'TIMELINE_BUCKET_SECONDS'
+PARSED_FIELDS = ('url', 'request_time')
+PARSED_STATUS_FIELDS = ('status', 'bytes_sent')
+PARSED_TIME_FIELDS = ('time_local',)
+
+# latency histograms of the timeline: bin 0 - below TIMELINE_MIN_TIME, bin k - below TIMELINE_MIN_TIME * 2 ** (k / 2)
+TIMELINE_BINS = 32
+TIMELINE_MIN_TIME = 0.001
+# number of distinct '$time_local' values whose window and of request times whose histogram bin are cached
+TIMELINE_CACHE_SIZE = 200000
+# windows of the report timeline farther than it (seconds) from the median request are dropped as outliers
+TIMELINE_MAX_SPAN = 2 * 86400
+MONTHS = {month: index for index, month in enumerate(
+    ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec'), 1)}
+
+# exit code of a run with a log rejected by 'THRESHOLD_ERROR_PARS_PERCENT'
+EXIT_PARSE_ERRORS = 2
+# exit code of a run stopped by an invalid config or an error
+EXIT_ERROR = 1
+
+# parsed log line, fields in the order they are extracted from 'MASK_LINE'
+LogRecord = collections.namedtuple('LogRecord', 'url request_time status method bytes_sent time_local')
+# result of 'analyze': report rows, timeline of the first rows or None, 'stages' of RunMetrics
+AnalysisResult = collections.namedtuple('AnalysisResult', 'rows timeline stages')
+
 DEFAULT_CONFIG_PATH = os.path.dirname(__file__)
 
 DEFAULT_CONFIG_FILE_NAME = "default.cfg"
@@ -39,7 +142,59 @@ Usage: python %s [--config] [file]
    REPORT_DIR - report save directory
    LOG_DIR - directory storing logfiles 
    STATUS_LOGGING - status logging (ERROR, INFO, DEBUG)
-   THRESHOLD_ERROR_PARS_PERCENT - error parsing in %
+   THRESHOLD_ERROR_PARS_PERCENT - error parsing in %, checked while parsing over the last 'PARSE_CHECK_WINDOW' lines
+                                  once 'PARSE_CHECK_LINES' lines are read and for the whole log, a log above it
+                                  gets no report and the run exits with 'EXIT_PARSE_ERRORS'
+   PARSE_CHECK_LINES - number of the first lines of a log read before the error parsing is checked
+   PARSE_CHECK_WINDOW - number of the last lines the error parsing is computed over
+   QUARANTINE_LINES - number of the first unparsed lines of a rejected log saved to
+                      'REPORT_DIR'/<log name>.quarantine
+   PARSER - line parser engine: "compiled" - single pass of 'MASK_LINE',
+            "template" - search of 'MASK_URL' and 'MASK_REQUEST_TIME'
+   REQUEST_METHODS - request methods of the URLs aggregated by the "compiled" parser, the lines of the other
+                     methods are parsed but skipped, empty - every method
+   WORKERS - number of processes parsing an uncompressed log file
+   GZIP_READER - decompression of .gz logs for the "compiled" parser:
+                 "auto" - external pigz/gzip process or, if not found, a background zlib thread,
+                 "thread" - background zlib thread, "text" - gzip.open in the parsing thread
+   PLAIN_READER - reading of .log files for the "compiled" parser:
+                  "mmap" - the memory-mapped file is parsed without copying lines, "text" - text-mode file
+   PROCESS_ALL - process every log in 'LOG_DIR' without a report, not only the last one
+   PROCESS_RANGE - "FROM:TO" (YYYYMMDD, a bound may be omitted): process every log of the range without a report
+   BATCH_WORKERS - number of processes handling the logs of 'PROCESS_ALL' / 'PROCESS_RANGE', one log per process
+   SNAPSHOT - save the per-URL aggregates of the day next to the report, always with 'ROLLUP'
+   ROLLUP - build "week" or "month" reports by merging the day snapshots, None - disabled
+   FOLLOW - tail the current log 'FOLLOW_LOG' and re-render the live report
+            every 'FOLLOW_INTERVAL' seconds or 'FOLLOW_LINES' new lines
+   FOLLOW_POLL - seconds to wait for new lines in the follow mode
+   FOLLOW_SAVE_INTERVAL - minimum seconds between the saves of the follow offset and aggregates, they are
+                          also saved on exit
+   URL_NORMALIZE - aggregate URLs without the query string, with numeric and hex path segments
+                   replaced by {id} and {hex} and with 'URL_REWRITE_RULES' applied
+   URL_REWRITE_RULES - list of [regular expression, replacement] applied to the normalized URL
+   URL_CACHE_SIZE - number of raw URLs whose normalized form is cached
+   URL_MAX_DISTINCT - maximum number of aggregated URLs, the rarest ones are spilled into "other",
+                      0 - unlimited
+   STATS_BACKEND - per-URL statistics: "python" - UrlAggregate accumulators, "numpy" - arrays of
+                   URL ids and request times reduced by groups, "python" is used if numpy is not installed
+   QUANTILE_BACKEND - median, p95 and p99 per URL: "exact" - all request times sorted once per URL,
+                      "sketch" - mergeable sketch with 'QUANTILE_RELATIVE_ERROR',
+                      "auto" - exact up to 'QUANTILE_EXACT_LIMIT' requests of the URL, then the sketch
+   METRICS_PATH - file written with the run metrics of the stages in the Prometheus textfile format,
+                  None - only the summary line in the script log
+   PROFILE_PATH - file the cProfile statistics of the run are dumped to, None - no profiling
+   CAPTURE_STATUS - also parse $status and $body_bytes_sent and add the per-URL columns count_4xx, count_5xx,
+                    error_rate (percent of 4xx and 5xx responses) and bytes_sum, only with the "compiled" parser
+   TIMELINE_BUCKET_SECONDS - seconds of the time windows of the per-URL latency histograms built from $time_local,
+                             0 - no timeline, only with the "compiled" parser
+   TIMELINE_TOP - number of the first report URLs drawn in the timeline of the report
+   REPORT_PRECISION - number of decimal digits of the times and percents in the report
+   REPORT_GZIP - write the report gzip-compressed as report-YYYY.MM.DD.html.gz
+   PARSE_CACHE_DIR - directory caching the per-URL aggregates of the parsed logs by the path, size and mtime
+                     of the log, None - no cache
+   PARSE_CACHE_MAX_BYTES - total size of the parse cache, the least recently used files are removed above it
+   INDEX_CACHE_PATH - file caching the dated logs of 'LOG_DIR' and reports of 'REPORT_DIR',
+                      a directory is listed again only when its mtime changes, None - no cache
 '''
 default_config = {
     "REPORT_SIZE": 1000,
@@ -47,57 +202,208 @@ default_config = {
     "LOG_DIR": "./log",
     "LOG_ANALYZER_PATH": None,
     "STATUS_LOGGING": "INFO",
-    "THRESHOLD_ERROR_PARS_PERCENT": 60
+    "THRESHOLD_ERROR_PARS_PERCENT": 60,
+    "PARSE_CHECK_LINES": 10000,
+    "PARSE_CHECK_WINDOW": 100000,
+    "QUARANTINE_LINES": 100,
+    "PARSER": "compiled",
+    "REQUEST_METHODS": ["GET"],
+    "WORKERS": 1,
+    "GZIP_READER": "auto",
+    "PLAIN_READER": "mmap",
+    "PROCESS_ALL": False,
+    "PROCESS_RANGE": None,
+    "BATCH_WORKERS": 1,
+    "SNAPSHOT": False,
+    "ROLLUP": None,
+    "FOLLOW": False,
+    "FOLLOW_LOG": "nginx-access-ui.log",
+    "FOLLOW_INTERVAL": 60,
+    "FOLLOW_LINES": 100000,
+    "FOLLOW_POLL": 1,
+    "FOLLOW_SAVE_INTERVAL": 300,
+    "QUANTILE_BACKEND": "auto",
+    "QUANTILE_EXACT_LIMIT": 10000,
+    "QUANTILE_RELATIVE_ERROR": 0.01,
+    "URL_NORMALIZE": False,
+    "URL_REWRITE_RULES": [],
+    "URL_CACHE_SIZE": 100000,
+    "URL_MAX_DISTINCT": 0,
+    "STATS_BACKEND": "python",
+    "METRICS_PATH": None,
+    "PROFILE_PATH": None,
+    "INDEX_CACHE_PATH": None,
+    "CAPTURE_STATUS": False,
+    "TIMELINE_BUCKET_SECONDS": 0,
+    "TIMELINE_TOP": 20,
+    "REPORT_PRECISION": 3,
+    "REPORT_GZIP": False,
+    "PARSE_CACHE_DIR": None,
+    "PARSE_CACHE_MAX_BYTES": 1 << 30
 }
 
 template_report = "./report.html"
+# placeholders of the report table and of the timeline in the template
+TABLE_PLACEHOLDER = "$table_json"
+TIMELINE_PLACEHOLDER = "$timeline_json"
+# number of report rows serialized in one write
+REPORT_WRITE_ROWS = 1000
+
 
+def file_date(file_name: str, pattern, date_format: str):
+    """
+    Date of a log or a report from its file name
+    :param file_name: name of the file
+    :param pattern: compiled pattern with the date in the first group
+    :param date_format: strptime format of the date
+    :return: date string 'YYYYMMDD' or None if the name does not match or the date is invalid
+    """
+    group_str_namefile = pattern.match(file_name)
+    if group_str_namefile is None:
+        return None
+    try:
+        date_typedate = datetime.datetime.strptime(group_str_namefile.group(1), date_format).date()
+    except ValueError:
+        return None
+    return date_typedate.strftime("%Y%m%d")
 
-def search_last_log(config: dict) -> str:
+
+def scan_dates(dir_path: str, pattern, date_format: str, known_files: dict) -> dict:
+    """
+    Lists a directory with os.scandir and dates the files matching 'pattern',
+    the names already in 'known_files' are not parsed again
+    :param dir_path: directory
+    :param pattern: compiled pattern with the date in the first group
+    :param date_format: strptime format of the date
+    :param known_files: dictionary {file name: date string} of the previous scan
+    :return: dictionary {file name: date string 'YYYYMMDD'}
+    """
+    files = {}
+    with os.scandir(dir_path) as entries:
+        for entry in entries:
+            name = entry.name
+            date_string = known_files.get(name)
+            if date_string is None:
+                date_string = file_date(name, pattern, date_format)
+            if date_string is not None:
+                files[name] = date_string
+    return files
+
+
+def load_index_cache(path_cache: str) -> dict:
+    """
+    :param path_cache: file of the directory index cache, None - no cache
+    :return: cached index {'logs': {...}, 'reports': {...}} or an empty one
+    """
+    if path_cache and os.path.exists(path_cache):
+        try:
+            with open(path_cache, encoding='utf-8') as file_cache:
+                index_cache = json.load(file_cache)
+            if index_cache.get("version") == INDEX_CACHE_VERSION:
+                return index_cache
+        except Exception:
+            logging.exception('Index cache %s is damaged, the directories are scanned again', path_cache)
+    return {"version": INDEX_CACHE_VERSION}
+
+
+def cached_dates(index_cache: dict, kind: str, dir_path: str, pattern, date_format: str) -> tuple:
+    """
+    Dated files of a directory from the index cache. The cached list is used while the directory
+    mtime is unchanged and older than the scan by 'INDEX_MTIME_GRANULARITY', otherwise the directory
+    is scanned again (only the new names are parsed)
+    :param index_cache: index loaded by 'load_index_cache', updated in place
+    :param kind: "logs" or "reports"
+    :param dir_path: directory
+    :param pattern: compiled pattern with the date in the first group
+    :param date_format: strptime format of the date
+    :return: (dictionary {file name: date string 'YYYYMMDD'}, True if the directory was scanned)
+    """
+    dir_path = os.path.abspath(dir_path)
+    try:
+        mtime_ns = os.stat(dir_path).st_mtime_ns
+    except FileNotFoundError:
+        index_cache.pop(kind, None)
+        return {}, False
+    cached = index_cache.get(kind)
+    if cached is not None and cached["path"] != dir_path:
+        cached = None
+    if (cached is not None and cached["mtime_ns"] == mtime_ns
+            and mtime_ns < cached["scanned_ns"] - INDEX_MTIME_GRANULARITY):
+        return cached["files"], False
+    scanned_ns = time.time_ns()
+    files = scan_dates(dir_path, pattern, date_format, cached["files"] if cached is not None else {})
+    index_cache[kind] = {"path": dir_path, "mtime_ns": mtime_ns, "scanned_ns": scanned_ns, "files": files}
+    return files, True
+
+
+def save_index_cache(path_cache: str, index_cache: dict):
+    """
+    Writes the directory index cache, the file is replaced atomically
+    :param path_cache: file of the directory index cache
+    :param index_cache: index
+    """
+    path_cache_tmp = path_cache + '.tmp'
+    try:
+        with open(path_cache_tmp, 'w', encoding='utf-8') as file_cache:
+            json.dump(index_cache, file_cache, separators=(',', ':'))
+        os.replace(path_cache_tmp, path_cache)
+    except OSError:
+        logging.exception('Failed to write the index cache %s', path_cache)
+
+
+def directory_index(config: dict) -> tuple:
+    """
+    Index of the log dates in 'LOG_DIR' and of the report dates in 'REPORT_DIR',
+    kept in 'INDEX_CACHE_PATH' between runs
+    :param config: dictionary with the directories 'LOG_DIR', 'REPORT_DIR' and 'INDEX_CACHE_PATH'
+    :return: (dictionary {log file name: date string 'YYYYMMDD'}, set of the date strings with a report)
+    """
+    index_cache = load_index_cache(config["INDEX_CACHE_PATH"])
+    logs, logs_scanned = cached_dates(index_cache, "logs", config["LOG_DIR"], LOG_NAME_PATTERN, "%Y%m%d")
+    reports, reports_scanned = cached_dates(index_cache, "reports", config["REPORT_DIR"], REPORT_NAME_PATTERN,
+                                            "%Y.%m.%d")
+    if config["INDEX_CACHE_PATH"] and (logs_scanned or reports_scanned):
+        save_index_cache(config["INDEX_CACHE_PATH"], index_cache)
+    return logs, set(reports.values())
+
+
+def logs_by_date(logs: dict) -> dict:
+    """
+    :param logs: dictionary {log file name: date string}
+    :return: dictionary {date string: log file name}, of several logs of a date the first by name
+    """
+    dated_logs = {}
+    for name in sorted(logs):
+        dated_logs.setdefault(logs[name], name)
+    return dated_logs
+
+
+def search_last_log(config: dict, index: tuple = None) -> str:
     """
     search function for the last log file in the directory 'LOG_DIR'
     :param config -  dictionary  with the directory log file:
-    :return:  last_log  - filename last log file
-    """
-    res = []
-    list_files = os.listdir(os.path.join(config["LOG_DIR"]))
-    if list_files:
-        data_last_log = datetime.datetime.strptime('00010101', '%Y%m%d').date()
-        for file in list_files:
-            group_str_namefile = re.match(MASK_LOG, file)
-            if group_str_namefile:
-                try:
-                    data_log = datetime.datetime.strptime(group_str_namefile.group(1), '%Y%m%d').date()
-                except:
-                    continue
-                if data_last_log < data_log:
-                    data_last_log = data_log
-                    last_log = group_str_namefile.group(0)
-            else:
-                continue
-    else:
-        last_log = None
-    return last_log
+    :param index: 'directory_index' of the run, None - the directories are indexed
+    :return:  last_log  - filename last log file, None if there is no log
+    """
+    logs, _ = index or directory_index(config)
+    if not logs:
+        return None
+    dated_logs = logs_by_date(logs)
+    return dated_logs[max(dated_logs)]
 
 
-def report_processing_check(config: dict, last_log: str) -> bool:
+def report_processing_check(config: dict, last_log: str, index: tuple = None) -> bool:
     """
     Function processing check reporting the latest log
     :param config: dictionary  with the directory report file 'REPORT_DIR'
     :param last_log: name last log file
+    :param index: 'directory_index' of the run, None - the directories are indexed
     :return: True if the file exists in the directory or
     False if the file is not in the directory
     """
-    group_str_namefile = re.match(MASK_LOG, last_log)
-    date_string = group_str_namefile.group(1)
-    date_typedate = datetime.datetime.strptime(date_string, "%Y%m%d").date()
-    report_name = 'report-{0}.html'.format(datetime.datetime.strftime(date_typedate, "%Y.%m.%d"))
     if os.path.isdir(config["REPORT_DIR"]):
-        files_list = os.listdir(config["REPORT_DIR"])
-        if report_name in files_list:
-            return True
-        else:
-            return False
+        _, report_dates = index or directory_index(config)
+        return file_date(last_log, LOG_NAME_PATTERN, "%Y%m%d") in report_dates
     else:
         try:
             os.mkdir(config["REPORT_DIR"])
@@ -108,86 +414,1470 @@ def report_processing_check(config: dict, last_log: str) -> bool:
         return False
 
 
-def parsing_string(string_pars: str, template: list) -> list:
+def parsing_string(string_pars: str, template: list) -> list:
+    """
+    Function parsing string 'string' pattern list template
+    :param string: any string
+    :param template: template [template1, [template2],...[]],
+    where [template1], [template2], ... is a regular expression
+    :return: list of found strings
+    """
+    pars_list = []
+    for temp in template:
+        parsed_result = re.search(temp, string_pars)
+        if parsed_result is not None:
+            pars_list.append(parsed_result.group())
+        else:
+            if temp != MASK_REQUEST_TIME:
+                pars_list.append('')
+            else:
+                pars_list.append('0')
+    return pars_list
+
+
+def parsing_line(string_pars: str):
+    """
+    Function parsing a whole 'ui_short' log line in one pass of the compiled 'MASK_LINE'
+    :param string_pars: log line
+    :return: LogRecord(url, request_time, status, method, bytes_sent, time_local)
+             or None if the line does not match the log format
+    """
+    parsed_result = LINE_PATTERN.match(string_pars)
+    if parsed_result is None:
+        return None
+    return LogRecord._make(parsed_result.group(*LogRecord._fields))
+
+
+def line_pattern(methods: tuple = REQUEST_METHODS, binary: bool = False):
+    """
+    :param methods: request methods of the matched lines, empty - any method
+    :param binary: the pattern matches undecoded lines
+    :return: compiled 'MASK_LINE' matching only the lines of the request methods
+    """
+    if not methods:
+        return LINE_PATTERN_BYTES if binary else LINE_PATTERN
+    key = (tuple(methods), binary)
+    pattern = METHOD_LINE_PATTERNS.get(key)
+    if pattern is None:
+        mask_line = MASK_LINE.replace('(?P<method>[A-Z]+)',
+                                      '(?P<method>%s)' % '|'.join(re.escape(method) for method in methods))
+        pattern = re.compile(mask_line.encode() if binary else mask_line)
+        METHOD_LINE_PATTERNS[key] = pattern
+    return pattern
+
+
+def request_methods(config: dict) -> tuple:
+    """
+    :param config: dictionary with structure containing 'REQUEST_METHODS'
+    :return: request methods of the aggregated lines, empty - any method
+    """
+    return tuple(config["REQUEST_METHODS"] or ())
+
+
+def process_message(total_str: int, proccesed_str: int, permissible_error: int) -> str:
+    """
+    The function calculates the parsing error and, on the threshold, issues a message to the log
+    :param total_str: total number of parsing operations
+    :param proccesed_str: number of defined values
+    :param permissible_error: threshold error
+    :return: message string
+    """
+    err = 100 - 100 * proccesed_str / total_str if total_str else 0
+    if err < permissible_error:
+        msg = 'Process to parse log complete'
+    else:
+        msg = 'Unable to parse most of the log Error >%d%% ' \
+              'perhaps the logging format has changed' % permissible_error
+    return msg
+
+
+class ParseErrorLimit(Exception):
+    """
+    The share of the log lines not matching the log format reached 'THRESHOLD_ERROR_PARS_PERCENT',
+    'bad_lines' are the first of them
+    """
+
+    def __init__(self, message: str, bad_lines: list = ()):
+        super().__init__(message, list(bad_lines))
+        self.bad_lines = list(bad_lines)
+
+    def __str__(self):
+        return self.args[0]
+
+
+class ParseErrors:
+    """
+    Error parsing tracked while a log is parsed. The parsers report only the rejected lines with their
+    line numbers, so the matched lines cost nothing; the rejected lines among the last 'window' lines are checked
+    against the threshold on every rejected line once 'min_lines' lines are read, a log of another format is
+    abandoned after its first lines instead of after the whole file
+    """
+
+    def __init__(self, threshold: float, min_lines: int, window: int, sample_size: int):
+        self.threshold = threshold
+        self.min_lines = min_lines
+        self.window = max(window, 1)
+        self.sample_size = sample_size
+        # line numbers of the rejected lines within the window
+        self.rejected = collections.deque()
+        self.bad_lines = []
+
+    def reject(self, line_number: int, log_string):
+        """
+        Counts a line not matching the log format
+        :param line_number: number of the line from 1 in the parsed range
+        :param log_string: the line as str or bytes
+        :raise ParseErrorLimit: the error parsing of the window reached the threshold
+        """
+        rejected = self.rejected
+        rejected.append(line_number)
+        while rejected[0] <= line_number - self.window:
+            rejected.popleft()
+        if len(self.bad_lines) < self.sample_size:
+            if not isinstance(log_string, str):
+                log_string = bytes(log_string).decode('utf-8', 'replace')
+            self.bad_lines.append(log_string.rstrip('\n'))
+        if line_number >= self.min_lines:
+            window_lines = min(line_number, self.window)
+            if 100 * len(rejected) >= self.threshold * window_lines:
+                raise ParseErrorLimit('Unable to parse %d of the last %d lines (line %d) Error >%s%% '
+                                      'perhaps the logging format has changed'
+                                      % (len(rejected), window_lines, line_number, self.threshold), self.bad_lines)
+
+    def check_total(self, total_str: int, proccesed_str: int):
+        """
+        Checks the error parsing of the whole log, e.g. of a log shorter than 'min_lines'
+        :param total_str: total number of parsed lines
+        :param proccesed_str: number of matched lines
+        :raise ParseErrorLimit: the error parsing reached the threshold
+        """
+        if total_str and 100 * (total_str - proccesed_str) >= self.threshold * total_str:
+            raise ParseErrorLimit('Unable to parse %d of %d lines Error >%s%% perhaps the logging format has changed'
+                                  % (total_str - proccesed_str, total_str, self.threshold), self.bad_lines)
+
+    def merge(self, other):
+        """
+        Adds the bad lines of a chunk parsed in another process
+        :param other: ParseErrors
+        """
+        self.bad_lines.extend(other.bad_lines[:self.sample_size - len(self.bad_lines)])
+
+
+def parse_errors(config: dict) -> ParseErrors:
+    """
+    :param config: dictionary with structure containing 'THRESHOLD_ERROR_PARS_PERCENT', 'PARSE_CHECK_LINES',
+                   'PARSE_CHECK_WINDOW' and 'QUARANTINE_LINES'
+    :return: ParseErrors of one log
+    """
+    return ParseErrors(config["THRESHOLD_ERROR_PARS_PERCENT"], config["PARSE_CHECK_LINES"],
+                       config["PARSE_CHECK_WINDOW"], config["QUARANTINE_LINES"])
+
+
+def write_quarantine(config: dict, log_file_name: str, bad_lines: list) -> str:
+    """
+    Saves the unparsed lines of a rejected log for the diagnosis
+    :param config: dictionary with structure containing 'REPORT_DIR'
+    :param log_file_name: name of the log file
+    :param bad_lines: lines not matching the log format
+    :return: path of the quarantine file
+    """
+    os.makedirs(config["REPORT_DIR"], exist_ok=True)
+    path_quarantine = os.path.join(config["REPORT_DIR"], log_file_name + '.quarantine')
+    with open(path_quarantine, 'w', encoding='utf-8') as file_quarantine:
+        for log_string in bad_lines:
+            file_quarantine.write(log_string + '\n')
+    return path_quarantine
+
+
+def parsing_lines(config: dict, log_lines, counter: dict, errors: ParseErrors = None):
+    """
+    Function-generator parsing log lines with the line parser engine 'PARSER'.
+    With the "compiled" parser lines not matching the log format are counted but not yielded,
+    the lines of the other request methods than 'REQUEST_METHODS' are processed but not yielded
+    :param config: dictionary with structure containing the line parser engine 'PARSER', 'REQUEST_METHODS',
+                   'CAPTURE_STATUS' and 'TIMELINE_BUCKET_SECONDS'
+    :param log_lines: iterable of log lines
+    :param counter: dictionary updated with the number of 'total' and 'processed' lines
+    :param errors: ParseErrors receiving the rejected lines or None
+    :return: structure list [url:str, request_time:str] followed by the other 'parsed_fields'
+    """
+    total_str = 0
+    processed_str = 0
+    try:
+        if config["PARSER"] == "template":
+            for log_string in log_lines:
+                total_str += 1
+                parsed_list = parsing_string(log_string, [MASK_URL, MASK_REQUEST_TIME])
+                if parsed_list[0] != '':
+                    processed_str += 1
+                elif errors is not None:
+                    errors.reject(total_str, log_string)
+                yield parsed_list
+        else:
+            match_line = line_pattern(request_methods(config)).match
+            match_other = LINE_PATTERN.match
+            fields = parsed_fields(config)
+            for log_string in log_lines:
+                total_str += 1
+                parsed_result = match_line(log_string)
+                if parsed_result is not None:
+                    processed_str += 1
+                    yield parsed_result.group(*fields)
+                elif match_other(log_string) is not None:
+                    processed_str += 1
+                elif errors is not None:
+                    errors.reject(total_str, log_string)
+    finally:
+        counter["total"] = counter.get("total", 0) + total_str
+        counter["processed"] = counter.get("processed", 0) + processed_str
+
+
+def parsing_byte_lines(log_lines, counter: dict, fields: tuple = PARSED_FIELDS, errors: ParseErrors = None,
+                       methods: tuple = REQUEST_METHODS):
+    """
+    Function-generator parsing undecoded log lines with the compiled 'MASK_LINE',
+    only the URL and the request time of the matched lines are decoded
+    :param log_lines: iterable of log lines (bytes)
+    :param counter: dictionary updated with the number of 'total' and 'processed' lines
+    :param fields: groups yielded, 'PARSED_FIELDS' followed by the undecoded other groups
+    :param errors: ParseErrors receiving the rejected lines or None
+    :param methods: request methods of the yielded lines, empty - any method
+    :return: structure list [url:str, request_time:str, other fields:bytes]
+    """
+    total_str = 0
+    processed_str = 0
+    match_line = line_pattern(methods, True).match
+    match_other = LINE_PATTERN_BYTES.match
+    other_fields = len(fields) > len(PARSED_FIELDS)
+    try:
+        for log_string in log_lines:
+            total_str += 1
+            parsed_result = match_line(log_string)
+            if parsed_result is not None:
+                processed_str += 1
+                if other_fields:
+                    parsed_line = parsed_result.group(*fields)
+                    yield (parsed_line[0].decode('utf-8', 'replace'), parsed_line[1].decode('ascii')) + parsed_line[2:]
+                else:
+                    url, request_time = parsed_result.group(*PARSED_FIELDS)
+                    yield url.decode('utf-8', 'replace'), request_time.decode('ascii')
+            elif match_other(log_string) is not None:
+                processed_str += 1
+            elif errors is not None:
+                errors.reject(total_str, log_string)
+    finally:
+        counter["total"] = counter.get("total", 0) + total_str
+        counter["processed"] = counter.get("processed", 0) + processed_str
+
+
+def parsing_mmap_range(log_file_path: str, start: int, end: int, counter: dict, fields: tuple = PARSED_FIELDS,
+                       errors: ParseErrors = None, methods: tuple = REQUEST_METHODS):
+    """
+    Function-generator parsing a byte range of a memory-mapped uncompressed log:
+    the compiled 'MASK_LINE' is matched in place between the line feed offsets
+    and only the URL and the request time of the matched lines are decoded
+    :param log_file_path: path of the log file
+    :param start: offset of the first line
+    :param end: offset after the last line
+    :param counter: dictionary updated with the number of 'total' and 'processed' lines
+    :param fields: groups yielded, 'PARSED_FIELDS' followed by the undecoded other groups
+    :param errors: ParseErrors receiving the rejected lines or None
+    :param methods: request methods of the yielded lines, empty - any method
+    :return: structure list [url:str, request_time:str, other fields:bytes]
+    """
+    total_str = 0
+    processed_str = 0
+    other_fields = len(fields) > len(PARSED_FIELDS)
+    try:
+        if start >= end:
+            return
+        with open(log_file_path, 'rb') as log_file, \
+                mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ) as log_map:
+            find_line_end = log_map.find
+            match_line = line_pattern(methods, True).match
+            match_other = LINE_PATTERN_BYTES.match
+            can_release = hasattr(log_map, 'madvise') and hasattr(mmap, 'MADV_DONTNEED')
+            position = start
+            while position < end:
+                window_start = position - position % mmap.PAGESIZE
+                window_end = find_line_end(b'\n', min(position + MMAP_RELEASE_SIZE, end), end) + 1 or end
+                while position < window_end:
+                    line_end = find_line_end(b'\n', position, window_end)
+                    if line_end < 0:
+                        line_end = window_end
+                    total_str += 1
+                    parsed_result = match_line(log_map, position, line_end)
+                    if parsed_result is not None:
+                        processed_str += 1
+                        if other_fields:
+                            parsed_line = parsed_result.group(*fields)
+                            yield (parsed_line[0].decode('utf-8', 'replace'),
+                                   parsed_line[1].decode('ascii')) + parsed_line[2:]
+                        else:
+                            url, request_time = parsed_result.group(*PARSED_FIELDS)
+                            yield url.decode('utf-8', 'replace'), request_time.decode('ascii')
+                    elif match_other(log_map, position, line_end) is not None:
+                        processed_str += 1
+                    elif errors is not None:
+                        errors.reject(total_str, log_map[position:line_end])
+                    position = line_end + 1
+                if can_release:
+                    release_end = window_end - window_end % mmap.PAGESIZE
+                    log_map.madvise(mmap.MADV_DONTNEED, window_start, release_end - window_start)
+            parsed_result = None
+    finally:
+        counter["total"] = counter.get("total", 0) + total_str
+        counter["processed"] = counter.get("processed", 0) + processed_str
+
+
+def put_block(blocks_queue: queue.Queue, block, stop_event: threading.Event) -> bool:
+    """
+    Puts a block into the queue unless the consumer has stopped reading
+    :return: False if the consumer has stopped
+    """
+    while not stop_event.is_set():
+        try:
+            blocks_queue.put(block, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def decompress_gzip_file(log_file_path: str, blocks_queue: queue.Queue, stop_event: threading.Event):
+    """
+    Background thread: decompresses a (multi-member) gzip file with zlib in large blocks,
+    the end of the file is marked by None, an error is passed as the exception object
+    :param log_file_path: path of the log file
+    :param blocks_queue: queue of decompressed blocks
+    :param stop_event: set by the consumer to stop decompression
+    """
+    try:
+        with open(log_file_path, 'rb') as log_file:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            while True:
+                data = log_file.read(GZIP_BLOCK_SIZE)
+                if not data:
+                    break
+                block = decompressor.decompress(data)
+                while decompressor.eof and decompressor.unused_data:
+                    data = decompressor.unused_data
+                    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                    block += decompressor.decompress(data)
+                if block and not put_block(blocks_queue, block, stop_event):
+                    return
+            if not decompressor.eof:
+                raise EOFError("Compressed file %s ended before the end-of-stream marker" % log_file_path)
+    except Exception as er:
+        put_block(blocks_queue, er, stop_event)
+    put_block(blocks_queue, None, stop_event)
+
+
+def read_gzip_blocks_thread(log_file_path: str):
+    """
+    Function-generator read decompressed blocks produced by the background zlib thread
+    :param log_file_path: path of the log file
+    :return: decompressed blocks (bytes)
+    """
+    blocks_queue = queue.Queue(maxsize=8)
+    stop_event = threading.Event()
+    thread = threading.Thread(target=decompress_gzip_file, args=(log_file_path, blocks_queue, stop_event),
+                              daemon=True)
+    thread.start()
+    try:
+        while True:
+            block = blocks_queue.get()
+            if block is None:
+                break
+            if isinstance(block, Exception):
+                raise block
+            yield block
+    finally:
+        stop_event.set()
+        thread.join()
+
+
+def read_gzip_blocks_process(command: str, log_file_path: str):
+    """
+    Function-generator read blocks decompressed by an external process
+    :param command: path of pigz or gzip
+    :param log_file_path: path of the log file
+    :return: decompressed blocks (bytes)
+    """
+    import subprocess
+
+    process = subprocess.Popen([command, '-dc', log_file_path], stdout=subprocess.PIPE)
+    finished = False
+    try:
+        while True:
+            block = process.stdout.read(GZIP_BLOCK_SIZE)
+            if not block:
+                finished = True
+                break
+            yield block
+    finally:
+        if not finished:
+            process.kill()
+        process.stdout.close()
+        process.wait()
+    if process.returncode:
+        raise OSError("%s failed to decompress %s, exit code %d" % (command, log_file_path, process.returncode))
+
+
+def read_gzip_blocks(config: dict, log_file_path: str):
+    """
+    Selects the decompression of a gzip log according to 'GZIP_READER'
+    :param config: dictionary with structure containing 'GZIP_READER'
+    :param log_file_path: path of the log file
+    :return: generator of decompressed blocks (bytes)
+    """
+    import shutil
+
+    if config["GZIP_READER"] == "auto":
+        for command_name in GZIP_COMMANDS:
+            command = shutil.which(command_name)
+            if command:
+                return read_gzip_blocks_process(command, log_file_path)
+    return read_gzip_blocks_thread(log_file_path)
+
+
+def split_block_lines(blocks):
+    """
+    Function-generator splits blocks of bytes into lines without the line feed
+    :param blocks: iterable of blocks (bytes)
+    :return: lines (bytes)
+    """
+    tail = b''
+    for block in blocks:
+        lines = (tail + block).split(b'\n')
+        tail = lines.pop()
+        yield from lines
+    if tail:
+        yield tail
+
+
+def parsing_string_log(config: dict, log_file_name: str, counter: dict = None, errors: ParseErrors = None) -> list:
+    """
+    Function-generator read log string from file with filename 'log_file_name'.
+    With the "compiled" parser .gz logs are decompressed outside the parsing thread
+    and .log files are memory-mapped
+    :param config: dictionary with structure containing the directory log file 'LOG_DIR',
+                   the line parser engine 'PARSER' and the readers 'GZIP_READER', 'PLAIN_READER'
+    :param log_file_name: name processed log file
+    :param counter: dictionary updated with the number of 'total' and 'processed' lines
+    :param errors: ParseErrors receiving the rejected lines or None
+    :return: structure list [url:str, request_time:str]
+    """
+    log_file_path = os.path.join(config["LOG_DIR"], log_file_name)
+    counter = {} if counter is None else counter
+    compiled = config["PARSER"] != "template"
+    if log_file_name.endswith(".gz") and compiled and config["GZIP_READER"] != "text":
+        log_lines = split_block_lines(read_gzip_blocks(config, log_file_path))
+        yield from parsing_byte_lines(log_lines, counter, parsed_fields(config), errors, request_methods(config))
+    elif not log_file_name.endswith(".gz") and compiled and config["PLAIN_READER"] == "mmap":
+        yield from parsing_mmap_range(log_file_path, 0, os.path.getsize(log_file_path), counter,
+                                      parsed_fields(config), errors, request_methods(config))
+    else:
+        open_log = gzip.open if log_file_name.endswith(".gz") else open
+        with open_log(log_file_path, 'rt', encoding='utf-8') as log_file:
+            yield from parsing_lines(config, log_file, counter, errors)
+    logging.info(process_message(counter.get("total", 0), counter.get("processed", 0),
+                                 config["THRESHOLD_ERROR_PARS_PERCENT"]))
+
+
+def split_log_chunks(log_file_path: str, number_chunks: int) -> list:
+    """
+    Splits an uncompressed log file into byte ranges aligned to the beginning of lines
+    :param log_file_path: path of the log file
+    :param number_chunks: desired number of ranges
+    :return: list of ranges [(start, end), ...], empty ranges are omitted
+    """
+    size_file = os.path.getsize(log_file_path)
+    bounds = [0]
+    with open(log_file_path, 'rb') as log_file:
+        for index_chunk in range(1, number_chunks):
+            position = max(size_file * index_chunk // number_chunks, bounds[-1])
+            if position > 0:
+                log_file.seek(position - 1)
+                log_file.readline()
+            bounds.append(log_file.tell())
+    bounds.append(size_file)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if start < end]
+
+
+def read_chunk_lines(log_file_path: str, start: int, end: int):
+    """
+    Function-generator read log lines from the byte range of an uncompressed log file
+    :param log_file_path: path of the log file
+    :param start: offset of the first line
+    :param end: offset after the last line
+    :return: decoded log lines
+    """
+    with open(log_file_path, 'rb') as log_file:
+        log_file.seek(start)
+        position = start
+        for log_string in log_file:
+            if position >= end:
+                break
+            position += len(log_string)
+            yield log_string.decode('utf-8')
+
+
+def parsing_chunk(config: dict, log_file_path: str, start: int, end: int) -> tuple:
+    """
+    Process pool job: parses and aggregates one byte range of a log file
+    :param config: dictionary with structure containing 'PARSER' and 'PLAIN_READER'
+    :param log_file_path: path of the log file
+    :param start: offset of the first line
+    :param end: offset after the last line
+    :return: (dictionary 'url': UrlAggregate or ColumnarAggregate, total lines, processed lines,
+              UrlNormalizer or None, ParseErrors)
+    :raise ParseErrorLimit: the error parsing of the chunk reached 'THRESHOLD_ERROR_PARS_PERCENT'
+    """
+    counter = {}
+    errors = parse_errors(config)
+    if config["PARSER"] != "template" and config["PLAIN_READER"] == "mmap":
+        parsed_lines = parsing_mmap_range(log_file_path, start, end, counter, parsed_fields(config), errors,
+                                          request_methods(config))
+    else:
+        parsed_lines = parsing_lines(config, read_chunk_lines(log_file_path, start, end), counter, errors)
+    normalizer = url_normalizer(config)
+    if normalizer is not None:
+        parsed_lines = normalizer.normalize_urls(parsed_lines)
+    if stats_backend(config) == "numpy":
+        mas_aggr_url = aggregate_columnar(parsed_lines, config["URL_MAX_DISTINCT"])
+    else:
+        mas_aggr_url = dict(aggregate_url(parsed_lines, max_distinct=config["URL_MAX_DISTINCT"],
+                                          capture_status=status_capture(config),
+                                          timeline_seconds=timeline_seconds(config), limits=quantile_limits(config)))
+    return mas_aggr_url, counter["total"], counter["processed"], normalizer, errors
+
+
+def parsing_log_parallel(config: dict, log_file_name: str, normalizer=None, counter: dict = None,
+                         errors: ParseErrors = None) -> dict:
+    """
+    Parses an uncompressed log file split into 'PARALLEL_CHUNKS_PER_WORKER' chunks per process in 'WORKERS'
+    processes and merges the partial aggregates in the order of the chunks, so the result is identical
+    to the sequential 'aggregate_url'
+    :param config: dictionary with structure containing the directory log file 'LOG_DIR'
+                   and the number of processes 'WORKERS'
+    :param log_file_name: name processed log file
+    :param normalizer: UrlNormalizer collecting the distinct URLs counted in the chunks
+    :param counter: dictionary updated with the number of 'total' and 'processed' lines
+    :param errors: ParseErrors receiving the bad lines of the chunks or None
+    :return: dictionary with elements 'url': UrlAggregate or ColumnarAggregate
+    :raise ParseErrorLimit: the error parsing of a chunk reached 'THRESHOLD_ERROR_PARS_PERCENT',
+                            the chunks not started yet are cancelled
+    """
+    import concurrent.futures
+
+    log_file_path = os.path.join(config["LOG_DIR"], log_file_name)
+    chunks = split_log_chunks(log_file_path, config["WORKERS"] * PARALLEL_CHUNKS_PER_WORKER)
+    if stats_backend(config) == "numpy":
+        mas_aggr_url = ColumnarAggregate(config["URL_MAX_DISTINCT"])
+    else:
+        mas_aggr_url = new_url_aggregates(quantile_limits(config))
+    total_str = 0
+    processed_str = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=config["WORKERS"]) as executor:
+        futures = [executor.submit(parsing_chunk, config, log_file_path, start, end) for start, end in chunks]
+        for future in futures:
+            try:
+                chunk_aggr_url, chunk_total, chunk_processed, chunk_normalizer, chunk_errors = future.result()
+            except ParseErrorLimit:
+                for other_future in futures:
+                    other_future.cancel()
+                raise
+            if isinstance(mas_aggr_url, ColumnarAggregate):
+                mas_aggr_url.merge(chunk_aggr_url)
+            else:
+                merge_aggregates(mas_aggr_url, chunk_aggr_url)
+            if normalizer is not None:
+                normalizer.merge(chunk_normalizer)
+            if errors is not None:
+                errors.merge(chunk_errors)
+            total_str += chunk_total
+            processed_str += chunk_processed
+    if counter is not None:
+        counter["total"] = counter.get("total", 0) + total_str
+        counter["processed"] = counter.get("processed", 0) + processed_str
+    logging.info(process_message(total_str, processed_str, config["THRESHOLD_ERROR_PARS_PERCENT"]))
+    return mas_aggr_url
+
+
+def parsing_log(config: dict, log_file_name: str, counter: dict = None, errors: ParseErrors = None) -> list:
+    """
+    The function collects all parsed URLs into a list
+    :param config: dictionary with structure containing the directory log file 'LOG_DIR'
+    :param log_file_name: name processed log file
+    :param counter: dictionary updated with the number of 'total' and 'processed' lines
+    :param errors: ParseErrors receiving the rejected lines or None
+    :return: structure list [[url:str, request_time:str],[url:str, request_time:str],...]
+    """
+    parced_lines = parsing_string_log(config, log_file_name, counter, errors)
+    return parced_lines
+
+
+def sort_list_url(mass_url: list) -> dict:
+    """
+    Function of sorting the request time by the same URL
+    :param mass_url: list [ "url","time_request"]
+    :return: dictionary with elements 'url': [time_request1,time_request2,..]
+    """
+    mas_sort_url = collections.defaultdict(list)
+    for url, value_time in mass_url:
+        mas_sort_url[url].append(value_time)
+    return mas_sort_url
+
+
+def exact_quantiles(values, quantiles) -> list:
+    """
+    Exact quantiles as the values of rank int(quantile * n) of the values sorted once,
+    for quantile 0.5 it is the same value as 'median_time_request'
+    :param values: list or array of numeric values
+    :param quantiles: quantiles in [0, 1]
+    :return: list of the quantile values
+    """
+    sorted_values = sorted(values)
+    count_values = len(sorted_values)
+    return [sorted_values[min(int(quantile * count_values), count_values - 1)] for quantile in quantiles]
+
+
+def exact_quantile(values, quantile: float) -> float:
+    """
+    :param values: list or array of numeric values
+    :param quantile: quantile in [0, 1]
+    :return: exact quantile value of 'exact_quantiles'
+    """
+    return exact_quantiles(values, (quantile,))[0]
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with a relative error bound (DDSketch):
+    values are counted in logarithmic bins of ratio (1 + error) / (1 - error),
+    so any quantile is estimated within 'relative_error' of the exact value
+    """
+    __slots__ = ('relative_error', 'gamma', 'inv_log_gamma', 'count', 'zero_count', 'bins')
+
+    # values not greater than it are counted as zero
+    min_value = 1e-9
+
+    def __init__(self, relative_error: float):
+        self.relative_error = relative_error
+        self.gamma = (1 + relative_error) / (1 - relative_error)
+        self.inv_log_gamma = 1 / math.log(self.gamma)
+        self.count = 0
+        self.zero_count = 0
+        self.bins = {}
+
+    def add(self, value: float, weight: int = 1):
+        """
+        Adds a value 'weight' times
+        """
+        self.count += weight
+        if value <= self.min_value:
+            self.zero_count += weight
+        else:
+            index = math.ceil(math.log(value) * self.inv_log_gamma)
+            self.bins[index] = self.bins.get(index, 0) + weight
+
+    def bin_value(self, index: int) -> float:
+        """
+        :return: estimate of the values of the bin 'index'
+        """
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def merge(self, other: 'QuantileSketch'):
+        """
+        Adds the values of another sketch, sketches with another error are re-binned
+        """
+        self.zero_count += other.zero_count
+        self.count += other.zero_count
+        if other.gamma == self.gamma:
+            self.count += other.count - other.zero_count
+            for index, count_bin in other.bins.items():
+                self.bins[index] = self.bins.get(index, 0) + count_bin
+        else:
+            for index, count_bin in other.bins.items():
+                self.add(other.bin_value(index), count_bin)
+
+    def quantile(self, quantile: float) -> float:
+        """
+        Estimate of the value of rank int(quantile * n)
+        :param quantile: quantile in [0, 1]
+        :return: quantile value
+        """
+        rank = min(int(quantile * self.count), self.count - 1)
+        if rank < self.zero_count:
+            return 0.0
+        cumulative = self.zero_count
+        for index in sorted(self.bins):
+            cumulative += self.bins[index]
+            if cumulative > rank:
+                return self.bin_value(index)
+        return self.bin_value(max(self.bins))
+
+
+class UrlAggregate:
+    """
+    Streaming accumulator of the request time statistics for one URL:
+    number of requests, total and maximum request time and the quantile backend -
+    the compact array of request times while there are at most 'exact_limit' of them,
+    then a mergeable QuantileSketch with 'relative_error', the limit bounds the memory of the URL.
+    With 'CAPTURE_STATUS' also the numbers of 4xx and 5xx responses and the bytes sent,
+    with 'TIMELINE_BUCKET_SECONDS' the latency histograms of the time windows {window start: array}
+    """
+    __slots__ = ('count', 'time_sum', 'time_max', 'times', 'sketch', 'count_4xx', 'count_5xx', 'bytes_sum',
+                 'timeline', 'exact_limit', 'relative_error')
+
+    def __init__(self, limits: tuple = QUANTILE_LIMITS):
+        """
+        :param limits: (exact limit, relative error) of the quantile backend, see 'quantile_limits'
+        """
+        self.exact_limit, self.relative_error = limits
+        self.count = 0
+        self.time_sum = 0
+        self.time_max = 0
+        self.times = array.array('d')
+        self.sketch = None
+        self.count_4xx = 0
+        self.count_5xx = 0
+        self.bytes_sum = 0
+        self.timeline = None
+
+    def add(self, request_time: float):
+        """
+        Adds one request time to the accumulator
+        :param request_time: request time
+        """
+        self.count += 1
+        self.time_sum += request_time
+        if request_time > self.time_max:
+            self.time_max = request_time
+        if self.sketch is None:
+            self.times.append(request_time)
+            if self.count > self.exact_limit:
+                self.to_sketch()
+        else:
+            self.sketch.add(request_time)
+
+    def to_sketch(self):
+        """
+        Moves the request times into a QuantileSketch
+        """
+        self.sketch = QuantileSketch(self.relative_error)
+        for request_time in self.times:
+            self.sketch.add(request_time)
+        self.times = array.array('d')
+
+    def merge(self, other: 'UrlAggregate'):
+        """
+        Adds the statistics of another accumulator for the same URL,
+        while both keep the exact times the total is summed again from the times
+        to match the sequential aggregation
+        :param other: UrlAggregate with the following requests
+        """
+        self.count += other.count
+        self.count_4xx += other.count_4xx
+        self.count_5xx += other.count_5xx
+        self.bytes_sum += other.bytes_sum
+        if other.timeline:
+            if self.timeline is None:
+                self.timeline = {}
+            for bucket, other_histogram in other.timeline.items():
+                histogram = self.timeline.get(bucket)
+                if histogram is None:
+                    self.timeline[bucket] = array.array('I', other_histogram)
+                else:
+                    for index, value in enumerate(other_histogram):
+                        histogram[index] += value
+        if other.time_max > self.time_max:
+            self.time_max = other.time_max
+        if self.sketch is None and other.sketch is None and self.count <= self.exact_limit:
+            self.times.extend(other.times)
+            self.time_sum = sum(self.times)
+            return
+        self.time_sum += other.time_sum
+        if self.sketch is None:
+            self.to_sketch()
+        if other.sketch is None:
+            for request_time in other.times:
+                self.sketch.add(request_time)
+        else:
+            self.sketch.merge(other.sketch)
+
+    def quantile(self, quantile: float) -> float:
+        """
+        :param quantile: quantile in [0, 1]
+        :return: exact quantile of the request times or the sketch estimate
+        """
+        return self.quantiles((quantile,))[0]
+
+    def quantiles(self, quantiles) -> list:
+        """
+        :param quantiles: quantiles in [0, 1]
+        :return: exact quantiles of the request times sorted once or the sketch estimates
+        """
+        if self.sketch is None:
+            return exact_quantiles(self.times, quantiles)
+        return [min(self.sketch.quantile(quantile), self.time_max) for quantile in quantiles]
+
+    def median(self) -> float:
+        """
+        :return: median request time, for exact times the same value as 'median_time_request'
+        """
+        return self.quantile(0.5)
+
+
+def latency_bin(request_time: float) -> int:
+    """
+    :param request_time: request time
+    :return: bin of the timeline histogram, two bins per doubling of the time
+    """
+    if request_time < TIMELINE_MIN_TIME:
+        return 0
+    mantissa, exponent = math.frexp(request_time / TIMELINE_MIN_TIME)
+    return min(2 * exponent - (mantissa < 0.7071067811865476), TIMELINE_BINS - 1)
+
+
+def latency_bin_limit(index: int) -> float:
+    """
+    :param index: bin of the timeline histogram
+    :return: upper limit of the request times of the bin
+    """
+    return TIMELINE_MIN_TIME * 2 ** (index / 2)
+
+
+def histogram_quantile(histogram, quantile: float) -> float:
+    """
+    :param histogram: latency histogram of a time window
+    :param quantile: quantile in [0, 1]
+    :return: upper limit of the bin containing the quantile (rank int(quantile * n) as in 'exact_quantile')
+    """
+    rank = min(int(quantile * sum(histogram)), sum(histogram) - 1)
+    for index, count in enumerate(histogram):
+        rank -= count
+        if rank < 0:
+            return latency_bin_limit(index)
+    return 0.0
+
+
+class TimelineBuckets:
+    """
+    Start of the time window of '$time_local' ("29/Jun/2017:03:50:22 +0300") as epoch seconds,
+    the windows are aligned to the local midnight. The window of every seen value is cached in 'buckets',
+    so most lines cost one dictionary lookup, the new values of a seen minute only add its seconds
+    """
+
+    def __init__(self, bucket_seconds: int):
+        self.bucket_seconds = bucket_seconds
+        self.buckets = {}
+        self.minutes = {}
+
+    def bucket(self, time_local):
+        """
+        :param time_local: '$time_local' as str or bytes
+        :return: start of the time window or None if the time is not valid
+        """
+        bucket = self.buckets.get(time_local, False)
+        if bucket is False:
+            if len(self.buckets) >= TIMELINE_CACHE_SIZE:
+                self.buckets.clear()
+                self.minutes.clear()
+            bucket = self.buckets[time_local] = self.parse(time_local)
+        return bucket
+
+    def parse(self, time_local):
+        """
+        :param time_local: '$time_local' as str or bytes
+        :return: start of the time window or None if the time is not valid
+        """
+        import calendar
+
+        if isinstance(time_local, bytes):
+            time_local = time_local.decode('ascii', 'replace')
+        minute_key = time_local[:17] + time_local[20:]
+        try:
+            minute = self.minutes.get(minute_key)
+            if minute is None:
+                day, month, year = time_local[:11].split('/')
+                offset = time_local[21:]
+                offset_seconds = int(offset[1:3]) * 3600 + int(offset[3:5]) * 60
+                midnight = calendar.timegm((int(year), MONTHS[month], int(day), 0, 0, 0)) - (
+                    -offset_seconds if offset[0] == '-' else offset_seconds)
+                minute = self.minutes[minute_key] = (
+                    midnight, int(time_local[12:14]) * 3600 + int(time_local[15:17]) * 60)
+            midnight, seconds = minute
+            seconds += int(time_local[18:20])
+        except (ValueError, KeyError, IndexError):
+            return None
+        return midnight + seconds - seconds % self.bucket_seconds
+
+
+def quantile_limits(config: dict) -> tuple:
+    """
+    Quantile backend of the UrlAggregate of a run:
+    "exact" - always the exact times, "sketch" - always the QuantileSketch,
+    "auto" - exact times up to 'QUANTILE_EXACT_LIMIT' requests of the URL
+    :param config: dictionary with structure containing 'QUANTILE_BACKEND',
+                   'QUANTILE_EXACT_LIMIT' and 'QUANTILE_RELATIVE_ERROR'
+    :return: (exact limit, relative error) of 'UrlAggregate'
+    """
+    if config["QUANTILE_BACKEND"] == "exact":
+        exact_limit = float('inf')
+    elif config["QUANTILE_BACKEND"] == "sketch":
+        exact_limit = 0
+    else:
+        exact_limit = config["QUANTILE_EXACT_LIMIT"]
+    return exact_limit, config["QUANTILE_RELATIVE_ERROR"]
+
+
+def new_url_aggregates(limits: tuple = QUANTILE_LIMITS) -> dict:
+    """
+    :param limits: (exact limit, relative error) of the aggregates, see 'quantile_limits'
+    :return: empty defaultdict creating the UrlAggregate of a new URL with 'limits'
+    """
+    return collections.defaultdict(functools.partial(UrlAggregate, limits))
+
+
+def aggregate_url(mass_url, mas_aggr_url: dict = None, max_distinct: int = 0, capture_status: bool = False,
+                  timeline_seconds: int = 0, limits: tuple = QUANTILE_LIMITS) -> dict:
+    """
+    Function of streaming aggregation of the request time by the same URL,
+    no parsed line is kept; a URL keeps at most 'exact_limit' request times (8 bytes each)
+    before its aggregate switches to the sketch, so the memory grows with the number of
+    distinct URLs rather than the number of lines except with the "exact" quantile backend
+    :param mass_url: iterable of [ "url","time_request"], e.g. generator 'parsing_string_log'
+    :param mas_aggr_url: defaultdict of 'new_url_aggregates' updated in place, a new one if None
+    :param max_distinct: maximum number of URLs, when it is reached the rarest half
+                         is spilled into 'OTHER_URL', 0 - unlimited
+    :param capture_status: 'mass_url' is [ "url","time_request", status, bytes_sent, ...] with str or bytes
+                           status and bytes sent, the 4xx and 5xx responses and the bytes are counted
+    :param timeline_seconds: the last field of 'mass_url' is '$time_local', the request times are counted
+                             in the latency histograms of the time windows of 'timeline_seconds', 0 - no timeline
+    :param limits: quantile limits of the aggregates of a new 'mas_aggr_url', see 'quantile_limits'
+    :return: dictionary with elements 'url': UrlAggregate
+    """
+    if mas_aggr_url is None:
+        mas_aggr_url = new_url_aggregates(limits)
+    # class of the status (4 - client error, 5 - server error) by the status text
+    status_classes = {}
+    if capture_status and not timeline_seconds:
+        for url, value_time, status, bytes_sent in mass_url:
+            url_aggr = mas_aggr_url.get(url)
+            if url_aggr is None:
+                if max_distinct and len(mas_aggr_url) >= max_distinct:
+                    spill_rare_urls(mas_aggr_url, max_distinct // 2)
+                url_aggr = mas_aggr_url[url]
+            url_aggr.add(float(value_time))
+            status_class = status_classes.get(status)
+            if status_class is None:
+                status_class = status_classes[status] = int(status) // 100
+            if status_class == 4:
+                url_aggr.count_4xx += 1
+            elif status_class == 5:
+                url_aggr.count_5xx += 1
+            try:
+                url_aggr.bytes_sum += int(bytes_sent)
+            except ValueError:
+                pass
+        return mas_aggr_url
+    if capture_status or timeline_seconds:
+        # bin of the latency histogram by the request time text
+        latency_bins = {}
+        empty_histogram = bytes(4 * TIMELINE_BINS)
+        buckets = TimelineBuckets(timeline_seconds) if timeline_seconds else None
+        bucket_of = buckets.buckets.get if timeline_seconds else None
+        for parsed_line in mass_url:
+            url = parsed_line[0]
+            url_aggr = mas_aggr_url.get(url)
+            if url_aggr is None:
+                if max_distinct and len(mas_aggr_url) >= max_distinct:
+                    spill_rare_urls(mas_aggr_url, max_distinct // 2)
+                url_aggr = mas_aggr_url[url]
+            value_time = parsed_line[1]
+            url_aggr.add(float(value_time))
+            if bucket_of is not None:
+                time_local = parsed_line[-1]
+                bucket = bucket_of(time_local, False)
+                if bucket is False:
+                    bucket = buckets.bucket(time_local)
+                if bucket is not None:
+                    bin_index = latency_bins.get(value_time)
+                    if bin_index is None:
+                        if len(latency_bins) >= TIMELINE_CACHE_SIZE:
+                            latency_bins.clear()
+                        bin_index = latency_bins[value_time] = latency_bin(float(value_time))
+                    timeline = url_aggr.timeline
+                    if timeline is None:
+                        timeline = url_aggr.timeline = {}
+                    histogram = timeline.get(bucket)
+                    if histogram is None:
+                        histogram = timeline[bucket] = array.array('I', empty_histogram)
+                    histogram[bin_index] += 1
+            if not capture_status:
+                continue
+            status, bytes_sent = parsed_line[2], parsed_line[3]
+            status_class = status_classes.get(status)
+            if status_class is None:
+                status_class = status_classes[status] = int(status) // 100
+            if status_class == 4:
+                url_aggr.count_4xx += 1
+            elif status_class == 5:
+                url_aggr.count_5xx += 1
+            try:
+                url_aggr.bytes_sum += int(bytes_sent)
+            except ValueError:
+                pass
+        return mas_aggr_url
+    if not max_distinct:
+        for url, value_time in mass_url:
+            mas_aggr_url[url].add(float(value_time))
+        return mas_aggr_url
+    for url, value_time in mass_url:
+        url_aggr = mas_aggr_url.get(url)
+        if url_aggr is None:
+            if len(mas_aggr_url) >= max_distinct:
+                spill_rare_urls(mas_aggr_url, max_distinct // 2)
+            url_aggr = mas_aggr_url[url]
+        url_aggr.add(float(value_time))
+    return mas_aggr_url
+
+
+def spill_rare_urls(mas_aggr_url: dict, keep_count: int) -> dict:
+    """
+    Merges all URLs except the 'keep_count' ones with the most requests into 'OTHER_URL'
+    :param mas_aggr_url: defaultdict with elements 'url': UrlAggregate, changed in place
+    :param keep_count: number of URLs kept
+    :return: mas_aggr_url
+    """
+    other_aggr = mas_aggr_url.pop(OTHER_URL, None) or mas_aggr_url.default_factory()
+    kept_urls = set(heapq.nlargest(keep_count, mas_aggr_url, key=lambda url: mas_aggr_url[url].count))
+    for url in [url for url in mas_aggr_url if url not in kept_urls]:
+        other_aggr.merge(mas_aggr_url.pop(url))
+    mas_aggr_url[OTHER_URL] = other_aggr
+    return mas_aggr_url
+
+
+def limit_distinct_urls(mas_aggr_url: dict, max_distinct: int) -> dict:
+    """
+    Applies the 'URL_MAX_DISTINCT' limit to merged aggregates
+    :param mas_aggr_url: defaultdict with elements 'url': UrlAggregate, changed in place
+    :param max_distinct: maximum number of URLs, 0 - unlimited
+    :return: mas_aggr_url
+    """
+    if max_distinct and len(mas_aggr_url) > max_distinct:
+        spill_rare_urls(mas_aggr_url, max_distinct - 1)
+    return mas_aggr_url
+
+
+class CardinalityEstimator:
+    """
+    Mergeable estimator of the number of distinct strings (HyperLogLog, about 1.6% error)
+    """
+    __slots__ = ('registers',)
+
+    precision = 12
+
+    def __init__(self):
+        self.registers = bytearray(1 << self.precision)
+
+    def add(self, value: str):
+        """
+        Adds a string to the counted set
+        """
+        hash_value = int.from_bytes(hashlib.blake2b(value.encode('utf-8', 'replace'), digest_size=8).digest(), 'big')
+        rest_bits = 64 - self.precision
+        rest = hash_value & ((1 << rest_bits) - 1)
+        rank = rest_bits - rest.bit_length() + 1
+        index = hash_value >> rest_bits
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: 'CardinalityEstimator'):
+        """
+        Adds the set counted by another estimator
+        """
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def estimate(self) -> int:
+        """
+        :return: estimated number of distinct strings
+        """
+        size = len(self.registers)
+        raw_estimate = 0.7213 / (1 + 1.079 / size) * size * size / sum(2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if raw_estimate <= 2.5 * size and zeros:
+            return round(size * math.log(size / zeros))
+        return round(raw_estimate)
+
+
+class UrlNormalizer:
+    """
+    URL normalization before the aggregation: the query string is stripped,
+    numeric and hex path segments are replaced by {id} and {hex} and the rewrite rules
+    are applied. Normalized forms of the last 'cache_size' raw URLs are cached,
+    the numbers of distinct raw and normalized URLs are estimated
+    """
+
+    def __init__(self, rewrite_rules: list, cache_size: int):
+        self.rewrite_rules = [(re.compile(pattern), replacement) for pattern, replacement in rewrite_rules]
+        self.cache_size = cache_size
+        self.cache = {}
+        self.raw_urls = CardinalityEstimator()
+        self.normalized_urls = CardinalityEstimator()
+
+    def normalize(self, url: str) -> str:
+        """
+        :param url: raw URL
+        :return: normalized URL
+        """
+        normalized = self.cache.get(url)
+        if normalized is not None:
+            return normalized
+        normalized = url.split('?', 1)[0]
+        normalized = URL_ID_PATTERN.sub('{id}', normalized)
+        normalized = URL_HEX_PATTERN.sub('{hex}', normalized)
+        for pattern, replacement in self.rewrite_rules:
+            normalized = pattern.sub(replacement, normalized)
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[url] = normalized
+        self.raw_urls.add(url)
+        self.normalized_urls.add(normalized)
+        return normalized
+
+    def normalize_urls(self, mass_url):
+        """
+        Function-generator normalizing the URLs of the parsed lines
+        :param mass_url: iterable of [ "url","time_request"] or [ "url","time_request", status, bytes_sent]
+        :return: structure list [normalized url:str, request_time:str, ...]
+        """
+        normalize = self.normalize
+        for parsed_line in mass_url:
+            if len(parsed_line) == 2:
+                yield normalize(parsed_line[0]), parsed_line[1]
+            else:
+                yield (normalize(parsed_line[0]),) + tuple(parsed_line[1:])
+
+    def merge(self, other: 'UrlNormalizer'):
+        """
+        Adds the distinct URLs counted by another normalizer
+        """
+        self.raw_urls.merge(other.raw_urls)
+        self.normalized_urls.merge(other.normalized_urls)
+
+    def __getstate__(self):
+        return {"rewrite_rules": self.rewrite_rules, "cache_size": self.cache_size, "cache": {},
+                "raw_urls": self.raw_urls, "normalized_urls": self.normalized_urls}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+
+def url_normalizer(config: dict):
+    """
+    :param config: dictionary with structure containing 'URL_NORMALIZE', 'URL_REWRITE_RULES'
+                   and 'URL_CACHE_SIZE'
+    :return: UrlNormalizer or None if the normalization is disabled
+    """
+    if not config["URL_NORMALIZE"]:
+        return None
+    return UrlNormalizer(config["URL_REWRITE_RULES"], config["URL_CACHE_SIZE"])
+
+
+class ColumnarAggregate:
+    """
+    Request times of all lines in one array with the array of URL ids,
+    the statistics are computed by 'grouped_statistics' with numpy.
+    Every URL keeps its id, the 'max_distinct' limit is applied to the groups by 'spill_map'
+    """
+
+    def __init__(self, max_distinct: int = 0):
+        """
+        :param max_distinct: maximum number of URLs of the statistics, the rarest ones
+                             are counted as 'OTHER_URL', 0 - unlimited
+        """
+        load_numpy()
+        self.max_distinct = max_distinct
+        self.url_ids = {}
+        self.urls = []
+        self.ids = array.array('q')
+        self.times = array.array('d')
+
+    def new_url(self, url: str) -> int:
+        """
+        Registers a URL
+        :return: id of the URL
+        """
+        url_id = self.url_ids[url] = len(self.urls)
+        self.urls.append(url)
+        return url_id
+
+    def merge(self, other: 'ColumnarAggregate'):
+        """
+        Appends the lines of another aggregate, its URL ids are mapped to the ids of this one
+        """
+        id_map = numpy.array([self.url_ids[url] if url in self.url_ids else self.new_url(url)
+                              for url in other.urls], dtype=numpy.int64)
+        if len(other.ids):
+            self.ids.frombytes(id_map[numpy.frombuffer(other.ids, dtype=numpy.int64)].tobytes())
+        self.times.extend(other.times)
+
+    def __len__(self):
+        return len(self.urls)
+
+    def spill_map(self, group_ids, counts):
+        """
+        Same choice as 'limit_distinct_urls': over the 'max_distinct' limit all URLs except
+        the 'max_distinct' - 1 ones with the most requests are mapped to 'OTHER_URL',
+        the first URL wins among equal counts
+        :param group_ids: array of the URL ids of the groups ordered by id
+        :param counts: array of the numbers of lines of the groups
+        :return: array mapping every URL id to its id in the statistics or None under the limit
+        """
+        if not self.max_distinct or len(group_ids) <= self.max_distinct:
+            return None
+        other_id = self.url_ids[OTHER_URL] if OTHER_URL in self.url_ids else self.new_url(OTHER_URL)
+        ranked = group_ids != other_id
+        kept_ids = group_ids[ranked][numpy.argsort(-counts[ranked], kind='stable')[:self.max_distinct - 1]]
+        id_map = numpy.full(len(self.urls), other_id, dtype=numpy.int64)
+        id_map[kept_ids] = kept_ids
+        return id_map
+
+    def to_url_aggregates(self, limits: tuple = QUANTILE_LIMITS) -> dict:
+        """
+        :param limits: (exact limit, relative error) of the aggregates, see 'quantile_limits'
+        :return: dictionary with elements 'url': UrlAggregate, e.g. for the day snapshot
+        """
+        mas_aggr_url = new_url_aggregates(limits)
+        if not len(self.ids):
+            return mas_aggr_url
+        ids = numpy.frombuffer(self.ids, dtype=numpy.int64)
+        order = numpy.argsort(ids, kind='stable')
+        sorted_ids = ids[order]
+        starts = numpy.flatnonzero(numpy.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+        id_map = self.spill_map(sorted_ids[starts], numpy.diff(numpy.r_[starts, len(sorted_ids)]))
+        if id_map is not None:
+            ids = id_map[ids]
+            order = numpy.argsort(ids, kind='stable')
+            sorted_ids = ids[order]
+            starts = numpy.flatnonzero(numpy.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+        sorted_times = numpy.frombuffer(self.times, dtype=numpy.float64)[order]
+        for url_id, url_times in zip(sorted_ids[starts], numpy.split(sorted_times, starts[1:])):
+            url_aggr = mas_aggr_url[self.urls[url_id]]
+            url_aggr.count = len(url_times)
+            url_aggr.time_max = float(url_times.max())
+            url_aggr.times = array.array('d', url_times.tobytes())
+            url_aggr.time_sum = sum(url_aggr.times)
+            if url_aggr.count > url_aggr.exact_limit:
+                url_aggr.to_sketch()
+        return mas_aggr_url
+
+
+def aggregate_columnar(mass_url, max_distinct: int = 0) -> ColumnarAggregate:
+    """
+    Function of streaming collection of the URL ids and request times for the numpy backend
+    :param mass_url: iterable of [ "url","time_request"], e.g. generator 'parsing_string_log'
+    :param max_distinct: maximum number of URLs of the statistics, the rarest ones are counted
+                         as 'OTHER_URL' when the statistics are computed, 0 - unlimited
+    :return: ColumnarAggregate
+    """
+    columnar = ColumnarAggregate(max_distinct)
+    url_ids = columnar.url_ids
+    append_id = columnar.ids.append
+    append_time = columnar.times.append
+    for url, value_time in mass_url:
+        url_id = url_ids.get(url)
+        if url_id is None:
+            url_id = columnar.new_url(url)
+        append_id(url_id)
+        append_time(float(value_time))
+    return columnar
+
+
+def url_aggregates(mas_aggr_url, limits: tuple = QUANTILE_LIMITS) -> dict:
+    """
+    :param mas_aggr_url: dictionary with elements 'url': UrlAggregate or ColumnarAggregate
+    :param limits: (exact limit, relative error) of the aggregates made from a ColumnarAggregate
+    :return: dictionary with elements 'url': UrlAggregate
+    """
+    if isinstance(mas_aggr_url, ColumnarAggregate):
+        return mas_aggr_url.to_url_aggregates(limits)
+    return mas_aggr_url
+
+
+def load_numpy():
+    """
+    Imports numpy on the first use of the numpy backend
+    :return: numpy module or None if it is not installed
+    """
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            numpy = False
+    return numpy or None
+
+
+def stats_backend(config: dict) -> str:
+    """
+    :param config: dictionary with structure containing 'STATS_BACKEND', 'CAPTURE_STATUS' and 'TIMELINE_BUCKET_SECONDS'
+    :return: "numpy" if it is configured and installed without the status and the timeline, otherwise "python"
+    """
+    if config["STATS_BACKEND"] == "numpy":
+        if status_capture(config) or timeline_seconds(config):
+            logging.warning('CAPTURE_STATUS and TIMELINE_BUCKET_SECONDS are not supported by the "numpy" backend, '
+                            'the "python" one is used')
+        elif load_numpy() is not None:
+            return "numpy"
+        else:
+            logging.warning('numpy is not installed, the "python" statistics backend is used')
+    return "python"
+
+
+def status_capture(config: dict) -> bool:
+    """
+    :param config: dictionary with structure containing 'CAPTURE_STATUS' and 'PARSER'
+    :return: True if the status and the bytes sent are captured, only the "compiled" parser extracts them
+    """
+    return config["CAPTURE_STATUS"] and config["PARSER"] != "template"
+
+
+def timeline_seconds(config: dict) -> int:
+    """
+    :param config: dictionary with structure containing 'TIMELINE_BUCKET_SECONDS' and 'PARSER'
+    :return: seconds of the timeline windows, 0 - no timeline, only the "compiled" parser extracts the time
+    """
+    if config["PARSER"] == "template":
+        return 0
+    return config["TIMELINE_BUCKET_SECONDS"] or 0
+
+
+def line_fields(capture_status: bool, bucket_seconds: int) -> tuple:
     """
-    Function parsing string 'string' pattern list template
-    :param string: any string
-    :param template: template [template1, [template2],...[]],
-    where [template1], [template2], ... is a regular expression
-    :return: list of found strings
+    :param capture_status: the status and the bytes sent are captured
+    :param bucket_seconds: seconds of the timeline windows, 0 - no timeline
+    :return: groups of 'MASK_LINE' yielded by the parsers, the url and the request time first, the local time last
     """
-    pars_list = []
-    for temp in template:
-        parsed_result = re.search(temp, string_pars)
-        if parsed_result is not None:
-            pars_list.append(parsed_result.group())
-        else:
-            if temp != MASK_REQUEST_TIME:
-                pars_list.append('')
-            else:
-                pars_list.append('0')
-    return pars_list
+    fields = PARSED_FIELDS
+    if capture_status:
+        fields += PARSED_STATUS_FIELDS
+    if bucket_seconds:
+        fields += PARSED_TIME_FIELDS
+    return fields
 
 
-def process_message(total_str: int, proccesed_str: int, permissible_error: int) -> str:
+def parsed_fields(config: dict) -> tuple:
     """
-    The function calculates the parsing error and, on the threshold, issues a message to the log
-    :param total_str: total number of parsing operations
-    :param proccesed_str: number of defined values
-    :param permissible_error: threshold error
-    :return: message string
+    :param config: dictionary with structure containing 'CAPTURE_STATUS', 'TIMELINE_BUCKET_SECONDS' and 'PARSER'
+    :return: groups of 'MASK_LINE' yielded by the parsers
     """
-    err = 100 - 100 * proccesed_str / total_str
-    if err < permissible_error:
-        msg = 'Process to parse log complete'
-    else:
-        msg = 'Unable to parse most of the log Error > %d \% ' \
-              'perhaps the logging format has changed' % permissible_error
-    return msg
+    return line_fields(status_capture(config), timeline_seconds(config))
 
 
-def parsing_string_log(config: dict, log_file_name: str) -> list:
+def merge_aggregates(mas_aggr_url: dict, other_aggr_url: dict) -> dict:
     """
-    Function-generator read log string from file with filename 'log_file_name'
-    :param config: dictionary with structure containing the directory log file 'LOG_DIR'
-    :param log_file_name: name processed log file
-    :return: structure list [url:str, request_time:str]
+    Merges partial aggregates into 'mas_aggr_url', new URLs keep their order
+    :param mas_aggr_url: defaultdict with elements 'url': UrlAggregate
+    :param other_aggr_url: dictionary with elements 'url': UrlAggregate
+    :return: mas_aggr_url
     """
-    log_file_path = os.path.join(config["LOG_DIR"], log_file_name)
-    open_log = gzip.open if log_file_name.endswith(".gz") else open
-    with open_log(log_file_path, 'rt', encoding='utf-8') as log_file:
-        total_str = 0
-        processed_str = 0
-        for log_string in log_file:
-            total_str += 1
-            parsed_list = parsing_string(log_string, [MASK_URL, MASK_REQUEST_TIME])
-            if parsed_list[0] != '':
-                processed_str += 1
-            yield parsed_list
-    logging.info(process_message(total_str, processed_str, config["THRESHOLD_ERROR_PARS_PERCENT"]))
+    for url, url_aggr in other_aggr_url.items():
+        if url in mas_aggr_url:
+            mas_aggr_url[url].merge(url_aggr)
+        else:
+            mas_aggr_url[url] = url_aggr
+    return mas_aggr_url
 
 
-def parsing_log(config: dict, log_file_name: str) -> list:
+def aggregate_log(config: dict, log_file_name: str, metrics=None) -> dict:
     """
-    The function collects all parsed URLs into a list
-    :param config: dictionary with structure containing the directory log file 'LOG_DIR'
+    Parses and aggregates a log file, uncompressed logs are split
+    between 'WORKERS' processes when more than one is configured.
+    URLs are normalized and limited by the 'URL_*' settings before the aggregation.
+    With 'PARSE_CACHE_DIR' a log already aggregated with the same settings is loaded from the cache.
+    A log whose error parsing reaches 'THRESHOLD_ERROR_PARS_PERCENT' is abandoned as soon as it is detected
+    and its first unparsed lines are saved by 'write_quarantine' if 'REPORT_DIR' is set
+    :param config: dictionary with structure containing the directory log file 'LOG_DIR',
+                   the number of processes 'WORKERS', the 'URL_*' settings and 'STATS_BACKEND'
     :param log_file_name: name processed log file
-    :return: structure list [[url:str, request_time:str],[url:str, request_time:str],...]
+    :param metrics: RunMetrics receiving the 'parse', 'aggregate' and 'parse_cache' stages,
+                    the parallel parsing is measured as the 'parse' stage
+    :return: dictionary with elements 'url': UrlAggregate or ColumnarAggregate for the numpy backend
+    :raise ParseErrorLimit: the error parsing reached 'THRESHOLD_ERROR_PARS_PERCENT'
     """
-    parced_lines = parsing_string_log(config, log_file_name)
-    return parced_lines
+    metrics = RunMetrics() if metrics is None else metrics
+    log_file_path = os.path.join(config["LOG_DIR"], log_file_name)
+    if config["PARSE_CACHE_DIR"]:
+        with metrics.stage("parse_cache"):
+            mas_aggr_url = read_parse_cache(config, log_file_path)
+        if mas_aggr_url is not None:
+            logging.info('Aggregates of %s loaded from the parse cache', log_file_name)
+            metrics.count("parse_cache", "hits", 1)
+            metrics.count("aggregate", "distinct_urls", len(mas_aggr_url))
+            return mas_aggr_url
+    metrics.stage_metrics("parse")
+    counter = {}
+    errors = parse_errors(config)
+    normalizer = url_normalizer(config)
+    try:
+        if config["WORKERS"] > 1 and not log_file_name.endswith(".gz"):
+            with metrics.stage("parse"):
+                mas_aggr_url = parsing_log_parallel(config, log_file_name, normalizer, counter, errors)
+            with metrics.stage("aggregate"):
+                if not isinstance(mas_aggr_url, ColumnarAggregate):
+                    limit_distinct_urls(mas_aggr_url, config["URL_MAX_DISTINCT"])
+        else:
+            parsed_lines = parsing_log(config, log_file_name, counter, errors)
+            if normalizer is not None:
+                parsed_lines = normalizer.normalize_urls(parsed_lines)
+            parsed_lines = metrics.timed_batches("parse", parsed_lines)
+            with metrics.stage("aggregate"):
+                if stats_backend(config) == "numpy":
+                    mas_aggr_url = aggregate_columnar(parsed_lines, config["URL_MAX_DISTINCT"])
+                else:
+                    mas_aggr_url = aggregate_url(parsed_lines, max_distinct=config["URL_MAX_DISTINCT"],
+                                                 capture_status=status_capture(config),
+                                                 timeline_seconds=timeline_seconds(config),
+                                                 limits=quantile_limits(config))
+        errors.check_total(counter.get("total", 0), counter.get("processed", 0))
+    except ParseErrorLimit as er:
+        metrics.count("parse", "lines", counter.get("total", 0))
+        if config["REPORT_DIR"]:
+            path_quarantine = write_quarantine(config, log_file_name, er.bad_lines)
+            logging.error('Log %s abandoned: %s, unparsed lines saved to %s', log_file_name, er, path_quarantine)
+        else:
+            logging.error('Log %s abandoned: %s', log_file_name, er)
+        raise
+    metrics.count("parse", "lines", counter.get("total", 0))
+    metrics.count("parse", "parsed_lines", counter.get("processed", 0))
+    metrics.count("parse", "bytes", os.path.getsize(log_file_path))
+    metrics.count("aggregate", "distinct_urls", len(mas_aggr_url))
+    if config["PARSE_CACHE_DIR"]:
+        with metrics.stage("parse_cache"):
+            write_parse_cache(config, log_file_path, url_aggregates(mas_aggr_url, quantile_limits(config)))
+    if normalizer is not None:
+        logging.info('Distinct URLs: raw ~%d, normalized ~%d, aggregated %d', normalizer.raw_urls.estimate(),
+                     normalizer.normalized_urls.estimate(), len(mas_aggr_url))
+    return mas_aggr_url
 
 
-def sort_list_url(mass_url: list) -> dict:
+def url_aggregate(line_time, limits: tuple = QUANTILE_LIMITS) -> UrlAggregate:
     """
-    Function of sorting the request time by the same URL
-    :param mass_url: list [ "url","time_request"]
-    :return: dictionary with elements 'url': [time_request1,time_request2,..]
+    Converts the list of request times for a given URL to the accumulator
+    :param line_time: list of strings of numeric values or UrlAggregate
+    :param limits: (exact limit, relative error) of a new accumulator, see 'quantile_limits'
+    :return: UrlAggregate
     """
-    mas_sort_url = collections.defaultdict(list)
-    for url, value_time in mass_url:
-        mas_sort_url[url].append(value_time)
-    return mas_sort_url
+    if isinstance(line_time, UrlAggregate):
+        return line_time
+    url_aggr = UrlAggregate(limits)
+    for item in line_time:
+        url_aggr.add(float(item))
+    return url_aggr
 
 
 def count_list_item(list_item: list) -> int:
@@ -286,45 +1976,340 @@ def median_time_request(list_item: list) -> float:
     return list_item_float[len(list_item_float) // 2]
 
 
-def write_url_dict(url_str: str, line_time: list, total_count: int, total_time: float) -> dict:
+def write_url_dict(url_str: str, line_time, total_count: int, total_time: float,
+                   status_columns: bool = False) -> dict:
     """
     The function forms a string of of static parameters parameters for a given URL in the form of a dictionary
     :param url_str: name URL
-    :param line_time: list values time_request for a given URL
+    :param line_time: list values time_request or UrlAggregate for a given URL
     :param total_count: total number of requests
     :param total_time:  total time of requests
+    :param status_columns: add the numbers of 4xx and 5xx responses, their percent and the bytes sent
     :return: dictionary of of statistical parameters for a given URL
     """
-    count_r = len(line_time)
-    time_sum = time_sum_url(line_time)
+    url_aggr = url_aggregate(line_time)
+    count_r = url_aggr.count
+    time_sum = url_aggr.time_sum
+    time_med, time_p95, time_p99 = url_aggr.quantiles((0.5, 0.95, 0.99))
     url_dict_stat = {"count": count_r,
-                     "time_avg": time_average(line_time),
-                     "time_max": time_max(line_time),
+                     "time_avg": time_sum / count_r,
+                     "time_max": url_aggr.time_max,
                      "time_sum": time_sum,
                      "url": url_str,
-                     "time_med": median_time_request(line_time),
+                     "time_med": time_med,
+                     "time_p95": time_p95,
+                     "time_p99": time_p99,
                      "time_perc": value_percent(time_sum, total_time),
                      "count_perc": value_percent(count_r, total_count)}
+    if status_columns:
+        url_dict_stat["count_4xx"] = url_aggr.count_4xx
+        url_dict_stat["count_5xx"] = url_aggr.count_5xx
+        url_dict_stat["error_rate"] = value_percent(url_aggr.count_4xx + url_aggr.count_5xx, count_r)
+        url_dict_stat["bytes_sum"] = url_aggr.bytes_sum
     return url_dict_stat
 
 
-def create_result_mas(data_mas: dict) -> list:
+def create_result_mas(data_mas: dict, report_size: int = None, status_columns: bool = False,
+                      exact_total: bool = True) -> list:
     """
-    Create function sorted by "max_time" list of statistics data
-    :param data_mas : source dictionary of url and time request
+    Create function sorted by "max_time" list of statistics data.
+    With 'report_size' the URLs with the largest "time_sum" are selected by a heap first
+    and the statistics are computed only for them
+    :param data_mas : source dictionary of url and time request list or UrlAggregate, or ColumnarAggregate
+    :param report_size: number of URLs in the result, None - all URLs
+    :param status_columns: add the status and bytes columns of 'write_url_dict'
+    :param exact_total: sum the total time request by request as 'time_total_request',
+                        False - from the per-URL sums kept by the aggregates (one addition per URL)
     :return: list dictionary of url and request statistics
     """
-    total_count = count_total_request(data_mas)
-    total_time = time_total_request(data_mas)
+    if isinstance(data_mas, ColumnarAggregate):
+        return create_result_mas_numpy(data_mas, report_size)
+    data_aggr = {url: url_aggregate(line_time) for url, line_time in data_mas.items()}
+    total_count = sum(url_aggr.count for url_aggr in data_aggr.values())
+    if exact_total and all(url_aggr.sketch is None for url_aggr in data_aggr.values()):
+        # summed value by value in the same order as 'time_total_request'
+        total_time = sum(itertools.chain.from_iterable(url_aggr.times for url_aggr in data_aggr.values()))
+    else:
+        total_time = sum(url_aggr.time_sum for url_aggr in data_aggr.values())
+    if report_size is None:
+        top_urls = sorted(data_aggr.items(), key=lambda item: item[1].time_sum, reverse=True)
+    else:
+        # equivalent to the sorted list cut to 'report_size', the order of equal values is kept
+        top_urls = heapq.nlargest(report_size, data_aggr.items(), key=lambda item: item[1].time_sum)
+    return [write_url_dict(url, url_aggr, total_count, total_time, status_columns) for url, url_aggr in top_urls]
+
+
+def grouped_statistics(columnar: ColumnarAggregate) -> dict:
+    """
+    Computes the per-URL statistics in one pass over the lines sorted by URL id and request time:
+    counts from the group bounds, sums by numpy.add.reduceat, maximums and quantiles by
+    indexing the sorted groups (rank int(quantile * n) as in 'exact_quantile').
+    Over the 'max_distinct' limit of the aggregate the rarest groups by these counts are merged
+    into 'OTHER_URL' by 'ColumnarAggregate.spill_map' and the lines are grouped again
+    :param columnar: ColumnarAggregate
+    :return: dictionary of arrays indexed by group: 'url_id', 'count', 'time_sum', 'time_max',
+             'time_med', 'time_p95', 'time_p99'
+    """
+    ids = numpy.frombuffer(columnar.ids, dtype=numpy.int64)
+    times = numpy.frombuffer(columnar.times, dtype=numpy.float64)
+    order = numpy.lexsort((times, ids))
+    sorted_ids = ids[order]
+    starts = numpy.flatnonzero(numpy.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+    counts = numpy.diff(numpy.r_[starts, len(sorted_ids)])
+    id_map = columnar.spill_map(sorted_ids[starts], counts)
+    if id_map is not None:
+        ids = id_map[ids]
+        order = numpy.lexsort((times, ids))
+        sorted_ids = ids[order]
+        starts = numpy.flatnonzero(numpy.r_[True, sorted_ids[1:] != sorted_ids[:-1]])
+        counts = numpy.diff(numpy.r_[starts, len(sorted_ids)])
+    sorted_times = times[order]
+    statistics = {"url_id": sorted_ids[starts],
+                  "count": counts,
+                  "time_sum": numpy.add.reduceat(sorted_times, starts),
+                  "time_max": sorted_times[starts + counts - 1]}
+    for name, quantile in (("time_med", 0.5), ("time_p95", 0.95), ("time_p99", 0.99)):
+        ranks = numpy.minimum((quantile * counts).astype(numpy.int64), counts - 1)
+        statistics[name] = sorted_times[starts + ranks]
+    return statistics
+
+
+def create_result_mas_numpy(columnar: ColumnarAggregate, report_size: int = None) -> list:
+    """
+    numpy backend of 'create_result_mas', the rows are the same up to the float rounding of the sums
+    :param columnar: ColumnarAggregate
+    :param report_size: number of URLs in the result, None - all URLs
+    :return: list dictionary of url and request statistics sorted by "time_sum"
+    """
+    if not len(columnar.ids):
+        return []
+    statistics = grouped_statistics(columnar)
+    total_count = len(columnar.ids)
+    total_time = float(numpy.frombuffer(columnar.times, dtype=numpy.float64).sum())
+    # groups are ordered by URL id, i.e. by the first appearance, the stable sort keeps it for equal sums
+    top_groups = numpy.argsort(-statistics["time_sum"], kind='stable')[:report_size]
     result_mas = []
+    for group in top_groups.tolist():
+        count_r = int(statistics["count"][group])
+        time_sum = float(statistics["time_sum"][group])
+        result_mas.append({"count": count_r,
+                           "time_avg": time_sum / count_r,
+                           "time_max": float(statistics["time_max"][group]),
+                           "time_sum": time_sum,
+                           "url": columnar.urls[statistics["url_id"][group]],
+                           "time_med": float(statistics["time_med"][group]),
+                           "time_p95": float(statistics["time_p95"][group]),
+                           "time_p99": float(statistics["time_p99"][group]),
+                           "time_perc": value_percent(time_sum, total_time),
+                           "count_perc": value_percent(count_r, total_count)})
+    return result_mas
 
-    for item_mas in data_mas.keys():
-        result_mas.append(write_url_dict(item_mas, data_mas[item_mas], total_count, total_time))
-    result_mas_sort = sorted(result_mas, key=operator.itemgetter("time_sum"), reverse=True)
-    return result_mas_sort
+
+def log_date(log_file_name: str) -> datetime.date:
+    """
+    Date of the log from its file name
+    :param log_file_name: name of the log file matching 'MASK_LOG'
+    :return: date of the log
+    """
+    group_str_namefile = LOG_NAME_PATTERN.match(log_file_name)
+    return datetime.datetime.strptime(group_str_namefile.group(1), "%Y%m%d").date()
+
+
+def report_file_name(conf: dict, report_stem: str) -> str:
+    """
+    :param conf: dictionary with structure containing 'REPORT_GZIP'
+    :param report_stem: name of the report file without the extension
+    :return: '<report_stem>.html' or '<report_stem>.html.gz'
+    """
+    return report_stem + (".html.gz" if conf["REPORT_GZIP"] else ".html")
+
+
+def report_exists(conf: dict, report_stem: str) -> bool:
+    """
+    :param conf: dictionary with structure containing 'REPORT_DIR'
+    :param report_stem: name of the report file without the extension
+    :return: True if the report exists uncompressed or gzip-compressed
+    """
+    return any(os.path.exists(os.path.join(conf["REPORT_DIR"], report_stem + extension))
+               for extension in (".html", ".html.gz"))
+
+
+def load_template_parts() -> tuple:
+    """
+    Splits the report template 'template_report' at the '$table_json' placeholder,
+    the text after it at the optional '$timeline_json' placeholder
+    :return: (text before the table, text between the table and the timeline or None, text after the timeline)
+    """
+    with open(template_report, 'r', encoding='utf-8') as file_template_report:
+        template_text = file_template_report.read()
+    head, placeholder, tail = template_text.partition(TABLE_PLACEHOLDER)
+    if not placeholder:
+        raise ValueError("Template %s has no %s" % (template_report, TABLE_PLACEHOLDER))
+    middle, placeholder, tail = tail.partition(TIMELINE_PLACEHOLDER)
+    if not placeholder:
+        return head, None, middle
+    return head, middle, tail
+
+
+def json_values(values: list, precision: int) -> str:
+    """
+    Compact JSON of the report cells of a column without the brackets: numbers with a float among them
+    are written with 'precision' decimal digits, strings have '</' escaped so a URL can not close the report script
+    :param values: list of str or of int and float
+    :param precision: number of decimal digits
+    :return: JSON text of the comma-separated values
+    """
+    if values and isinstance(values[0], str):
+        return json.dumps(values, ensure_ascii=False, separators=(',', ':'))[1:-1].replace('</', '<\\/')
+    if any(isinstance(value, float) for value in values):
+        return ','.join(map(('%%.%df' % precision).__mod__, values))
+    return ','.join(map(str, values))
+
+
+def write_table_payload(file_report, rows: list, precision: int):
+    """
+    Writes the report rows as a columnar JSON object {"count": N, "columns": {"name": [values], ...}},
+    the values of a column are written in slices of 'REPORT_WRITE_ROWS' rows
+    :param file_report: text file
+    :param rows: list of statistics [{},{},..], all with the same keys
+    :param precision: number of decimal digits of the floats
+    """
+    file_report.write('{"count":%d,"columns":{' % len(rows))
+    for index_column, column in enumerate(rows[0] if rows else ()):
+        file_report.write('%s%s:[' % (',' if index_column else '', json.dumps(column)))
+        for start in range(0, len(rows), REPORT_WRITE_ROWS):
+            if start:
+                file_report.write(',')
+            file_report.write(json_values([row[column] for row in rows[start:start + REPORT_WRITE_ROWS]],
+                                          precision))
+        file_report.write(']')
+    file_report.write('}}')
+
+
+def report_timeline(conf: dict, mas_aggr_url, result_mas_sort: list):
+    """
+    Timeline of the first 'TIMELINE_TOP' report URLs as the list of their non-empty time windows.
+    Windows farther than 'TIMELINE_MAX_SPAN' from the window of the median request are dropped,
+    so a '$time_local' far outside the period of the log does not stretch the timeline
+    :param conf: dictionary with structure containing 'TIMELINE_BUCKET_SECONDS', 'TIMELINE_TOP' and 'PARSER'
+    :param mas_aggr_url: dictionary with elements 'url': UrlAggregate
+    :param result_mas_sort: sorted list of statistics [{},{},..]
+    :return: None without the timeline, otherwise {"bucket_seconds": seconds, "start": epoch seconds of the first
+             window, "end": of the last window, "urls": [url, ..], "windows": [[[window start, requests, p95], ..], ..],
+             "dropped": requests of the dropped windows}
+    """
+    bucket_seconds = timeline_seconds(conf)
+    if not bucket_seconds or isinstance(mas_aggr_url, ColumnarAggregate):
+        return None
+    timelines = []
+    for row in result_mas_sort[:conf["TIMELINE_TOP"]]:
+        url_aggr = mas_aggr_url.get(row["url"])
+        if url_aggr is not None and url_aggr.timeline:
+            timelines.append((row["url"], {bucket: sum(histogram) for bucket, histogram in url_aggr.timeline.items()},
+                              url_aggr.timeline))
+    if not timelines:
+        return None
+    requests_by_bucket = collections.Counter()
+    for url, counts, timeline in timelines:
+        requests_by_bucket.update(counts)
+    requests_half = sum(requests_by_bucket.values()) / 2
+    requests_before = 0
+    for median_bucket in sorted(requests_by_bucket):
+        requests_before += requests_by_bucket[median_bucket]
+        if requests_before >= requests_half:
+            break
+    first_bucket = median_bucket - TIMELINE_MAX_SPAN
+    last_bucket = median_bucket + TIMELINE_MAX_SPAN
+    payload = {"bucket_seconds": bucket_seconds, "start": None, "end": None, "urls": [], "windows": [], "dropped": 0}
+    for url, counts, timeline in timelines:
+        windows = []
+        for bucket in sorted(timeline):
+            if first_bucket <= bucket <= last_bucket:
+                windows.append([bucket, counts[bucket], histogram_quantile(timeline[bucket], 0.95)])
+            else:
+                payload["dropped"] += counts[bucket]
+        if windows:
+            payload["urls"].append(url)
+            payload["windows"].append(windows)
+    payload["start"] = min(windows[0][0] for windows in payload["windows"])
+    payload["end"] = max(windows[-1][0] for windows in payload["windows"])
+    if payload["dropped"]:
+        logging.warning('Timeline: %d requests more than %d s away from the median request time are not shown',
+                        payload["dropped"], TIMELINE_MAX_SPAN)
+    return payload
+
+
+def write_timeline_payload(file_report, timeline, precision: int):
+    """
+    Writes the timeline of 'report_timeline' as JSON, 'null' without the timeline
+    :param file_report: text file
+    :param timeline: dictionary of 'report_timeline' or None
+    :param precision: number of decimal digits of the p95 times
+    """
+    if timeline is None:
+        file_report.write('null')
+        return
+    file_report.write('{"bucket_seconds":%d,"start":%d,"end":%d,"urls":[%s],"windows":[%s],"dropped":%d}' % (
+        timeline["bucket_seconds"], timeline["start"], timeline["end"], json_values(timeline["urls"], precision),
+        ','.join('[%s]' % ','.join('[%d,%d,%.*f]' % (bucket, count, precision, p95) for bucket, count, p95 in windows)
+                 for windows in timeline["windows"]), timeline["dropped"]))
+
+
+def render_report(conf: dict, report_stem: str, result_mas_sort: list, timeline: dict = None):
+    """
+    The function of creating a report file in the form of a table.
+    The template parts, the columnar table and the timeline are streamed to a temporary file (gzip-compressed
+    with 'REPORT_GZIP') renamed to '<report_stem>.html' or '<report_stem>.html.gz'
+    :param conf: dictionary with structure containing
+                   the directory log file 'REPORT_DIR',
+                   report sample size 'REPORT_SIZE', 'REPORT_PRECISION' and 'REPORT_GZIP'
+    :param report_stem: name of the report file without the extension
+    :param result_mas_sort: sorted list of statistics [{},{},..]
+    :param timeline: timeline of the first URLs made by 'report_timeline', None - no timeline
+    :return:
+    """
+    import shutil
+
+    try:
+        head, middle, tail = load_template_parts()
+    except Exception as er:
+        logging.exception('Error load template report: %s', er)
+        return
+    report_name = report_file_name(conf, report_stem)
+    path_rep_file_tmp = os.path.join(conf['REPORT_DIR'], report_stem + '.tmp')
+    if conf["REPORT_GZIP"]:
+        file_report = gzip.open(path_rep_file_tmp, 'wt', encoding='utf-8', compresslevel=6)
+    else:
+        file_report = open(path_rep_file_tmp, 'w', encoding='utf-8')
+    try:
+        with file_report:
+            file_report.write(head)
+            write_table_payload(file_report, result_mas_sort[:conf["REPORT_SIZE"]], conf["REPORT_PRECISION"])
+            if middle is not None:
+                file_report.write(middle)
+                write_timeline_payload(file_report, timeline, conf["REPORT_PRECISION"])
+            file_report.write(tail)
+    except Exception as er:
+        # the previous report is kept
+        logging.exception('Error create report %s: %s', path_rep_file_tmp, er)
+        with contextlib.suppress(OSError):
+            os.remove(path_rep_file_tmp)
+        return
+    else:
+        new_name_rep_file = os.path.join(conf["REPORT_DIR"], report_name)
+        try:
+            os.replace(path_rep_file_tmp, new_name_rep_file)
+        except:
+            logging.exception("Report %s - failed to create", report_name)
+            return
+    logging.info("Create report file - %s ", report_name)
+    if not os.path.exists(os.path.join(conf["REPORT_DIR"], "jquery.tablesorter.min.js")):
+        if os.path.exists("jquery.tablesorter.min.js"):
+            shutil.copy(r"jquery.tablesorter.min.js",
+                        os.path.join(conf["REPORT_DIR"], "jquery.tablesorter.min.js"))
 
 
-def create_report(conf: dict, log_file_name: str, result_mas_sort: list):
+def create_report(conf: dict, log_file_name: str, result_mas_sort: list, timeline: dict = None):
     """
     The function of creating a report file in the form of a table
     :param conf: dictionary with structure containing 
@@ -333,40 +2318,702 @@ def create_report(conf: dict, log_file_name: str, result_mas_sort: list):
     :param log_file_name: name of the log file for which
                           the report is generated
     :param result_mas_sort: sorted list of statistics [{},{},..]
+    :param timeline: timeline of the first URLs made by 'report_timeline', None - no timeline
     :return: 
     """
-    with open(template_report, 'r', encoding='utf-8') as file_template_report:
-        try:
-            template_text = file_template_report.read()
-        except Exception as er:
-            logging.exception('Error load template report: %s', er)
-    if conf["REPORT_SIZE"] < len(result_mas_sort):
-        size_rep = conf["REPORT_SIZE"]
+    date_typedate = log_date(log_file_name)
+    report_stem = 'report-{0}'.format(datetime.datetime.strftime(date_typedate, "%Y.%m.%d"))
+    render_report(conf, report_stem, result_mas_sort, timeline)
+
+
+def snapshot_path(conf: dict, date_typedate: datetime.date) -> str:
+    """
+    Path of the aggregate snapshot of the day in the directory 'REPORT_DIR'
+    """
+    snapshot_name = 'report-{0}.snapshot'.format(datetime.datetime.strftime(date_typedate, "%Y.%m.%d"))
+    return os.path.join(conf["REPORT_DIR"], snapshot_name)
+
+
+def write_snapshot(path_snapshot: str, mas_aggr_url: dict):
+    """
+    Saves the per-URL aggregates gzip-compressed as a JSON header line followed by the raw bytes of
+    the array columns in the order of the header, so loading a snapshot never executes code.
+    The exact request times of all URLs are stored in one array, the histograms of the timelines in another,
+    the quantile sketches and the window starts of the timelines are in the header
+    :param path_snapshot: path of the snapshot file
+    :param mas_aggr_url: dictionary with elements 'url': UrlAggregate
+    """
+    columns = collections.OrderedDict((
+        ("count", array.array('q')),
+        ("time_sum", array.array('d')),
+        ("time_max", array.array('d')),
+        ("times_size", array.array('q')),
+        ("times", array.array('d')),
+        ("count_4xx", array.array('q')),
+        ("count_5xx", array.array('q')),
+        ("bytes_sum", array.array('q')),
+        ("timeline", array.array('I'))))
+    sketches = []
+    timelines = []
+    for url_aggr in mas_aggr_url.values():
+        columns["count"].append(url_aggr.count)
+        columns["time_sum"].append(url_aggr.time_sum)
+        columns["time_max"].append(url_aggr.time_max)
+        columns["times_size"].append(len(url_aggr.times))
+        columns["times"].extend(url_aggr.times)
+        columns["count_4xx"].append(url_aggr.count_4xx)
+        columns["count_5xx"].append(url_aggr.count_5xx)
+        columns["bytes_sum"].append(url_aggr.bytes_sum)
+        if url_aggr.timeline is None:
+            timelines.append(None)
+        else:
+            timelines.append(list(url_aggr.timeline))
+            for histogram in url_aggr.timeline.values():
+                columns["timeline"].extend(histogram)
+        if url_aggr.sketch is None:
+            sketches.append(None)
+        else:
+            sketch = url_aggr.sketch
+            sketches.append([sketch.relative_error, sketch.zero_count, sorted(sketch.bins.items())])
+    header = {"version": SNAPSHOT_VERSION,
+              "byteorder": sys.byteorder,
+              "url": list(mas_aggr_url.keys()),
+              "columns": [[name, column.typecode, column.itemsize, len(column)] for name, column in columns.items()],
+              "sketch": sketches,
+              "timeline_bins": TIMELINE_BINS,
+              "timeline": timelines}
+    path_snapshot_tmp = path_snapshot + '.tmp'
+    with gzip.open(path_snapshot_tmp, 'wb', compresslevel=1) as file_snapshot:
+        file_snapshot.write(json.dumps(header, separators=(',', ':')).encode('utf-8') + b'\n')
+        for column in columns.values():
+            file_snapshot.write(column.tobytes())
+    os.replace(path_snapshot_tmp, path_snapshot)
+
+
+def read_snapshot(path_snapshot: str, limits: tuple = QUANTILE_LIMITS) -> dict:
+    """
+    Loads the per-URL aggregates saved by 'write_snapshot'
+    :param path_snapshot: path of the snapshot file
+    :param limits: (exact limit, relative error) of the loaded aggregates, see 'quantile_limits'
+    :return: dictionary with elements 'url': UrlAggregate
+    :raise ValueError: the file is not a snapshot of 'SNAPSHOT_VERSION'
+    """
+    with gzip.open(path_snapshot, 'rb') as file_snapshot:
+        header_line = file_snapshot.readline()
+        if not header_line.startswith(b'{'):
+            raise ValueError("Unsupported snapshot format in %s" % path_snapshot)
+        header = json.loads(header_line.decode('utf-8'))
+        if header.get("version") != SNAPSHOT_VERSION or header.get("timeline_bins") != TIMELINE_BINS:
+            raise ValueError("Unsupported snapshot version %s in %s" % (header.get("version"), path_snapshot))
+        columns = {}
+        for name, typecode, itemsize, length in header["columns"]:
+            if typecode not in ('q', 'd', 'I') or array.array(typecode).itemsize != itemsize:
+                raise ValueError("Unsupported column %s of type %s in %s" % (name, typecode, path_snapshot))
+            data = file_snapshot.read(itemsize * length)
+            if len(data) != itemsize * length:
+                raise ValueError("Truncated column %s in %s" % (name, path_snapshot))
+            column = array.array(typecode)
+            column.frombytes(data)
+            if header["byteorder"] != sys.byteorder:
+                column.byteswap()
+            columns[name] = column
+    mas_aggr_url = new_url_aggregates(limits)
+    offset = 0
+    offset_timeline = 0
+    for index, url in enumerate(header["url"]):
+        url_aggr = UrlAggregate(limits)
+        url_aggr.count = columns["count"][index]
+        url_aggr.time_sum = columns["time_sum"][index]
+        url_aggr.time_max = columns["time_max"][index]
+        url_aggr.count_4xx = columns["count_4xx"][index]
+        url_aggr.count_5xx = columns["count_5xx"][index]
+        url_aggr.bytes_sum = columns["bytes_sum"][index]
+        if header["timeline"][index] is not None:
+            url_aggr.timeline = {}
+            for bucket in header["timeline"][index]:
+                url_aggr.timeline[bucket] = columns["timeline"][offset_timeline:offset_timeline + TIMELINE_BINS]
+                offset_timeline += TIMELINE_BINS
+        times_size = columns["times_size"][index]
+        url_aggr.times = columns["times"][offset:offset + times_size]
+        offset += times_size
+        if header["sketch"][index] is not None:
+            relative_error, zero_count, bins = header["sketch"][index]
+            url_aggr.sketch = QuantileSketch(relative_error)
+            url_aggr.sketch.zero_count = zero_count
+            url_aggr.sketch.bins = {bin_index: bin_count for bin_index, bin_count in bins}
+            url_aggr.sketch.count = zero_count + sum(url_aggr.sketch.bins.values())
+        mas_aggr_url[url] = url_aggr
+    return mas_aggr_url
+
+
+def parse_cache_path(config: dict, log_file_path: str) -> str:
+    """
+    Path of the cached aggregates of a log in 'PARSE_CACHE_DIR'. The name is a hash of the path, size
+    and mtime of the log and of the settings changing the aggregates, so a modified log or another
+    setting is a cache miss
+    :param config: dictionary with structure containing 'PARSE_CACHE_DIR' and the 'PARSE_CACHE_CONFIG' settings
+    :param log_file_path: path of the log file
+    :return: path of the cache file
+    """
+    stat_log = os.stat(log_file_path)
+    fingerprint = json.dumps([SNAPSHOT_VERSION, os.path.abspath(log_file_path), stat_log.st_size, stat_log.st_mtime_ns,
+                              [config[key] for key in PARSE_CACHE_CONFIG]])
+    cache_name = hashlib.blake2b(fingerprint.encode('utf-8'), digest_size=16).hexdigest() + '.snapshot'
+    return os.path.join(config["PARSE_CACHE_DIR"], cache_name)
+
+
+def read_parse_cache(config: dict, log_file_path: str):
+    """
+    Loads the cached aggregates of a log and marks them as recently used
+    :param config: dictionary with structure containing 'PARSE_CACHE_DIR'
+    :param log_file_path: path of the log file
+    :return: dictionary with elements 'url': UrlAggregate or None if the log is not cached
+    """
+    path_cache = parse_cache_path(config, log_file_path)
+    if not os.path.exists(path_cache):
+        return None
+    try:
+        mas_aggr_url = read_snapshot(path_cache, quantile_limits(config))
+    except Exception:
+        logging.exception('Parse cache %s is damaged, the log is parsed again', path_cache)
+        return None
+    os.utime(path_cache)
+    return mas_aggr_url
+
+
+def write_parse_cache(config: dict, log_file_path: str, mas_aggr_url: dict):
+    """
+    Saves the aggregates of a log in 'PARSE_CACHE_DIR' and evicts the least recently used
+    cache files above 'PARSE_CACHE_MAX_BYTES'
+    :param config: dictionary with structure containing 'PARSE_CACHE_DIR' and 'PARSE_CACHE_MAX_BYTES'
+    :param log_file_path: path of the log file
+    :param mas_aggr_url: dictionary with elements 'url': UrlAggregate
+    """
+    path_cache = parse_cache_path(config, log_file_path)
+    try:
+        os.makedirs(config["PARSE_CACHE_DIR"], exist_ok=True)
+        write_snapshot(path_cache, mas_aggr_url)
+        evict_parse_cache(config["PARSE_CACHE_DIR"], config["PARSE_CACHE_MAX_BYTES"], path_cache)
+    except OSError:
+        logging.exception('Failed to write the parse cache %s', path_cache)
+
+
+def evict_parse_cache(cache_dir: str, max_bytes: int, keep_path: str = None) -> list:
+    """
+    Removes the cache files used the longest time ago (by mtime) until their total size is within 'max_bytes'
+    :param cache_dir: directory of the cache files
+    :param max_bytes: maximum total size of the cache files
+    :param keep_path: cache file never removed, e.g. the one just written
+    :return: names of the removed files
+    """
+    with os.scandir(cache_dir) as entries:
+        cache_files = [(entry.stat().st_mtime_ns, entry.stat().st_size, entry.name) for entry in entries
+                       if entry.name.endswith('.snapshot') and entry.is_file()]
+    total_size = sum(size for _, size, _ in cache_files)
+    removed = []
+    for _, size, name in sorted(cache_files):
+        if total_size <= max_bytes:
+            break
+        path_cache = os.path.join(cache_dir, name)
+        if keep_path is not None and os.path.abspath(path_cache) == os.path.abspath(keep_path):
+            continue
+        os.remove(path_cache)
+        total_size -= size
+        removed.append(name)
+    if removed:
+        logging.info('Parse cache: %d least recently used files removed', len(removed))
+    return removed
+
+
+def search_unprocessed_logs(config: dict, index: tuple = None) -> list:
+    """
+    Search function for all log files in the directory 'LOG_DIR' without a report in 'REPORT_DIR'
+    dated within 'PROCESS_RANGE'
+    :param config: dictionary with the directories 'LOG_DIR' and 'REPORT_DIR' and 'PROCESS_RANGE'
+    :param index: 'directory_index' of the run, None - the directories are indexed
+    :return: log file names sorted by date, one file per date
+    """
+    date_from, date_to = date_range(config["PROCESS_RANGE"])
+    logs, report_dates = index or directory_index(config)
+    dated_logs = logs_by_date(logs)
+    return [dated_logs[date_string] for date_string in sorted(dated_logs)
+            if date_string not in report_dates and date_from <= date_string <= date_to]
+
+
+def rollup_period(date_typedate: datetime.date, rollup: str) -> str:
+    """
+    Name of the roll-up report containing the day
+    :param date_typedate: date of the day
+    :param rollup: "week" (weeks start on Monday) or "month"
+    :return: report name without the extension
+    """
+    if rollup == "week":
+        monday = date_typedate - datetime.timedelta(days=date_typedate.weekday())
+        return 'report-week-{0}'.format(datetime.datetime.strftime(monday, "%Y.%m.%d"))
+    if rollup == "month":
+        return 'report-month-{0}'.format(datetime.datetime.strftime(date_typedate, "%Y.%m"))
+    raise ValueError("Unknown roll-up period %s" % rollup)
+
+
+def create_rollup_reports(conf: dict, updated_dates=()) -> list:
+    """
+    Builds the roll-up reports by merging the day snapshots in 'REPORT_DIR' without reading raw logs.
+    A period is rendered if its report is missing or one of its days was processed in this run
+    :param conf: dictionary with structure containing 'REPORT_DIR', 'REPORT_SIZE' and 'ROLLUP'
+    :param updated_dates: dates of the days processed in this run
+    :return: names of the rendered reports without the extension
+    """
+    if not os.path.isdir(conf["REPORT_DIR"]):
+        return []
+    snapshots_by_period = collections.defaultdict(list)
+    for file in sorted(os.listdir(conf["REPORT_DIR"])):
+        group_str_namefile = re.match(MASK_SNAPSHOT, file)
+        if group_str_namefile:
+            date_typedate = datetime.datetime.strptime(group_str_namefile.group(1), "%Y.%m.%d").date()
+            snapshots_by_period[rollup_period(date_typedate, conf["ROLLUP"])].append(file)
+    updated_periods = {rollup_period(date_typedate, conf["ROLLUP"]) for date_typedate in updated_dates}
+    rendered = []
+    for report_stem, snapshot_files in sorted(snapshots_by_period.items()):
+        if report_exists(conf, report_stem) and report_stem not in updated_periods:
+            continue
+        mas_aggr_url = new_url_aggregates(quantile_limits(conf))
+        for file in snapshot_files:
+            merge_aggregates(mas_aggr_url, read_snapshot(os.path.join(conf["REPORT_DIR"], file), quantile_limits(conf)))
+        limit_distinct_urls(mas_aggr_url, conf["URL_MAX_DISTINCT"])
+        logging.info('Roll-up report %s from %d day snapshots', report_stem, len(snapshot_files))
+        result_mas = create_result_mas(mas_aggr_url, conf["REPORT_SIZE"], status_capture(conf))
+        render_report(conf, report_stem, result_mas, report_timeline(conf, mas_aggr_url, result_mas))
+        rendered.append(report_stem)
+    return rendered
+
+
+def process_log(config: dict, log_name: str, metrics=None):
+    """
+    Parses one log file, saves the day snapshot and creates its report
+    :param config: dict config
+    :param log_name: name of the log file in 'LOG_DIR'
+    :param metrics: RunMetrics receiving the 'parse', 'aggregate', 'stats' and 'render' stages
+    """
+    metrics = RunMetrics() if metrics is None else metrics
+    mass_passed_data_sort = aggregate_log(config, log_name, metrics)
+    with metrics.stage("stats"):
+        result_mas = create_result_mas(mass_passed_data_sort, config["REPORT_SIZE"], status_capture(config))
+        timeline = report_timeline(config, mass_passed_data_sort, result_mas)
+    with metrics.stage("render"):
+        if config["SNAPSHOT"] or config["ROLLUP"]:
+            write_snapshot(snapshot_path(config, log_date(log_name)),
+                           url_aggregates(mass_passed_data_sort, quantile_limits(config)))
+        create_report(config, log_name, result_mas, timeline)
+    metrics.count("render", "reports", 1)
+
+
+def process_log_job(config: dict, log_name: str) -> tuple:
+    """
+    Process pool job of the batch mode: processes one log file with a single parsing process
+    :param config: dict config
+    :param log_name: name of the log file in 'LOG_DIR'
+    :return: (log_name, stages of the RunMetrics of the job)
+    """
+    metrics = RunMetrics()
+    process_log(dict(config, WORKERS=1), log_name, metrics)
+    return log_name, metrics.stages
+
+
+def process_logs(config: dict, log_names: list, metrics=None) -> list:
+    """
+    Processes the log files one by one or, with 'BATCH_WORKERS' > 1, as jobs of a process pool.
+    The progress and the time of every file are logged, a failed file does not stop the others,
+    the logs rejected by the error parsing are counted as "rejected_logs" of the 'parse' stage
+    :param config: dict config
+    :param log_names: names of the log files in 'LOG_DIR'
+    :param metrics: RunMetrics receiving the stages of all files
+    :return: dates of the processed logs in the order of 'log_names'
+    """
+    import concurrent.futures
+
+    metrics = RunMetrics() if metrics is None else metrics
+    processed = set()
+    if config["BATCH_WORKERS"] > 1 and len(log_names) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=config["BATCH_WORKERS"], initializer=init_logging,
+                                                    initargs=(config,)) as executor:
+            started = time.perf_counter()
+            futures = {executor.submit(process_log_job, config, log_name): log_name for log_name in log_names}
+            for index, future in enumerate(concurrent.futures.as_completed(futures), 1):
+                log_name = futures[future]
+                try:
+                    _, job_stages = future.result()
+                except ParseErrorLimit:
+                    logging.error('[%d/%d] Raw log %s rejected by the error parsing', index, len(log_names), log_name)
+                    metrics.count("parse", "rejected_logs", 1)
+                    continue
+                except Exception:
+                    logging.exception('[%d/%d] Raw log %s failed', index, len(log_names), log_name)
+                    continue
+                metrics.merge(job_stages)
+                processed.add(log_name)
+                logging.info('[%d/%d] Raw log %s processed in %.2f s (%.1f s since the start)', index,
+                             len(log_names), log_name, sum(stage["wall_seconds"] for stage in job_stages.values()),
+                             time.perf_counter() - started)
     else:
-        size_rep = len(result_mas_sort)
-    report_text = string.Template(template_text)
-    report_text_file = report_text.safe_substitute(table_json=result_mas_sort[0:size_rep])
-    group_str_namefile = re.match(MASK_LOG, log_file_name)
-    date_string = group_str_namefile.group(1)
-    date_typedate = datetime.datetime.strptime(date_string, "%Y%m%d").date()
-    report_name_tmp = 'report-{0}.tmp'.format(datetime.datetime.strftime(date_typedate, "%Y.%m.%d"))
-    path_rep_file_tmp = os.path.join(conf['REPORT_DIR'], report_name_tmp)
-    with open(path_rep_file_tmp, 'w', encoding='utf-8') as file_report:
+        for index, log_name in enumerate(log_names, 1):
+            logging.info('[%d/%d] Raw log: %s', index, len(log_names), log_name)
+            started = time.perf_counter()
+            try:
+                process_log(config, log_name, metrics)
+            except ParseErrorLimit:
+                logging.error('[%d/%d] Raw log %s rejected by the error parsing', index, len(log_names), log_name)
+                metrics.count("parse", "rejected_logs", 1)
+                continue
+            except Exception:
+                logging.exception('[%d/%d] Raw log %s failed', index, len(log_names), log_name)
+                continue
+            processed.add(log_name)
+            logging.info('[%d/%d] Raw log %s processed in %.2f s', index, len(log_names), log_name,
+                         time.perf_counter() - started)
+    return [log_date(log_name) for log_name in log_names if log_name in processed]
+
+
+def date_range(process_range: str) -> tuple:
+    """
+    Parses the 'PROCESS_RANGE' of the log dates
+    :param process_range: "FROM:TO" with the dates as YYYYMMDD, an omitted bound is open, None - all dates
+    :return: (first date string, last date string) comparable with the dates of the log names
+    """
+    if not process_range:
+        return "00000000", "99999999"
+    date_from, separator, date_to = process_range.partition(':')
+    if not separator:
+        raise ValueError("Range %s is not FROM:TO" % process_range)
+    for date_string in (date_from, date_to):
+        if date_string:
+            datetime.datetime.strptime(date_string, "%Y%m%d")
+    return date_from or "00000000", date_to or "99999999"
+
+
+def cpu_time() -> float:
+    """
+    CPU time of the process and of its terminated child processes (the parsing workers)
+    :return: seconds
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def peak_memory() -> int:
+    """
+    Peak resident memory of the process or of its largest child process
+    :return: bytes, 0 if the platform has no 'resource' module
+    """
+    if resource is None:
+        return 0
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # ru_maxrss is in kilobytes everywhere except macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class RunMetrics:
+    """
+    Wall time, CPU time and counters of the pipeline stages of one run and the peak memory of the run
+    (the peak resident memory of a process is not reset between stages, so it is not reported per stage).
+    The time of a stage nested in another one is subtracted from the outer stage,
+    stages and counters repeated for several logs are summed
+    """
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.active = []
+        self.start_wall = time.perf_counter()
+
+    def stage_metrics(self, name: str) -> dict:
+        """
+        :param name: name of the stage
+        :return: dictionary of the stage metrics, created on the first use
+        """
+        if name not in self.stages:
+            self.stages[name] = {"wall_seconds": 0.0, "cpu_seconds": 0.0}
+        return self.stages[name]
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """
+        Context manager measuring the enclosed code as the stage 'name'
+        :param name: name of the stage
+        """
+        stage = self.stage_metrics(name)
+        nested = [0.0, 0.0]
+        self.active.append(nested)
+        start_wall = time.perf_counter()
+        start_cpu = cpu_time()
+        try:
+            yield stage
+        finally:
+            wall = time.perf_counter() - start_wall
+            cpu = cpu_time() - start_cpu
+            self.active.pop()
+            stage["wall_seconds"] += wall - nested[0]
+            stage["cpu_seconds"] += cpu - nested[1]
+            if self.active:
+                self.active[-1][0] += wall
+                self.active[-1][1] += cpu
+
+    def timed_batches(self, name: str, items):
+        """
+        Function-generator measuring the production of 'items' as the stage 'name',
+        items are pulled in batches of 'METRICS_BATCH_SIZE' so the timing does not slow down every line
+        :param name: name of the stage
+        :param items: iterable, e.g. parsed log lines
+        :return: items
+        """
+        iterator = iter(items)
+        while True:
+            with self.stage(name):
+                batch = list(itertools.islice(iterator, METRICS_BATCH_SIZE))
+            if not batch:
+                return
+            yield from batch
+
+    def merge(self, stages: dict):
+        """
+        Adds the stages measured in another process, e.g. a batch job
+        :param stages: 'stages' of another RunMetrics
+        """
+        for name, other_stage in stages.items():
+            stage = self.stage_metrics(name)
+            for key, value in other_stage.items():
+                stage[key] = stage.get(key, 0) + value
+
+    def count(self, name: str, key: str, value: int):
+        """
+        Adds 'value' to the counter 'key' of the stage 'name'
+        """
+        stage = self.stage_metrics(name)
+        stage[key] = stage.get(key, 0) + value
+
+    def summary(self) -> str:
+        """
+        :return: one-line JSON with the total wall time and the peak memory of the run and the metrics of every stage
+        """
+        return json.dumps({"wall_seconds": round(time.perf_counter() - self.start_wall, 6),
+                           "peak_memory_bytes": peak_memory(),
+                           "stages": {name: {key: round(value, 6) for key, value in stage.items()}
+                                      for name, stage in self.stages.items()}},
+                          separators=(',', ':'))
+
+    def write_prometheus(self, path_metrics: str):
+        """
+        Writes the metrics in the Prometheus textfile format, the file is replaced atomically
+        :param path_metrics: path of the metrics file, e.g. in the node_exporter textfile directory
+        """
+        keys = []
+        for stage in self.stages.values():
+            keys.extend(key for key in stage if key not in keys)
+        lines = ['# HELP log_analyzer_run_wall_seconds Wall time of the last run',
+                 '# TYPE log_analyzer_run_wall_seconds gauge',
+                 'log_analyzer_run_wall_seconds %.6f' % (time.perf_counter() - self.start_wall),
+                 '# HELP log_analyzer_run_peak_memory_bytes Peak resident memory of the last run',
+                 '# TYPE log_analyzer_run_peak_memory_bytes gauge',
+                 'log_analyzer_run_peak_memory_bytes %d' % peak_memory(),
+                 '# HELP log_analyzer_run_timestamp_seconds End time of the last run',
+                 '# TYPE log_analyzer_run_timestamp_seconds gauge',
+                 'log_analyzer_run_timestamp_seconds %.3f' % time.time()]
+        for key in keys:
+            metric = 'log_analyzer_stage_' + key
+            lines.append('# HELP %s Stage %s of the last run' % (metric, key.replace('_', ' ')))
+            lines.append('# TYPE %s gauge' % metric)
+            for name, stage in self.stages.items():
+                if key in stage:
+                    lines.append('%s{stage="%s"} %s' % (metric, name, stage[key]))
+        path_metrics_tmp = path_metrics + '.tmp'
+        with open(path_metrics_tmp, 'w', encoding='utf-8') as file_metrics:
+            file_metrics.write('\n'.join(lines) + '\n')
+        os.replace(path_metrics_tmp, path_metrics)
+
+
+def load_follow_state(conf: dict) -> tuple:
+    """
+    Loads the position in the followed log and the aggregates collected up to it
+    :param conf: dictionary with structure containing 'REPORT_DIR'
+    :return: (state {'inode': int, 'offset': int}, defaultdict with elements 'url': UrlAggregate)
+    """
+    path_state = os.path.join(conf["REPORT_DIR"], FOLLOW_REPORT_STEM + ".state")
+    path_snapshot = os.path.join(conf["REPORT_DIR"], FOLLOW_REPORT_STEM + ".snapshot")
+    if os.path.exists(path_state) and os.path.exists(path_snapshot):
         try:
-            file_report.write(report_text_file)
-        except Exception as er:
-            logging.exception('Error create report %s: %s', path_rep_file_tmp, er)
-    report_name = pathlib.Path(path_rep_file_tmp).stem + ".html"
-    new_name_rep_file = os.path.join(conf["REPORT_DIR"], report_name)
+            with open(path_state, encoding='utf-8') as file_state:
+                state = json.load(file_state)
+            return state, read_snapshot(path_snapshot, quantile_limits(conf))
+        except Exception:
+            logging.exception('Follow state %s is damaged, start from the beginning of the log', path_state)
+    return {"inode": None, "offset": 0}, new_url_aggregates(quantile_limits(conf))
+
+
+def save_follow_state(conf: dict, state: dict, mas_aggr_url: dict):
+    """
+    Saves the position in the followed log together with the aggregates collected up to it
+    :param conf: dictionary with structure containing 'REPORT_DIR'
+    :param state: {'inode': int, 'offset': int}
+    :param mas_aggr_url: dictionary with elements 'url': UrlAggregate
+    """
+    write_snapshot(os.path.join(conf["REPORT_DIR"], FOLLOW_REPORT_STEM + ".snapshot"), mas_aggr_url)
+    path_state = os.path.join(conf["REPORT_DIR"], FOLLOW_REPORT_STEM + ".state")
+    with open(path_state + '.tmp', 'w', encoding='utf-8') as file_state:
+        json.dump(state, file_state)
+    os.replace(path_state + '.tmp', path_state)
+
+
+def follow_read(log_file_path: str, state: dict, mas_aggr_url: dict, normalizer=None, max_distinct: int = 0,
+                capture_status: bool = False, bucket_seconds: int = 0, methods: tuple = REQUEST_METHODS) -> int:
+    """
+    Parses the complete lines appended to the followed log since 'state["offset"]'
+    into the aggregates. A new inode or a file shorter than the offset means
+    the log was rotated or truncated: the offset and the aggregates are reset.
+    A read of 'FOLLOW_READ_SIZE' bytes without a line end is skipped together
+    with the rest of its line, so an oversized line does not stop the offset
+    :param log_file_path: path of the followed log
+    :param state: {'inode': int, 'offset': int, 'skip_line': bool - the rest of the line at the offset
+                  is skipped}, updated in place
+    :param mas_aggr_url: defaultdict with elements 'url': UrlAggregate, updated in place
+    :param normalizer: UrlNormalizer or None
+    :param max_distinct: maximum number of URLs, 0 - unlimited
+    :param capture_status: count the status and the bytes sent
+    :param bucket_seconds: seconds of the timeline windows, 0 - no timeline
+    :param methods: request methods of the aggregated lines, empty - any method
+    :return: number of parsed lines
+    """
     try:
-        os.rename(path_rep_file_tmp, new_name_rep_file)
-    except:
-        logging.exception("Report %s - failed to create", report_name)
-    logging.info("Create report file - %s ", report_name)
-    if "jquery.tablesorter.min.js" not in os.listdir(conf["REPORT_DIR"]):
-        if "jquery.tablesorter.min.js" in os.listdir("./"):
-            shutil.copy(r"jquery.tablesorter.min.js",
-                        os.path.join(conf["REPORT_DIR"], "jquery.tablesorter.min.js"))
+        stat_log = os.stat(log_file_path)
+    except FileNotFoundError:
+        return 0
+    if stat_log.st_ino != state["inode"] or stat_log.st_size < state["offset"]:
+        if state["inode"] is not None:
+            logging.info('Log %s was rotated or truncated, start a new report', log_file_path)
+        state["inode"] = stat_log.st_ino
+        state["offset"] = 0
+        state.pop("skip_line", None)
+        mas_aggr_url.clear()
+    if stat_log.st_size == state["offset"]:
+        return 0
+    with open(log_file_path, 'rb') as log_file:
+        log_file.seek(state["offset"])
+        data = log_file.read(min(stat_log.st_size - state["offset"], FOLLOW_READ_SIZE))
+    if state.get("skip_line"):
+        size_skipped = data.find(b'\n') + 1
+        if size_skipped == 0:
+            state["offset"] += len(data)
+            return 0
+        state["offset"] += size_skipped
+        state["skip_line"] = False
+        data = data[size_skipped:]
+    size_lines = data.rfind(b'\n') + 1
+    if size_lines == 0:
+        if len(data) == FOLLOW_READ_SIZE:
+            logging.warning('Line of %s at offset %d is longer than %d bytes, skipped',
+                            log_file_path, state["offset"], FOLLOW_READ_SIZE)
+            state["offset"] += len(data)
+            state["skip_line"] = True
+        return 0
+    counter = {}
+    parsed_lines = parsing_byte_lines(data[:size_lines - 1].split(b'\n'), counter,
+                                      line_fields(capture_status, bucket_seconds), methods=methods)
+    if normalizer is not None:
+        parsed_lines = normalizer.normalize_urls(parsed_lines)
+    aggregate_url(parsed_lines, mas_aggr_url, max_distinct, capture_status, bucket_seconds)
+    state["offset"] += size_lines
+    return counter["total"]
+
+
+def follow_log(conf: dict, iterations: int = None):
+    """
+    Follow mode: tails the current log from the persisted offset and re-renders
+    the live report every 'FOLLOW_INTERVAL' seconds or 'FOLLOW_LINES' new lines,
+    each step parses only the bytes appended since the previous one and the report totals
+    are taken from the per-URL sums. The offset and the aggregates are saved at most every
+    'FOLLOW_SAVE_INTERVAL' seconds and on exit
+    :param conf: dictionary with structure containing 'LOG_DIR', 'REPORT_DIR', 'FOLLOW_LOG',
+                 'FOLLOW_INTERVAL', 'FOLLOW_LINES', 'FOLLOW_POLL' and 'FOLLOW_SAVE_INTERVAL'
+    :param iterations: number of polling steps, None - until interrupted
+    """
+    if not os.path.isdir(conf["REPORT_DIR"]):
+        os.makedirs(conf["REPORT_DIR"])
+    log_file_path = os.path.join(conf["LOG_DIR"], conf["FOLLOW_LOG"])
+    state, mas_aggr_url = load_follow_state(conf)
+    normalizer = url_normalizer(conf)
+    logging.info('Follow %s from offset %d', log_file_path, state["offset"])
+    lines_pending = 0
+    last_render = last_save = time.monotonic()
+    saved_state = dict(state)
+    try:
+        while iterations is None or iterations > 0:
+            if iterations is not None:
+                iterations -= 1
+            new_lines = follow_read(log_file_path, state, mas_aggr_url, normalizer, conf["URL_MAX_DISTINCT"],
+                                    status_capture(conf), timeline_seconds(conf), request_methods(conf))
+            lines_pending += new_lines
+            if lines_pending and (lines_pending >= conf["FOLLOW_LINES"] or
+                                  time.monotonic() - last_render >= conf["FOLLOW_INTERVAL"]):
+                result_mas = create_result_mas(mas_aggr_url, conf["REPORT_SIZE"], status_capture(conf),
+                                               exact_total=False)
+                render_report(conf, FOLLOW_REPORT_STEM, result_mas, report_timeline(conf, mas_aggr_url, result_mas))
+                lines_pending = 0
+                last_render = time.monotonic()
+                if last_render - last_save >= conf["FOLLOW_SAVE_INTERVAL"]:
+                    save_follow_state(conf, state, mas_aggr_url)
+                    saved_state = dict(state)
+                    last_save = last_render
+            if not new_lines and (iterations is None or iterations > 0):
+                time.sleep(conf["FOLLOW_POLL"])
+    finally:
+        if state != saved_state:
+            save_follow_state(conf, state, mas_aggr_url)
+
+
+def analyze(log_file_path: str, config: dict = None) -> AnalysisResult:
+    """
+    Library entry point: parses and aggregates one log file and computes its report rows without writing
+    a report or a snapshot; neither the command line nor the logging settings are used
+    :param log_file_path: path of a .gz or uncompressed log file, the name does not have to match 'MASK_LOG'
+    :param config: values replacing those of 'default_config', e.g. {"REPORT_SIZE": 100, "CAPTURE_STATUS": True}
+    :return: AnalysisResult(rows, timeline, stages): sorted statistics [{},{},..] of the first 'REPORT_SIZE' URLs,
+             'report_timeline' of the rows and the stage metrics of the call
+    :raise ParseErrorLimit: the error parsing reached 'THRESHOLD_ERROR_PARS_PERCENT', the unparsed lines
+                            are saved by 'write_quarantine' only if 'REPORT_DIR' is given in 'config'
+    """
+    config = dict(dict(default_config, REPORT_DIR=None), **(config or {}))
+    config["LOG_DIR"], log_file_name = os.path.split(os.path.abspath(log_file_path))
+    metrics = RunMetrics()
+    mas_aggr_url = aggregate_log(config, log_file_name, metrics)
+    with metrics.stage("stats"):
+        rows = create_result_mas(mas_aggr_url, config["REPORT_SIZE"], status_capture(config))
+        timeline = report_timeline(config, mas_aggr_url, rows)
+    return AnalysisResult(rows, timeline, metrics.stages)
+
+
+def iter_records(log_file_path: str, counter: dict = None):
+    """
+    Library function-generator of the parsed lines of a log file, lines not matching
+    the log format are counted and skipped
+    :param log_file_path: path of a .gz or uncompressed log file
+    :param counter: dictionary updated with the number of 'total' and 'processed' lines
+    :return: LogRecord(url, request_time, status, method, bytes_sent, time_local) of str
+    """
+    counter = {} if counter is None else counter
+    total_str = 0
+    processed_str = 0
+    match_line = LINE_PATTERN.match
+    make_record = LogRecord._make
+    open_log = gzip.open if log_file_path.endswith(".gz") else open
+    try:
+        with open_log(log_file_path, 'rt', encoding='utf-8', errors='replace') as log_file:
+            for log_string in log_file:
+                total_str += 1
+                parsed_result = match_line(log_string)
+                if parsed_result is not None:
+                    processed_str += 1
+                    yield make_record(parsed_result.group(*LogRecord._fields))
+    finally:
+        counter["total"] = counter.get("total", 0) + total_str
+        counter["processed"] = counter.get("processed", 0) + processed_str
 
 
 def init_logging(conf: dict):
@@ -385,57 +3032,169 @@ def init_logging(conf: dict):
         level=conf["STATUS_LOGGING"])
 
 
-def parser_name_config() -> str:
+def parser_command_line(argv: list = None) -> "argparse.Namespace":
     """
     Command line parsing procedure
-    :return: filename config
+    :param argv: command line arguments, None - sys.argv
+    :return: parsed arguments
     """
+    import argparse
+
+    def process_range(value: str) -> str:
+        try:
+            date_range(value)
+        except ValueError as error:
+            raise argparse.ArgumentTypeError(str(error))
+        return value
+
     parser = argparse.ArgumentParser(description='Log analizer')
     parser.add_argument('--config', type=str, help='Load config')
-    args = parser.parse_args()
-    return args.config
+    parser.add_argument('--workers', type=int, help='Number of processes parsing a log file')
+    parser.add_argument('--all', action='store_true', help='Process every log without a report')
+    parser.add_argument('--range', type=process_range, metavar='FROM:TO',
+                        help='Process every log without a report dated FROM:TO (YYYYMMDD, a bound may be omitted)')
+    parser.add_argument('--jobs', type=int, help='Number of processes handling the logs of --all / --range')
+    parser.add_argument('--rollup', choices=('week', 'month'), help='Build roll-up reports from day snapshots')
+    parser.add_argument('--follow', action='store_true', help='Tail the current log and update the live report')
+    parser.add_argument('--profile', nargs='?', const='log_analyzer.prof', metavar='PATH',
+                        help='Dump the cProfile statistics of the run (default log_analyzer.prof)')
+    return parser.parse_args(argv)
+
+
+def command_line_overrides(args) -> dict:
+    """
+    Config values given by the command line options
+    :param args: parsed arguments of 'parser_command_line'
+    :return: dict config
+    """
+    overrides = {}
+    if args.workers:
+        overrides["WORKERS"] = args.workers
+    if args.all:
+        overrides["PROCESS_ALL"] = True
+    if args.range:
+        overrides["PROCESS_RANGE"] = args.range
+    if args.jobs:
+        overrides["BATCH_WORKERS"] = args.jobs
+    if args.rollup:
+        overrides["ROLLUP"] = args.rollup
+    if args.follow:
+        overrides["FOLLOW"] = True
+    if args.profile:
+        overrides["PROFILE_PATH"] = args.profile
+    return overrides
 
 
 def configs_merger(conf: dict, default_conf_path=DEFAULT_CONFIG_PATH,
-                   default_conf_f_name=DEFAULT_CONFIG_FILE_NAME) -> dict:
+                   default_conf_f_name=DEFAULT_CONFIG_FILE_NAME, args=None) -> dict:
     """
     Config file upload function and merge with default config
+    and the command line options
     :param conf:
     :param default_conf_path: default config path
     :param default_conf_f_name: namefile default config
+    :param args: parsed arguments of 'parser_command_line', None - the default config file without options
     :return: dict config
     """
-    config_name = parser_name_config() if parser_name_config() else default_conf_f_name
+    config_name = args.config if args is not None and args.config else default_conf_f_name
     try:
-        with open(os.path.join(default_conf_path, config_name)) as id_file_config:
-            config_from_file = json.load(id_file_config, encoding="utf-8")
+        with open(os.path.join(default_conf_path, config_name), encoding="utf-8") as id_file_config:
+            config_from_file = json.load(id_file_config)
     except Exception as error_work_config:
         sys.exit(error_work_config)
     conf.update(config_from_file)
+    if args is not None:
+        conf.update(command_line_overrides(args))
     return conf
 
 
-def main(config):
-    config.update(configs_merger(config))
+def run_analyzer(config: dict) -> int:
+    """
+    Processes the logs selected by the config, the stage metrics of the run
+    are written to the script log and to 'METRICS_PATH'.
+    'LOG_DIR' and 'REPORT_DIR' are indexed once by 'directory_index' for the whole discovery
+    :param config: merged dict config
+    :return: exit code, 'EXIT_PARSE_ERRORS' if a log was rejected by the error parsing, otherwise 0
+    """
+    if config["FOLLOW"]:
+        follow_log(config)
+        return 0
+    metrics = RunMetrics()
+    processed_dates = []
+    if config["PROCESS_ALL"] or config["PROCESS_RANGE"]:
+        with metrics.stage("discover"):
+            index = directory_index(config)
+            log_names = search_unprocessed_logs(config, index)
+            if log_names:
+                report_processing_check(config, log_names[-1], index)
+        logging.info('Unprocessed logs found: %d', len(log_names))
+        processed_dates = process_logs(config, log_names, metrics)
+    else:
+        with metrics.stage("discover"):
+            index = directory_index(config)
+            log_name = search_last_log(config, index)
+            processed = log_name is not None and report_processing_check(config, log_name, index)
+        if log_name is None:
+            logging.info('No log found in %s', config["LOG_DIR"])
+        elif not processed:
+            logging.info('Last raw log found: %s', log_name)
+            try:
+                process_log(config, log_name, metrics)
+            except ParseErrorLimit:
+                metrics.count("parse", "rejected_logs", 1)
+            else:
+                processed_dates.append(log_date(log_name))
+        else:
+            logging.info('Last log has already been processed')
+    if config["ROLLUP"]:
+        with metrics.stage("rollup"):
+            metrics.count("rollup", "reports", len(create_rollup_reports(config, processed_dates)))
+    logging.info('Run summary %s', metrics.summary())
+    if config["METRICS_PATH"]:
+        try:
+            metrics.write_prometheus(config["METRICS_PATH"])
+        except OSError:
+            logging.exception('Failed to write the metrics file %s', config["METRICS_PATH"])
+    if metrics.stages.get("parse", {}).get("rejected_logs"):
+        return EXIT_PARSE_ERRORS
+    return 0
+
+
+def main(config, argv: list = None) -> int:
+    """
+    Command line entry point, the only reader of the command line
+    :param config: dict config updated with the config file and the options
+    :param argv: command line arguments, None - sys.argv
+    :return: exit code of 'run_analyzer', 'EXIT_ERROR' if the config is invalid
+    """
+    config.update(configs_merger(config, args=parser_command_line(argv)))
     init_logging(config)
     if not os.path.isdir(config["LOG_DIR"]):
         logging.error("Scripts aborted - The directory 'LOG_DIR' is incorrect")
         sys.exit()
+    try:
+        date_range(config["PROCESS_RANGE"])
+    except ValueError as error:
+        logging.error("Scripts aborted - 'PROCESS_RANGE' is incorrect: %s", error)
+        return EXIT_ERROR
     logging.info("Start. Load config %s", config)
-    log_name = search_last_log(config)
-    if not report_processing_check(config, log_name):
-        logging.info('Last raw log found: %s', log_name)
-        mass_passed_data = parsing_log(config, log_name)
-        mass_passed_data_sort = sort_list_url(mass_passed_data)
-        create_report(config, log_name, create_result_mas(mass_passed_data_sort))
-    else:
-        logging.info('Last log has already been processed')
+    if config["PROFILE_PATH"]:
+        import cProfile
+
+        profiler = cProfile.Profile()
+        try:
+            return profiler.runcall(run_analyzer, config)
+        finally:
+            profiler.dump_stats(config["PROFILE_PATH"])
+            logging.info('Profile of the run saved to %s', config["PROFILE_PATH"])
+    return run_analyzer(config)
 
 
 if __name__ == "__main__":
     try:
-        main(default_config)
+        sys.exit(main(default_config))
     except KeyboardInterrupt:
         logging.info('Script the script was interrupted by clicking Ctrl+C')
     except Exception as err:
         logging.exception(err)
+        sys.exit(EXIT_ERROR)
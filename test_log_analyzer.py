@@ -1,4 +1,13 @@
+import gzip
+import io
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
 import unittest
+import unittest.mock
 import log_analyzer
 
 MASK_URL = r'(?<=GET\s)(/\S+)'
@@ -15,10 +24,10 @@ test_dict5 = {'url1': ['1', '1', '1', '1', '1',],'url3': ['1', '1', '1', '1', '1
 
 test_dict_rep1 = {"count": 5, "time_avg": 1.0, "time_max": 1.0,
                  "time_sum": 5.0, "url": 'url1',
-                 "time_med": 1, "time_perc": 50.0, "count_perc": 50.0}
+                 "time_med": 1, "time_p95": 1.0, "time_p99": 1.0, "time_perc": 50.0, "count_perc": 50.0}
 test_dict_rep2 = {"count": 5, "time_avg": 1, "time_max": 1.0,
                  "time_sum": 5.0, "url": 'url3',
-                 "time_med": 1, "time_perc": 50.0, "count_perc": 50.0}
+                 "time_med": 1, "time_p95": 1.0, "time_p99": 1.0, "time_perc": 50.0, "count_perc": 50.0}
 
 test_dict_stat_urlt = [test_dict_rep1, test_dict_rep2]
 
@@ -27,6 +36,26 @@ test_list_url_time1 = [['url1', '1'],['url1', '1'],['url3', '1'],['url1', '1'],[
 test_list_url_time2 = [['url1', '1.1'],['url1', '2.2'],['url2', '1.1'],['url3', '5.5'],['url1', '3.3'],['url3', '4.4'],
                       ['url3', '3.3'],['url3', '2.2'],['url1', '4.4'],['url3', '1.1'],['url1', '5.5']]
 
+
+
+def write_test_log(log_dir: str, log_name: str, count_lines: int) -> str:
+    """
+    Writes a log file of 'count_lines' lines with random URLs and request times
+    """
+    rnd = random.Random(count_lines)
+    lines = []
+    for _ in range(count_lines):
+        if rnd.random() < 0.05:
+            lines.append(string3)
+        else:
+            lines.append(string2.replace('1769230', str(rnd.randint(0, 30))).replace(
+                '0.628', '%.3f' % rnd.random()))
+    log_path = os.path.join(log_dir, log_name)
+    with open(log_path, 'w', encoding='utf-8') as log_file:
+        log_file.write('\n'.join(lines) + '\n')
+    return log_path
+
+
 class MyTestCase(unittest.TestCase):
     def test_parsing_string(self):
         self.assertEqual(log_analyzer.parsing_string(string1,[MASK_URL,MASK_REQUEST_TIME]), [
@@ -38,6 +67,16 @@ class MyTestCase(unittest.TestCase):
         self.assertEqual(log_analyzer.parsing_string(string3, [MASK_URL, MASK_REQUEST_TIME]), [
             '', "0.628"],
                          False)
+    def test_parsing_line(self):
+        self.assertEqual(log_analyzer.parsing_line(string1), log_analyzer.LogRecord(
+            "/api/v2/group/7786679/statistic/sites/?date_type=day&date_from=2017-06-28&date_to=2017-06-28",
+            "0.067", "200", "GET", "22", "29/Jun/2017:03:50:22 +0300"))
+        self.assertEqual(log_analyzer.parsing_line(string2 + '\n').url, "/api/v2/group/1769230/banners")
+        self.assertEqual(log_analyzer.parsing_line(string2).request_time, "0.628")
+        self.assertIsNone(log_analyzer.parsing_line(string3))
+        self.assertEqual(log_analyzer.parsing_line(string1).request_time,
+                         log_analyzer.parsing_string(string1, [MASK_URL, MASK_REQUEST_TIME])[1])
+
     def test_value_percent(self):
         self.assertEqual(log_analyzer.value_percent(1,100), 1)
         self.assertEqual(log_analyzer.value_percent(1100.10, 10000), 11.001)
@@ -66,6 +105,620 @@ class MyTestCase(unittest.TestCase):
     def test_create_result_mas(self):
         self.assertEqual(log_analyzer.create_result_mas(test_dict5), test_dict_stat_urlt)
 
+    def test_aggregate_url(self):
+        aggregates = log_analyzer.aggregate_url(test_list_url_time2)
+        self.assertEqual(list(aggregates), list(test_dict2))
+        for url, line_time in test_dict2.items():
+            self.assertEqual(aggregates[url].count, len(line_time))
+            self.assertEqual(aggregates[url].time_sum, log_analyzer.time_sum_url(line_time))
+            self.assertEqual(aggregates[url].time_max, log_analyzer.time_max(line_time))
+            self.assertEqual(aggregates[url].median(), log_analyzer.median_time_request(line_time))
+
+    def test_create_result_mas_aggregate(self):
+        self.assertEqual(log_analyzer.create_result_mas(log_analyzer.aggregate_url(test_list_url_time2)),
+                         log_analyzer.create_result_mas(log_analyzer.sort_list_url(test_list_url_time2)))
+
+    def test_split_log_chunks(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = write_test_log(log_dir, 'nginx-access-ui.log-20170630.log', 1000)
+            chunks = log_analyzer.split_log_chunks(log_path, 7)
+            self.assertEqual(chunks[0][0], 0)
+            self.assertEqual(chunks[-1][1], os.path.getsize(log_path))
+            lines = []
+            for start, end in chunks:
+                lines.extend(log_analyzer.read_chunk_lines(log_path, start, end))
+            with open(log_path, encoding='utf-8') as log_file:
+                self.assertEqual(lines, log_file.readlines())
+
+    def test_parsing_log_parallel(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_name = 'nginx-access-ui.log-20170630.log'
+            write_test_log(log_dir, log_name, 5000)
+            config = dict(log_analyzer.default_config, LOG_DIR=log_dir)
+            sequential = log_analyzer.aggregate_log(config, log_name)
+            config["WORKERS"] = 3
+            with self.assertLogs(level='INFO') as logs:
+                parallel = log_analyzer.aggregate_log(config, log_name)
+            self.assertEqual(log_analyzer.create_result_mas(parallel), log_analyzer.create_result_mas(sequential))
+            self.assertIn('Process to parse log complete', logs.output[-1])
+
+    def test_parsing_string_log_gzip(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = write_test_log(log_dir, 'nginx-access-ui.log-20170630.log', 3000)
+            with open(log_path, 'rb') as log_file:
+                log_data = log_file.read()
+            log_name = 'nginx-access-ui.log-20170630.gz'
+            with open(os.path.join(log_dir, log_name), 'wb') as gz_file:
+                gz_file.write(gzip.compress(log_data[:len(log_data) // 2]))
+                gz_file.write(gzip.compress(log_data[len(log_data) // 2:]))
+            config = dict(log_analyzer.default_config, LOG_DIR=log_dir)
+            expected = list(log_analyzer.parsing_string_log(config, 'nginx-access-ui.log-20170630.log'))
+            for gzip_reader in ("auto", "thread", "text"):
+                config["GZIP_READER"] = gzip_reader
+                parsed = [tuple(item) for item in log_analyzer.parsing_string_log(config, log_name)]
+                self.assertEqual(parsed, expected, gzip_reader)
+
+    def test_read_gzip_blocks_truncated(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = os.path.join(log_dir, 'nginx-access-ui.log-20170630.gz')
+            with open(log_path, 'wb') as gz_file:
+                gz_file.write(gzip.compress((string1 + '\n').encode() * 1000)[:-20])
+            for gzip_reader in ("auto", "thread"):
+                config = dict(log_analyzer.default_config, GZIP_READER=gzip_reader)
+                with self.assertRaises((EOFError, OSError)):
+                    list(log_analyzer.read_gzip_blocks(config, log_path))
+
+    def test_parsing_string_log_mmap(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_name = 'nginx-access-ui.log-20170630.log'
+            log_path = write_test_log(log_dir, log_name, 3000)
+            with open(log_path, 'ab') as log_file:
+                log_file.write(string1.encode('utf-8'))
+            config = dict(log_analyzer.default_config, LOG_DIR=log_dir, PLAIN_READER="text")
+            expected = list(log_analyzer.parsing_string_log(config, log_name))
+            config["PLAIN_READER"] = "mmap"
+            with unittest.mock.patch.object(log_analyzer, 'MMAP_RELEASE_SIZE', 4096):
+                self.assertEqual(list(log_analyzer.parsing_string_log(config, log_name)), expected)
+            open(log_path, 'w').close()
+            counter = {}
+            self.assertEqual(list(log_analyzer.parsing_mmap_range(log_path, 0, 0, counter)), [])
+            self.assertEqual(counter, {"total": 0, "processed": 0})
+
+    def test_request_methods(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_name = 'nginx-access-ui.log-20170630.log'
+            string_post = string1.replace('"GET ', '"POST ')
+            with open(os.path.join(log_dir, log_name), 'w', encoding='utf-8') as log_file:
+                log_file.write('\n'.join([string1, string_post, string2, string_post]) + '\n')
+            template = dict(log_analyzer.default_config, LOG_DIR=log_dir, PARSER="template")
+            expected = [line for line in log_analyzer.parsing_string_log(template, log_name) if line[0]]
+            for reader in ("mmap", "text"):
+                config = dict(log_analyzer.default_config, LOG_DIR=log_dir, PLAIN_READER=reader)
+                counter = {}
+                self.assertEqual([list(line) for line in log_analyzer.parsing_string_log(config, log_name, counter)],
+                                 expected)
+                self.assertEqual(counter, {"total": 4, "processed": 4})
+                config["REQUEST_METHODS"] = []
+                self.assertEqual(len(list(log_analyzer.parsing_string_log(config, log_name))), 4)
+            post_lines = log_analyzer.parsing_byte_lines([string_post.encode()], {}, methods=("POST",))
+            self.assertEqual(next(post_lines)[1], "0.067")
+
+    def test_snapshot_roundtrip(self):
+        with tempfile.TemporaryDirectory() as report_dir:
+            aggregates = log_analyzer.aggregate_url(test_list_url_time2)
+            aggregates['url3'].to_sketch()
+            path_snapshot = os.path.join(report_dir, 'report-2017.06.30.snapshot')
+            log_analyzer.write_snapshot(path_snapshot, aggregates)
+            self.assertEqual(log_analyzer.create_result_mas(log_analyzer.read_snapshot(path_snapshot)),
+                             log_analyzer.create_result_mas(aggregates))
+            with gzip.open(path_snapshot, 'rb') as file_snapshot:
+                header = json.loads(file_snapshot.readline())
+            self.assertEqual(header["url"], list(aggregates))
+            with gzip.open(path_snapshot, 'wb') as file_snapshot:
+                file_snapshot.write(b'\x80\x04\x95\x00')
+            with self.assertRaises(ValueError):
+                log_analyzer.read_snapshot(path_snapshot)
+
+    def test_process_all_and_rollup(self):
+        with tempfile.TemporaryDirectory() as log_dir, tempfile.TemporaryDirectory() as report_dir:
+            for day, count_lines in (('20170626', 500), ('20170627', 700), ('20170703', 300)):
+                write_test_log(log_dir, 'nginx-access-ui.log-%s.log' % day, count_lines)
+            config = dict(log_analyzer.default_config, LOG_DIR=log_dir, REPORT_DIR=report_dir, ROLLUP="week",
+                          INDEX_CACHE_PATH=os.path.join(report_dir, '.log_index.json'))
+            log_names = log_analyzer.search_unprocessed_logs(config)
+            self.assertEqual(log_names, ['nginx-access-ui.log-20170626.log', 'nginx-access-ui.log-20170627.log',
+                                         'nginx-access-ui.log-20170703.log'])
+            for log_name in log_names[:2]:
+                log_analyzer.process_log(config, log_name)
+            self.assertEqual(log_analyzer.search_unprocessed_logs(config), log_names[2:])
+            self.assertEqual(log_analyzer.create_rollup_reports(config), ['report-week-2017.06.26'])
+            self.assertEqual(log_analyzer.create_rollup_reports(config), [])
+            log_analyzer.process_log(config, log_names[2])
+            self.assertEqual(log_analyzer.create_rollup_reports(config, [log_analyzer.log_date(log_names[2])]),
+                             ['report-week-2017.07.03'])
+            self.assertTrue(os.path.exists(os.path.join(report_dir, 'report-2017.06.27.snapshot')))
+            merged = log_analyzer.read_snapshot(os.path.join(report_dir, 'report-2017.06.26.snapshot'))
+            log_analyzer.merge_aggregates(
+                merged, log_analyzer.read_snapshot(os.path.join(report_dir, 'report-2017.06.27.snapshot')))
+            parsed = log_analyzer.aggregate_log(config, log_names[0])
+            log_analyzer.merge_aggregates(parsed, log_analyzer.aggregate_log(config, log_names[1]))
+            self.assertEqual(log_analyzer.create_result_mas(merged), log_analyzer.create_result_mas(parsed))
+
+    def test_directory_index_cache(self):
+        with tempfile.TemporaryDirectory() as log_dir, tempfile.TemporaryDirectory() as report_dir, \
+                tempfile.TemporaryDirectory() as cache_dir:
+            for file in ('nginx-access-ui.log-20170629.gz', 'nginx-access-ui.log-20170630.log',
+                         'nginx-access-ui.log-20171350.log', 'nginx-access-ui.log-20170701.bz2', 'other.log'):
+                open(os.path.join(log_dir, file), 'w').close()
+            open(os.path.join(report_dir, 'report-2017.06.30.html'), 'w').close()
+            config = dict(log_analyzer.default_config, LOG_DIR=log_dir, REPORT_DIR=report_dir,
+                          INDEX_CACHE_PATH=os.path.join(cache_dir, 'index.json'))
+            self.assertEqual(log_analyzer.search_last_log(config), 'nginx-access-ui.log-20170630.log')
+            self.assertTrue(log_analyzer.report_processing_check(config, 'nginx-access-ui.log-20170630.log'))
+            self.assertEqual(log_analyzer.search_unprocessed_logs(config), ['nginx-access-ui.log-20170629.gz'])
+            # directories modified long before the scan are not listed again
+            for dir_path in (log_dir, report_dir):
+                os.utime(dir_path, (1, 1))
+            log_analyzer.directory_index(config)
+            with unittest.mock.patch('log_analyzer.scan_dates') as scan_dates:
+                self.assertEqual(log_analyzer.search_unprocessed_logs(config), ['nginx-access-ui.log-20170629.gz'])
+                scan_dates.assert_not_called()
+            open(os.path.join(log_dir, 'nginx-access-ui.log-20170702.gz'), 'w').close()
+            self.assertEqual(log_analyzer.search_last_log(config), 'nginx-access-ui.log-20170702.gz')
+            # without the cache a run lists each directory once
+            open(os.path.join(report_dir, 'report-2017.07.02.html'), 'w').close()
+            with unittest.mock.patch('log_analyzer.scan_dates', wraps=log_analyzer.scan_dates) as scan_dates:
+                with self.assertLogs(level='INFO') as logs:
+                    self.assertEqual(log_analyzer.run_analyzer(dict(config, INDEX_CACHE_PATH=None)), 0)
+                self.assertEqual(scan_dates.call_count, 2)
+            self.assertTrue([line for line in logs.output if 'Last log has already been processed' in line])
+
+    def test_parse_cache(self):
+        with tempfile.TemporaryDirectory() as log_dir, tempfile.TemporaryDirectory() as cache_dir:
+            for day in ('20170629', '20170630'):
+                write_test_log(log_dir, 'nginx-access-ui.log-%s.log' % day, 2000)
+            config = dict(log_analyzer.default_config, LOG_DIR=log_dir, PARSE_CACHE_DIR=cache_dir)
+            parsed = log_analyzer.aggregate_log(config, 'nginx-access-ui.log-20170630.log')
+            with unittest.mock.patch('log_analyzer.parsing_log', side_effect=AssertionError('parsed again')):
+                cached = log_analyzer.aggregate_log(config, 'nginx-access-ui.log-20170630.log')
+            self.assertEqual(log_analyzer.create_result_mas(cached), log_analyzer.create_result_mas(parsed))
+            log_analyzer.aggregate_log(dict(config, URL_NORMALIZE=True), 'nginx-access-ui.log-20170630.log')
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+            for index, name in enumerate(('a.snapshot', 'b.snapshot', 'c.snapshot')):
+                with open(os.path.join(cache_dir, name), 'wb') as cache_file:
+                    cache_file.write(b'x' * 100)
+                os.utime(os.path.join(cache_dir, name), (index + 1, index + 1))
+            cache_files = set(os.listdir(cache_dir))
+            self.assertEqual(log_analyzer.evict_parse_cache(cache_dir, sum(
+                entry.stat().st_size for entry in os.scandir(cache_dir)) - 150, os.path.join(cache_dir, 'a.snapshot')),
+                ['b.snapshot', 'c.snapshot'])
+            self.assertEqual(set(os.listdir(cache_dir)), cache_files - {'b.snapshot', 'c.snapshot'})
+
+    def test_process_logs_batch(self):
+        with tempfile.TemporaryDirectory() as log_dir, tempfile.TemporaryDirectory() as report_dir:
+            for day in ('20170628', '20170629', '20170630', '20170701'):
+                write_test_log(log_dir, 'nginx-access-ui.log-%s.log' % day, 1000)
+            config = dict(log_analyzer.default_config, LOG_DIR=log_dir, REPORT_DIR=report_dir, INDEX_CACHE_PATH=None,
+                          PROCESS_RANGE='20170629:20170630', BATCH_WORKERS=2)
+            log_names = log_analyzer.search_unprocessed_logs(config)
+            self.assertEqual(log_names, ['nginx-access-ui.log-20170629.log', 'nginx-access-ui.log-20170630.log'])
+            metrics = log_analyzer.RunMetrics()
+            self.assertEqual(log_analyzer.process_logs(config, log_names, metrics),
+                             [log_analyzer.log_date(log_name) for log_name in log_names])
+            self.assertEqual(metrics.stages["parse"]["lines"], 2000)
+            self.assertEqual(metrics.stages["render"]["reports"], 2)
+            self.assertEqual(log_analyzer.search_unprocessed_logs(config), [])
+            self.assertEqual(log_analyzer.search_unprocessed_logs(dict(config, PROCESS_RANGE='20170630:')),
+                             ['nginx-access-ui.log-20170701.log'])
+            with self.assertRaises(ValueError):
+                log_analyzer.date_range('2017-06-29')
+            with self.assertRaises(SystemExit) as usage_error, \
+                    unittest.mock.patch('sys.stderr', new_callable=io.StringIO) as stderr:
+                log_analyzer.parser_command_line(['--range', 'bad'])
+            self.assertEqual(usage_error.exception.code, 2)
+            self.assertIn('--range', stderr.getvalue())
+            self.assertEqual(log_analyzer.parser_command_line(['--range', '20170629:']).range, '20170629:')
+
+    def test_capture_status(self):
+        lines = [string2, string2.replace('" 200 1020 ', '" 404 10 '), string2.replace('" 200 1020 ', '" 502 - '),
+                 string1, string3]
+        with tempfile.TemporaryDirectory() as log_dir, tempfile.TemporaryDirectory() as report_dir:
+            for log_name in ('nginx-access-ui.log-20170630.log', 'nginx-access-ui.log-20170701.gz'):
+                open_log = gzip.open if log_name.endswith('.gz') else open
+                with open_log(os.path.join(log_dir, log_name), 'wt', encoding='utf-8') as log_file:
+                    log_file.write('\n'.join(lines) + '\n')
+            for reader in ({"PLAIN_READER": "mmap"}, {"PLAIN_READER": "text", "GZIP_READER": "text"},
+                           {"GZIP_READER": "thread"}, {"URL_NORMALIZE": True}, {"WORKERS": 2}):
+                config = dict(log_analyzer.default_config, LOG_DIR=log_dir, REPORT_DIR=report_dir,
+                              CAPTURE_STATUS=True, **reader)
+                for log_name in ('nginx-access-ui.log-20170630.log', 'nginx-access-ui.log-20170701.gz'):
+                    aggregates = log_analyzer.aggregate_log(config, log_name)
+                    rows = log_analyzer.create_result_mas(aggregates, status_columns=True)
+                    banners = [row for row in rows if row["url"].endswith('/banners')][0]
+                    self.assertEqual((banners["count"], banners["count_4xx"], banners["count_5xx"],
+                                      banners["bytes_sum"]), (3, 1, 1, 1030))
+                    self.assertAlmostEqual(banners["error_rate"], 200 / 3)
+            path_snapshot = os.path.join(report_dir, 'report-2017.06.30.snapshot')
+            log_analyzer.write_snapshot(path_snapshot, aggregates)
+            self.assertEqual(log_analyzer.create_result_mas(log_analyzer.read_snapshot(path_snapshot), status_columns=True),
+                             rows)
+            self.assertNotIn("count_4xx", log_analyzer.create_result_mas(aggregates)[0])
+
+    def test_timeline(self):
+        lines = [string2, string2.replace('03:50:22', '03:54:59').replace(' 0.628', ' 0.002'),
+                 string2.replace('03:50:22', '04:10:00').replace('" 200 1020 ', '" 500 1 '),
+                 string2.replace('[29/Jun/2017:03:50:22 +0300]', '[bad time]'), string1, string3,
+                 string2.replace('29/Jun/2017:03:50:22', '01/Jan/2000:00:00:00')]
+        self.assertEqual(log_analyzer.latency_bin(0.0005), 0)
+        self.assertLess(0.628, log_analyzer.latency_bin_limit(log_analyzer.latency_bin(0.628)))
+        self.assertGreaterEqual(0.628, log_analyzer.latency_bin_limit(log_analyzer.latency_bin(0.628) - 1))
+        with tempfile.TemporaryDirectory() as log_dir, tempfile.TemporaryDirectory() as report_dir:
+            for log_name in ('nginx-access-ui.log-20170630.log', 'nginx-access-ui.log-20170701.gz'):
+                open_log = gzip.open if log_name.endswith('.gz') else open
+                with open_log(os.path.join(log_dir, log_name), 'wt', encoding='utf-8') as log_file:
+                    log_file.write('\n'.join(lines) + '\n')
+            for reader in ({"PLAIN_READER": "mmap"}, {"PLAIN_READER": "text", "GZIP_READER": "text"},
+                           {"CAPTURE_STATUS": True}, {"URL_NORMALIZE": True}, {"WORKERS": 2}):
+                config = dict(log_analyzer.default_config, LOG_DIR=log_dir, REPORT_DIR=report_dir,
+                              TIMELINE_BUCKET_SECONDS=300, **reader)
+                for log_name in ('nginx-access-ui.log-20170630.log', 'nginx-access-ui.log-20170701.gz'):
+                    aggregates = log_analyzer.aggregate_log(config, log_name)
+                    banners = [url_aggr for url, url_aggr in aggregates.items() if url.endswith('/banners')][0]
+                    # 29/Jun/2017:03:50:22 +0300 is 1498697422, windows start at the local midnight
+                    self.assertEqual({bucket: sum(histogram) for bucket, histogram in banners.timeline.items()},
+                                     {1498697400: 2, 1498698600: 1, 946674000: 1})
+                    self.assertEqual(banners.count, 5)
+            rows = log_analyzer.create_result_mas(aggregates)
+            timeline = log_analyzer.report_timeline(config, aggregates, rows)
+            index = [url.endswith('/banners') for url in timeline["urls"]].index(True)
+            self.assertEqual((timeline["start"], timeline["end"], timeline["bucket_seconds"]),
+                             (1498697400, 1498698600, 300))
+            self.assertEqual([window[:2] for window in timeline["windows"][index]],
+                             [[1498697400, 2], [1498698600, 1]])
+            self.assertEqual(timeline["dropped"], 1)
+            self.assertAlmostEqual(timeline["windows"][index][0][2], log_analyzer.latency_bin_limit(
+                log_analyzer.latency_bin(0.628)))
+            path_snapshot = os.path.join(report_dir, 'report-2017.06.30.snapshot')
+            log_analyzer.write_snapshot(path_snapshot, aggregates)
+            self.assertEqual(log_analyzer.report_timeline(config, log_analyzer.read_snapshot(path_snapshot), rows),
+                             timeline)
+            log_analyzer.render_report(config, 'report-2017.06.30', rows, timeline)
+            with open(os.path.join(report_dir, 'report-2017.06.30.html'), encoding='utf-8') as file_report:
+                report_text = file_report.read()
+            payload = json.loads(report_text.split('var timeline = ', 1)[1].split(';\n', 1)[0])
+            self.assertEqual([[window[:2] for window in windows] for windows in payload["windows"]],
+                             [[window[:2] for window in windows] for windows in timeline["windows"]])
+            self.assertEqual(payload["start"], timeline["start"])
+            self.assertIsNone(log_analyzer.report_timeline(log_analyzer.default_config, aggregates, rows))
+
+    def test_parse_error_limit(self):
+        lines = [string1] * 10 + ['garbage %d' % index for index in range(30)] + [string2] * 100
+        with tempfile.TemporaryDirectory() as log_dir, tempfile.TemporaryDirectory() as report_dir:
+            for log_name in ('nginx-access-ui.log-20170630.log', 'nginx-access-ui.log-20170701.gz'):
+                open_log = gzip.open if log_name.endswith('.gz') else open
+                with open_log(os.path.join(log_dir, log_name), 'wt', encoding='utf-8') as log_file:
+                    log_file.write('\n'.join(lines) + '\n')
+            for reader in ({"PLAIN_READER": "mmap", "GZIP_READER": "thread"},
+                           {"PLAIN_READER": "text", "GZIP_READER": "text"}, {"PARSER": "template"}):
+                config = dict(log_analyzer.default_config, LOG_DIR=log_dir, REPORT_DIR=report_dir,
+                              PARSE_CHECK_LINES=20, PARSE_CHECK_WINDOW=20, QUARANTINE_LINES=5, **reader)
+                for log_name in ('nginx-access-ui.log-20170630.log', 'nginx-access-ui.log-20170701.gz'):
+                    metrics = log_analyzer.RunMetrics()
+                    with self.assertLogs(level='ERROR'):
+                        with self.assertRaises(log_analyzer.ParseErrorLimit):
+                            log_analyzer.process_log(config, log_name, metrics)
+                    # 12 of the lines 3..22 are not parsed
+                    self.assertEqual(metrics.stages["parse"]["lines"], 22)
+                    with open(os.path.join(report_dir, log_name + '.quarantine'), encoding='utf-8') as file_quarantine:
+                        self.assertEqual(file_quarantine.read().splitlines(), ['garbage %d' % index for index in range(5)])
+            config = dict(log_analyzer.default_config, LOG_DIR=log_dir, REPORT_DIR=report_dir, INDEX_CACHE_PATH=None,
+                          PROCESS_ALL=True)
+            with self.assertLogs(level='INFO'):
+                self.assertEqual(log_analyzer.run_analyzer(dict(config, PARSE_CHECK_LINES=20, PARSE_CHECK_WINDOW=20)),
+                                 log_analyzer.EXIT_PARSE_ERRORS)
+                self.assertEqual(log_analyzer.run_analyzer(dict(config, WORKERS=2, PARSE_CHECK_LINES=10,
+                                                                PARSE_CHECK_WINDOW=20)),
+                                 log_analyzer.EXIT_PARSE_ERRORS)
+            self.assertEqual([name for name in os.listdir(report_dir) if name.endswith('.html')], [])
+            # the error parsing of a log shorter than PARSE_CHECK_LINES is checked at its end
+            with self.assertLogs(level='INFO'):
+                self.assertEqual(log_analyzer.run_analyzer(dict(config, THRESHOLD_ERROR_PARS_PERCENT=20)),
+                                 log_analyzer.EXIT_PARSE_ERRORS)
+                self.assertEqual(log_analyzer.run_analyzer(config), 0)
+            self.assertEqual(len([name for name in os.listdir(report_dir) if name.endswith('.html')]), 2)
+
+    def test_library_api(self):
+        loaded = subprocess.run([sys.executable, '-c', 'import sys, log_analyzer; print(*[module for module in '
+                                 '("numpy", "argparse", "concurrent.futures", "cProfile", "pickle", "shutil", '
+                                 '"subprocess") if module in sys.modules])'],
+                                check=True, stdout=subprocess.PIPE, universal_newlines=True,
+                                cwd=os.path.dirname(os.path.abspath(log_analyzer.__file__))).stdout.split()
+        self.assertEqual(loaded, [])
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = write_test_log(log_dir, 'access.log', 500)
+            config = dict(log_analyzer.default_config, LOG_DIR=log_dir)
+            expected = log_analyzer.create_result_mas(log_analyzer.aggregate_log(config, 'access.log'), 10)
+            with unittest.mock.patch.object(sys, 'argv', ['scheduler', '--unknown-option']):
+                result = log_analyzer.analyze(log_path, {"REPORT_SIZE": 10})
+            self.assertEqual(result.rows, expected)
+            self.assertIsNone(result.timeline)
+            self.assertEqual(result.stages["parse"]["lines"], 500)
+            counter = {}
+            with open(log_path, encoding='utf-8') as log_file:
+                lines = log_file.read().splitlines()
+            self.assertEqual(list(log_analyzer.iter_records(log_path, counter)),
+                             [record for record in map(log_analyzer.parsing_line, lines) if record is not None])
+            self.assertEqual(counter["total"], 500)
+            self.assertLess(counter["processed"], 500)
+            with open(os.path.join(log_dir, 'config.json'), 'w', encoding='utf-8') as file_config:
+                json.dump({"REPORT_SIZE": 5}, file_config)
+            with unittest.mock.patch.object(sys, 'argv', ['scheduler', '--unknown-option']):
+                self.assertEqual(log_analyzer.configs_merger({}, log_dir, 'config.json'), {"REPORT_SIZE": 5})
+            args = log_analyzer.parser_command_line(['--config', 'config.json', '--workers', '2'])
+            self.assertEqual(log_analyzer.configs_merger({}, log_dir, args=args), {"REPORT_SIZE": 5, "WORKERS": 2})
+            with open(os.path.join(log_dir, 'garbage.log'), 'w', encoding='utf-8') as log_file:
+                log_file.write('garbage\n' * 100)
+            saved_cwd = os.getcwd()
+            os.chdir(log_dir)
+            try:
+                with self.assertLogs(level='ERROR'), self.assertRaises(log_analyzer.ParseErrorLimit):
+                    log_analyzer.analyze(os.path.join(log_dir, 'garbage.log'))
+            finally:
+                os.chdir(saved_cwd)
+            self.assertFalse([name for name in os.listdir(log_dir) if name.endswith('.quarantine')])
+            self.assertFalse(os.path.exists(os.path.join(log_dir, 'reports')))
+
+    def test_run_metrics(self):
+        with tempfile.TemporaryDirectory() as log_dir, tempfile.TemporaryDirectory() as report_dir:
+            log_path = write_test_log(log_dir, 'nginx-access-ui.log-20170630.log', 10000)
+            metrics_path = os.path.join(report_dir, 'log_analyzer.prom')
+            config = dict(log_analyzer.default_config, LOG_DIR=log_dir, REPORT_DIR=report_dir,
+                          METRICS_PATH=metrics_path, INDEX_CACHE_PATH=None)
+            with self.assertLogs(level='INFO') as logs:
+                log_analyzer.run_analyzer(config)
+            summary = [message for message in logs.output if 'Run summary' in message]
+            self.assertEqual(len(summary), 1)
+            stages = json.loads(summary[0].split('Run summary ', 1)[1])["stages"]
+            self.assertEqual(list(stages), ['discover', 'parse', 'aggregate', 'stats', 'render'])
+            self.assertEqual(stages["parse"]["lines"], 10000)
+            self.assertEqual(stages["parse"]["bytes"], os.path.getsize(log_path))
+            self.assertGreater(stages["aggregate"]["distinct_urls"], 0)
+            self.assertGreater(stages["parse"]["wall_seconds"], 0)
+            with open(metrics_path, encoding='utf-8') as file_metrics:
+                metrics_text = file_metrics.read()
+            self.assertIn('log_analyzer_stage_lines{stage="parse"} 10000\n', metrics_text)
+            self.assertIn('# TYPE log_analyzer_stage_wall_seconds gauge', metrics_text)
+            self.assertIn('log_analyzer_run_peak_memory_bytes ', metrics_text)
+            self.assertNotIn('peak_memory_bytes', stages["parse"])
+
+    def test_run_metrics_nested_stage(self):
+        metrics = log_analyzer.RunMetrics()
+        with metrics.stage("outer"):
+            with metrics.stage("inner"):
+                sum(range(100000))
+        self.assertLess(metrics.stages["outer"]["wall_seconds"], metrics.stages["inner"]["wall_seconds"])
+        self.assertEqual(list(metrics.timed_batches("parse", range(10000))), list(range(10000)))
+        self.assertIn("parse", metrics.stages)
+
+    def test_render_report_payload(self):
+        with tempfile.TemporaryDirectory() as report_dir:
+            rows = log_analyzer.create_result_mas(test_dict2)
+            rows[0]["url"] = '/x</script><script>alert(1)'
+            config = dict(log_analyzer.default_config, REPORT_DIR=report_dir, REPORT_SIZE=2)
+            log_analyzer.render_report(config, 'report-2017.06.30', rows)
+            with open(os.path.join(report_dir, 'report-2017.06.30.html'), encoding='utf-8') as file_report:
+                report_text = file_report.read()
+            self.assertNotIn('</script><script>', report_text)
+            payload = json.loads(report_text.split('var payload = ', 1)[1].split(';\n', 1)[0])
+            self.assertEqual(payload["count"], 2)
+            self.assertEqual(payload["columns"]["url"], [row["url"] for row in rows[:2]])
+            self.assertEqual(payload["columns"]["time_avg"], [round(row["time_avg"], 3) for row in rows[:2]])
+            config["REPORT_GZIP"] = True
+            config["LOG_DIR"] = report_dir
+            config["INDEX_CACHE_PATH"] = None
+            log_analyzer.render_report(config, 'report-2017.07.01', rows)
+            with gzip.open(os.path.join(report_dir, 'report-2017.07.01.html.gz'), 'rt', encoding='utf-8') as file_report:
+                self.assertEqual(file_report.read(), report_text)
+            self.assertTrue(log_analyzer.report_processing_check(config, 'nginx-access-ui.log-20170701.gz'))
+            with unittest.mock.patch.object(log_analyzer, 'write_table_payload', side_effect=OSError('disk full')):
+                with self.assertLogs(level='INFO') as logs:
+                    log_analyzer.render_report(config, 'report-2017.07.01', rows)
+            self.assertFalse([line for line in logs.output if 'Create report file' in line])
+            self.assertFalse(os.path.exists(os.path.join(report_dir, 'report-2017.07.01.tmp')))
+            with gzip.open(os.path.join(report_dir, 'report-2017.07.01.html.gz'), 'rt', encoding='utf-8') as file_report:
+                self.assertEqual(file_report.read(), report_text)
+
+    def test_follow_log(self):
+        with tempfile.TemporaryDirectory() as log_dir, tempfile.TemporaryDirectory() as report_dir:
+            config = dict(log_analyzer.default_config, LOG_DIR=log_dir, REPORT_DIR=report_dir,
+                          FOLLOW_INTERVAL=0, FOLLOW_POLL=0)
+            log_path = os.path.join(log_dir, config["FOLLOW_LOG"])
+            with open(log_path, 'w', encoding='utf-8') as log_file:
+                log_file.write(string1 + '\n' + string3 + '\n' + string2)
+            log_analyzer.follow_log(config, iterations=1)
+            report_path = os.path.join(report_dir, 'report-live.html')
+            self.assertTrue(os.path.exists(report_path))
+            state, aggregates = log_analyzer.load_follow_state(config)
+            self.assertEqual(state["offset"], len(string1) + len(string3) + 2)
+            self.assertEqual([url_aggr.count for url_aggr in aggregates.values()], [1])
+            with open(log_path, 'a', encoding='utf-8') as log_file:
+                log_file.write('\n' + string2 + '\n')
+            with unittest.mock.patch.object(log_analyzer, 'save_follow_state',
+                                            wraps=log_analyzer.save_follow_state) as save_follow_state:
+                log_analyzer.follow_log(config, iterations=2)
+                self.assertEqual(save_follow_state.call_count, 1)
+            state, aggregates = log_analyzer.load_follow_state(config)
+            self.assertEqual(state["offset"], os.path.getsize(log_path))
+            self.assertEqual(aggregates["/api/v2/group/1769230/banners"].count, 2)
+            with open(log_path, 'w', encoding='utf-8') as log_file:
+                log_file.write(string2 + '\n')
+            log_analyzer.follow_log(config, iterations=1)
+            state, aggregates = log_analyzer.load_follow_state(config)
+            self.assertEqual(dict((url, url_aggr.count) for url, url_aggr in aggregates.items()),
+                             {"/api/v2/group/1769230/banners": 1})
+
+    def test_follow_read_long_line(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_path = os.path.join(log_dir, 'access.log')
+            with open(log_path, 'w', encoding='utf-8') as log_file:
+                log_file.write(string1 + '\n' + 'x' * 2500 + '\n' + string2 + '\n')
+            state = {"inode": None, "offset": 0}
+            aggregates = log_analyzer.new_url_aggregates()
+            offsets = []
+            with unittest.mock.patch.object(log_analyzer, 'FOLLOW_READ_SIZE', 1000):
+                with self.assertLogs(level='WARNING'):
+                    for _ in range(6):
+                        log_analyzer.follow_read(log_path, state, aggregates)
+                        offsets.append(state["offset"])
+            self.assertEqual(offsets[-1], os.path.getsize(log_path))
+            self.assertEqual(offsets, sorted(offsets))
+            self.assertEqual(sorted(url_aggr.count for url_aggr in aggregates.values()), [1, 1])
+
+    def test_exact_quantile(self):
+        rnd = random.Random(8)
+        for size in (1, 2, 7, 100, 1001):
+            values = [rnd.choice((0.0, 0.1, rnd.random())) for _ in range(size)]
+            for quantile in (0.0, 0.5, 0.95, 0.99, 1.0):
+                self.assertEqual(log_analyzer.exact_quantile(values, quantile),
+                                 sorted(values)[min(int(quantile * size), size - 1)])
+        self.assertEqual(log_analyzer.exact_quantile([float(item) for item in test_dict1['url1']], 0.5),
+                         log_analyzer.median_time_request(test_dict1['url1']))
+        self.assertEqual(log_analyzer.exact_quantiles(values, (0.5, 0.95, 0.99)),
+                         [log_analyzer.exact_quantile(values, quantile) for quantile in (0.5, 0.95, 0.99)])
+
+    def test_quantile_sketch(self):
+        rnd = random.Random(95)
+        values = [rnd.lognormvariate(-2, 1) for _ in range(20000)] + [0.0] * 100
+        first, second = log_analyzer.QuantileSketch(0.01), log_analyzer.QuantileSketch(0.01)
+        for value in values[:7000]:
+            first.add(value)
+        for value in values[7000:]:
+            second.add(value)
+        first.merge(second)
+        self.assertEqual(first.count, len(values))
+        for quantile in (0.001, 0.5, 0.95, 0.99):
+            exact = sorted(values)[int(quantile * len(values))]
+            self.assertLessEqual(abs(first.quantile(quantile) - exact), 0.01 * exact + 1e-12)
+
+    def test_url_aggregate_sketch_merge(self):
+        rnd = random.Random(99)
+        values = [rnd.random() for _ in range(3000)]
+        limits = (1000, 0.01)
+        parts = [log_analyzer.url_aggregate(values[:500], limits), log_analyzer.url_aggregate(values[500:2000], limits),
+                 log_analyzer.url_aggregate(values[2000:], limits)]
+        self.assertIsNone(parts[0].sketch)
+        self.assertIsNotNone(parts[1].sketch)
+        parts[0].merge(parts[1])
+        parts[0].merge(parts[2])
+        # the limits belong to the aggregates, not to the class
+        self.assertEqual(log_analyzer.UrlAggregate().exact_limit, log_analyzer.QUANTILE_LIMITS[0])
+        self.assertEqual(log_analyzer.quantile_limits(dict(log_analyzer.default_config, QUANTILE_BACKEND="sketch")),
+                         (0, log_analyzer.default_config["QUANTILE_RELATIVE_ERROR"]))
+        self.assertEqual(parts[0].count, len(values))
+        self.assertAlmostEqual(parts[0].time_sum, sum(values))
+        self.assertEqual(parts[0].time_max, max(values))
+        for quantile in (0.5, 0.95, 0.99):
+            exact = sorted(values)[int(quantile * len(values))]
+            self.assertLessEqual(abs(parts[0].quantile(quantile) - exact), 0.01 * exact)
+
+    def test_split_block_lines(self):
+        blocks = [b'a\nb', b'c\n', b'', b'd\ne']
+        self.assertEqual(list(log_analyzer.split_block_lines(blocks)), [b'a', b'bc', b'd', b'e'])
+
+    def test_create_result_mas_top(self):
+        rnd = random.Random(9)
+        mass_url = [('/url%d' % rnd.randint(0, 300), rnd.choice(('0.5', '1.0', '%.3f' % rnd.random())))
+                    for _ in range(5000)]
+        full_sort = log_analyzer.create_result_mas(log_analyzer.aggregate_url(mass_url))
+        for report_size in (0, 1, 10, 100, 301, 1000):
+            self.assertEqual(log_analyzer.create_result_mas(log_analyzer.aggregate_url(mass_url), report_size),
+                             full_sort[:report_size])
+
+    def test_url_normalizer(self):
+        normalizer = log_analyzer.UrlNormalizer([[r'^/api/v\d+/', '/api/']], 2)
+        self.assertEqual(normalizer.normalize(
+            "/api/v2/group/7786679/statistic/sites/?date_type=day&date_from=2017-06-28"),
+            "/api/group/{id}/statistic/sites/")
+        self.assertEqual(normalizer.normalize("/api/v2/slot/4822/groups"), "/api/slot/{id}/groups")
+        self.assertEqual(normalizer.normalize("/export/712e90144abee9/x"), "/export/{hex}/x")
+        self.assertEqual(normalizer.normalize("/banner/25019354"), "/banner/{id}")
+        self.assertEqual(len(normalizer.cache), 2)
+        self.assertEqual(normalizer.raw_urls.estimate(), 4)
+        self.assertEqual(normalizer.normalized_urls.estimate(), 4)
+
+    def test_cardinality_estimator(self):
+        first, second = log_analyzer.CardinalityEstimator(), log_analyzer.CardinalityEstimator()
+        for index in range(30000):
+            first.add('/url/%d' % index)
+            second.add('/url/%d' % (index + 20000))
+        first.merge(second)
+        self.assertLess(abs(first.estimate() - 50000), 50000 * 0.05)
+
+    def test_aggregate_url_max_distinct(self):
+        mass_url = [('/url%d' % (index % 50 if index % 3 else index), '0.1') for index in range(3000)]
+        aggregates = log_analyzer.aggregate_url(mass_url, max_distinct=100)
+        self.assertLessEqual(len(aggregates), 100)
+        self.assertIn(log_analyzer.OTHER_URL, aggregates)
+        self.assertEqual(sum(url_aggr.count for url_aggr in aggregates.values()), 3000)
+        for index in range(1, 50, 3):
+            self.assertEqual(aggregates['/url%d' % index].count, 40)
+
+    @unittest.skipIf(log_analyzer.load_numpy() is None, 'numpy is not installed')
+    def test_create_result_mas_numpy(self):
+        rnd = random.Random(11)
+        mass_url = [('/url%d' % rnd.randint(0, 200), '%.3f' % rnd.random()) for _ in range(5000)]
+        expected = log_analyzer.create_result_mas(log_analyzer.aggregate_url(mass_url), 50)
+        columnar = log_analyzer.aggregate_columnar(mass_url)
+        result = log_analyzer.create_result_mas(columnar, 50)
+        self.assertEqual([row["url"] for row in result], [row["url"] for row in expected])
+        for row, expected_row in zip(result, expected):
+            for key, value in expected_row.items():
+                if isinstance(value, float):
+                    self.assertAlmostEqual(row[key], value, msg=key)
+                else:
+                    self.assertEqual(row[key], value, key)
+        self.assertEqual(log_analyzer.create_result_mas(columnar.to_url_aggregates(), 50), expected)
+
+    @unittest.skipIf(log_analyzer.load_numpy() is None, 'numpy is not installed')
+    def test_aggregate_log_numpy_parallel(self):
+        with tempfile.TemporaryDirectory() as log_dir:
+            log_name = 'nginx-access-ui.log-20170630.log'
+            write_test_log(log_dir, log_name, 3000)
+            config = dict(log_analyzer.default_config, LOG_DIR=log_dir, STATS_BACKEND="numpy")
+            sequential = log_analyzer.aggregate_log(config, log_name)
+            config["WORKERS"] = 2
+            parallel = log_analyzer.aggregate_log(config, log_name)
+            self.assertEqual(log_analyzer.create_result_mas(parallel), log_analyzer.create_result_mas(sequential))
+        with tempfile.TemporaryDirectory() as log_dir:
+            # 20 parts of the log with 2 URLs each, the URL with the most requests is in the last part
+            rnd = random.Random(11)
+            lines = []
+            for part in range(20):
+                part_urls = ['/api/part/%d/a' % part] * (31 + part) + ['/api/part/%d/b' % part] * (30 - part)
+                rnd.shuffle(part_urls)
+                lines.extend(string2.replace('/api/v2/group/1769230/banners', url).replace(
+                    '0.628', '%.3f' % rnd.random()) for url in part_urls)
+            with open(os.path.join(log_dir, log_name), 'w', encoding='utf-8') as log_file:
+                log_file.write('\n'.join(lines) + '\n')
+            config = dict(log_analyzer.default_config, LOG_DIR=log_dir, URL_MAX_DISTINCT=10, WORKERS=2)
+            # no chunk of the python backend reaches the limit, its rows are the exact top URLs
+            expected = log_analyzer.create_result_mas(log_analyzer.aggregate_log(config, log_name))
+            self.assertEqual(len(expected), 10)
+            self.assertEqual({row["url"] for row in expected},
+                             {'other'} | {'/api/part/%d/a' % part for part in range(11, 20)})
+            for workers in (1, 2):
+                limited = log_analyzer.aggregate_log(dict(config, STATS_BACKEND="numpy", WORKERS=workers), log_name)
+                self.assertEqual(len(limited.ids), len(lines))
+                for rows in (log_analyzer.create_result_mas(limited),
+                             log_analyzer.create_result_mas(log_analyzer.url_aggregates(limited))):
+                    self.assertEqual([row["url"] for row in rows], [row["url"] for row in expected])
+                    for row, expected_row in zip(rows, expected):
+                        for key, value in expected_row.items():
+                            if isinstance(value, float):
+                                self.assertAlmostEqual(row[key], value, msg=key)
+                            else:
+                                self.assertEqual(row[key], value)
+
     def test_time_max(self):
         self.assertEqual(log_analyzer.time_max([1,2,3,4,5,6,7]),7)
         self.assertEqual(log_analyzer.time_max([1, 21, 3, 4, 5, 6, 7]), 21)